@@ -4,17 +4,41 @@ LE TATCHE BOIS - Professional Document Generator
 Facture, Devis, and Papier En-Tête conforming to Moroccan CGI (art. 145-146)
 """
 
+import calendar
+import copy
+import functools
+import hashlib
+import io
+import json
+import math
 import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm, cm
-from reportlab.lib.colors import HexColor, white, black, Color
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import Table, TableStyle
-from PIL import Image
-import copy
+
+# Start-up loads only the standard library above and ReportLab's two constant
+# modules (page sizes, units). ReportLab proper (canvas, config, platypus), PIL
+# and pymupdf - and multiprocessing / http.server - are imported lazily by the
+# functions that first use them, so --help, list and validate stay fast (see
+# check_import_time)
+
+
+@functools.lru_cache(maxsize=None)
+def _rl_config():
+    """ReportLab's settings, configured on first use"""
+    from reportlab import rl_config
+
+    # Image streams are already Flate/JPEG; skip the extra ASCII85 layer (+25% size,
+    # and ReportLab's pure-Python encoder was most of the render time)
+    rl_config.useA85 = 0
+    return rl_config
 
 # ─── COMPANY INFO ────────────────────────────────────────────────
 COMPANY = {
@@ -33,54 +57,687 @@ COMPANY = {
 }
 
 # ─── COLORS (Gold/Brown branding) ───────────────────────────────
-GOLD_DARK = HexColor("#8B6914")
-GOLD = HexColor("#C5961A")
-GOLD_LIGHT = HexColor("#D4A843")
-GOLD_PALE = HexColor("#F5E6C0")
-BROWN_DARK = HexColor("#3D1F00")
-BROWN = HexColor("#5C2E00")
-BROWN_MEDIUM = HexColor("#7A3B11")
-WHITE = white
-BLACK = black
-GRAY_LIGHT = HexColor("#F5F5F0")
-GRAY = HexColor("#888888")
-GRAY_DARK = HexColor("#444444")
-LINE_COLOR = HexColor("#C5961A")
+# Hex strings: ReportLab takes them wherever it takes a colour (toColor)
+GOLD_DARK = "#8B6914"
+GOLD = "#C5961A"
+GOLD_LIGHT = "#D4A843"
+GOLD_PALE = "#F5E6C0"
+BROWN_DARK = "#3D1F00"
+BROWN = "#5C2E00"
+BROWN_MEDIUM = "#7A3B11"
+WHITE = "#FFFFFF"
+BLACK = "#000000"
+GRAY_LIGHT = "#F5F5F0"
+GRAY = "#888888"
+GRAY_DARK = "#444444"
+LINE_COLOR = "#C5961A"
 
 # ─── PATHS ───────────────────────────────────────────────────────
-LOGO_HEADER = "/home/claude/logo_cropped_final.png"
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGO_HEADER = os.path.join(ASSET_DIR, "logo-header.png")
 LOGO_FOOTER = "/mnt/user-data/uploads/logo_tatchebois_footer_2.png"
-LOGO_WATERMARK = "/home/claude/logo_watermark.png"
+LOGO_WATERMARK = os.path.join(ASSET_DIR, "logo-watermark.png")
 BORDER_FRAME = "/home/claude/border_frame.png"
-WOOD_BG = "/mnt/user-data/uploads/Screenshot_at_Feb_06_21-28-21.png"
+WOOD_BG = os.path.join(ASSET_DIR, "wood-bg.png")
+FRAME_TOP = os.path.join(ASSET_DIR, "frame_top.png")
+FRAME_BOTTOM = os.path.join(ASSET_DIR, "frame_bottom.png")
+FRAME_LEFT = os.path.join(ASSET_DIR, "frame_left.png")
+FRAME_RIGHT = os.path.join(ASSET_DIR, "frame_right.png")
 OUTPUT_DIR = "/home/claude"
 
 W, H = A4  # 595.27 x 841.89 points
 
 
-WOOD_BAR_TEXTURE = "/mnt/user-data/uploads/Screenshot_at_Feb_06_20-59-22.png"
-WOOD_HEADER_TEXTURE = "/mnt/user-data/uploads/Screenshot_at_Feb_06_21-08-04.png"
+WOOD_BAR_TEXTURE = os.path.join(ASSET_DIR, "wood-bar.png")
+WOOD_HEADER_TEXTURE = os.path.join(ASSET_DIR, "wood-header.png")
+
+
+# ─── RENDER CONTEXT ─────────────────────────────────────────────
+# The constants above are only defaults: a render reads its company, colours and
+# asset paths from the RenderContext on its canvas, so documents for different
+# settings can be drawn at the same time, from any number of threads
+THEME_COLOURS = ("GOLD_DARK", "GOLD", "GOLD_LIGHT", "GOLD_PALE", "BROWN_DARK", "BROWN", "BROWN_MEDIUM",
+                 "WHITE", "BLACK", "GRAY_LIGHT", "GRAY", "GRAY_DARK", "LINE_COLOR")
+ASSET_NAMES = ("LOGO_HEADER", "LOGO_WATERMARK", "WOOD_BG", "WOOD_BAR_TEXTURE", "WOOD_HEADER_TEXTURE",
+               "FRAME_TOP", "FRAME_BOTTOM", "FRAME_LEFT", "FRAME_RIGHT")
+Theme = namedtuple("Theme", THEME_COLOURS)
+AssetPaths = namedtuple("AssetPaths", ASSET_NAMES)
+
+
+class RenderContext:
+    """Everything a render reads besides the document data: company info, theme
+    colours, asset paths and the cache decoding them, quality, output profile,
+    output directory and the flat background / deterministic / overlay modes.
+
+    Fields left out take the module settings (COMPANY, the colour and path
+    constants, OUTPUT_DIR, ASSETS, the use_* modes) as they are when the
+    context is built; theme and assets may also be given as partial dicts.
+    A context never changes after that (derive variants with replace()), so
+    one can be shared by any number of threads. Builders take it as context=
+    and put it on their canvas, where every draw_* helper finds it.
+    """
+
+    __slots__ = ("company", "theme", "assets", "asset_cache", "quality", "profile", "output_dir",
+                 "flat_background", "deterministic", "overlay")
+
+    def __init__(self, company=None, theme=None, assets=None, asset_cache=None, quality="final",
+                 profile=None, output_dir=None, flat_background=None, deterministic=None, overlay=None):
+        from types import MappingProxyType
+
+        if quality not in QUALITIES:
+            raise ValueError(f"unknown quality {quality!r} (expected one of {', '.join(QUALITIES)})")
+        resolve_profile(profile)  # fail here on an unknown profile name
+        defaults = globals()
+        if not isinstance(theme, Theme):
+            theme = Theme(*(defaults[name] for name in THEME_COLOURS))._replace(**(theme or {}))
+        if not isinstance(assets, AssetPaths):
+            assets = AssetPaths(*(defaults[name] for name in ASSET_NAMES))._replace(**(assets or {}))
+        fields = {
+            "company": MappingProxyType(dict(COMPANY if company is None else company)),
+            "theme": theme,
+            "assets": assets,
+            "asset_cache": ASSETS if asset_cache is None else asset_cache,
+            "quality": quality,
+            "profile": copy.deepcopy(profile),
+            "output_dir": OUTPUT_DIR if output_dir is None else output_dir,
+            # False / "" turn a mode off whatever the module setting
+            "flat_background": (FLAT_BACKGROUND if flat_background is None else flat_background) or None,
+            "deterministic": bool(DETERMINISTIC if deterministic is None else deterministic),
+            "overlay": bool(LETTERHEAD_OVERLAY if overlay is None else overlay),
+        }
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RenderContext is immutable; use replace()")
+
+    def replace(self, **changes):
+        """A copy of this context with some fields changed"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return RenderContext(**fields)
+
+    def __repr__(self):
+        return (f"RenderContext(company={self.company.get('name')!r}, quality={self.quality!r}, "
+                f"profile={self.profile!r}, overlay={self.overlay})")
+
+
+def render_context(c):
+    """The RenderContext c was created with (see new_canvas); a bare canvas
+    gets one with the module settings"""
+    context = c.__dict__.get("_context")
+    if context is None:
+        context = c._context = RenderContext()
+    return context
+
+
+# ─── STAGE TIMING ────────────────────────────────────────────────
+STAGE_HOOK = None  # see use_stage_hook; None leaves the draw stages untimed
+_stage_frames = threading.local()
+
+
+def use_stage_hook(hook):
+    """Install a callable that receives one record per finished draw stage
+    (None disables timing); returns the previous hook"""
+    global STAGE_HOOK
+    previous, STAGE_HOOK = STAGE_HOOK, hook
+    return previous
+
+
+def _canvas_counters(c):
+    # Pages completed so far (showPage calls) and image stream bytes embedded
+    return c.getPageNumber(), c.__dict__.get("_image_bytes", 0)
+
+
+def stage(name):
+    """Decorator marking a draw stage or builder, named after the function or name.
+
+    With a hook installed each call reports {"stage", "path", "wall_s", "cpu_s",
+    "image_bytes", "pages"}: path is the chain of enclosing stages, and pages /
+    image bytes are those completed or embedded during the call. Stages take
+    their canvas as first argument; a builder, which creates its own, adopts
+    the canvas of its first nested stage.
+    """
+    if callable(name):
+        return stage(name.__name__)(name)
+
+    def decorate(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            hook = STAGE_HOOK
+            if hook is None:
+                return func(*args, **kwargs)
+            frames = _stage_frames.__dict__.setdefault("frames", [])
+            c = args[0] if args and hasattr(args[0], "showPage") else None
+            frame = [name, c, *(_canvas_counters(c) if c is not None else (0, 0))]
+            frames.append(frame)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+                frames.pop()
+                _, c, pages, image_bytes = frame
+                if c is not None:
+                    if frames and frames[-1][1] is None:
+                        frames[-1][1:] = frame[1:]
+                    now_pages, now_bytes = _canvas_counters(c)
+                    pages, image_bytes = now_pages - pages, now_bytes - image_bytes
+                hook({"stage": name, "path": "/".join([f[0] for f in frames] + [name]),
+                      "wall_s": wall, "cpu_s": cpu, "image_bytes": image_bytes, "pages": pages})
+        return timed
+    return decorate
+
+
+class StageRecorder:
+    """Stage hook collecting records in memory, exportable as JSON lines,
+    Prometheus text or folded stacks (flamegraph.pl / speedscope).
+
+        with StageRecorder() as stages:
+            render_pdf("facture")
+        stages.write("stages.prom")
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def __enter__(self):
+        self._previous = use_stage_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        use_stage_hook(self._previous)
+
+    def totals(self, key="stage"):
+        """Sums per stage name (or per path): calls, wall_s, cpu_s, image_bytes, pages"""
+        totals = {}
+        with self._lock:
+            for record in self.records:
+                total = totals.setdefault(record[key], dict.fromkeys(
+                    ("calls", "wall_s", "cpu_s", "image_bytes", "pages"), 0))
+                total["calls"] += 1
+                for field in ("wall_s", "cpu_s", "image_bytes", "pages"):
+                    total[field] += record[field]
+        return totals
+
+    def jsonl(self):
+        with self._lock:
+            return "".join(json.dumps(record) + "\n" for record in self.records)
+
+    def prometheus(self):
+        metrics = (("calls", "tatche_stage_calls_total", "Stage calls"),
+                   ("wall_s", "tatche_stage_wall_seconds_total", "Wall time spent in the stage"),
+                   ("cpu_s", "tatche_stage_cpu_seconds_total", "CPU time spent in the stage"),
+                   ("image_bytes", "tatche_stage_image_bytes_total", "Image stream bytes embedded"),
+                   ("pages", "tatche_stage_pages_total", "Pages completed"))
+        totals = self.totals()
+        lines = []
+        for field, metric, doc in metrics:
+            lines += [f"# HELP {metric} {doc} (nested stages included).", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{name}"}} {total[field]:.6g}' for name, total in totals.items()]
+        return "\n".join(lines) + "\n"
+
+    def folded(self):
+        """Folded stacks weighted by self wall time in microseconds"""
+        totals = {path: total["wall_s"] for path, total in self.totals("path").items()}
+        self_time = dict(totals)
+        for path, wall in totals.items():
+            parent = path.rpartition("/")[0]
+            if parent in self_time:
+                self_time[parent] -= wall
+        return "".join(f"{path.replace('/', ';')} {max(0, round(wall * 1e6))}\n"
+                       for path, wall in self_time.items())
+
+    def report(self):
+        """Per-stage table, slowest first"""
+        lines = [f"{'Stage':<26}{'Calls':>7}{'Wall':>11}{'CPU':>11}{'Images':>10}{'Pages':>7}"]
+        for name, t in sorted(self.totals().items(), key=lambda kv: -kv[1]["wall_s"]):
+            lines.append(f"{name:<26}{t['calls']:>7}{t['wall_s'] * 1000:>8.1f} ms{t['cpu_s'] * 1000:>8.1f} ms"
+                         f"{t['image_bytes'] / 1024:>7.0f} KB{t['pages']:>7}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Export by extension: .prom Prometheus, .folded stacks, '-' table on stderr, else JSON lines"""
+        if path == "-":
+            sys.stderr.write(self.report())
+            return
+        ext = os.path.splitext(path)[1]
+        text = self.prometheus() if ext == ".prom" else self.folded() if ext == ".folded" else self.jsonl()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+# ─── ASSET CACHE ─────────────────────────────────────────────────
+class AssetCache:
+    """Process-wide cache of decoded branding images, keyed by path + mtime"""
+
+    def __init__(self):
+        self._readers = {}
+        self._xobjects = {}  # (path, mtime, mask) -> encoded PDFImageXObject prototype
+        self.variants = {}  # source path -> resampled variant (see optimise_assets)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Return a shared, fully decoded ImageReader for path"""
+        from reportlab.lib.utils import ImageReader
+
+        path = self.variants.get(path, path)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            reader = self._readers.get(key)
+            if reader is not None:
+                self.hits += 1
+                return reader
+            self.misses += 1
+        # Decode outside the lock; a racing miss only costs a duplicate decode
+        reader = ImageReader(path)
+        reader.getRGBData()
+        if reader._dataA is not None:
+            reader._dataA.getRGBData()
+        with self._lock:
+            # Drop readers for older versions of the same file
+            for stale in [k for k in self._readers if k[0] == path]:
+                del self._readers[stale]
+            return self._readers.setdefault(key, reader)
+
+    def xobject(self, path, mask=None):
+        """Return (drawn path, image XObject prototype) - encoded once per process"""
+        from reportlab.lib.utils import _digester
+        from reportlab.pdfbase import pdfdoc
+
+        path = self.variants.get(path, path)
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, str(mask))
+        with self._lock:
+            proto = self._xobjects.get(key)
+            if proto is not None:
+                self.hits += 1  # a miss is counted by get() below
+        if proto is None:
+            # Named after the file name and content, never its directory, so the
+            # same assets give the same PDF bytes from any checkout
+            digest = _asset_digest(path, st.st_mtime_ns, st.st_size)
+            name = _digester(f"{os.path.basename(path)}|{digest}|{mask}".encode("utf8"))
+            _rl_config()  # the XObject picks its stream filters from it
+            proto = pdfdoc.PDFImageXObject(name, self.get(path), mask=mask)
+            with self._lock:
+                for stale in [k for k in self._xobjects if k[0] == path and k[1] != key[1]]:
+                    del self._xobjects[stale]
+                proto = self._xobjects.setdefault(key, proto)
+        return path, proto
+
+    def invalidate(self, path=None):
+        """Forget one asset (or all of them) after the file was replaced"""
+        with self._lock:
+            if path is None:
+                self._readers.clear()
+                self._xobjects.clear()
+                self.variants.clear()
+            else:
+                variant = self.variants.pop(path, None)
+                for cache in (self._readers, self._xobjects):
+                    for key in [k for k in cache if k[0] in (path, variant)]:
+                        del cache[key]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._readers)}
+
+
+ASSETS = AssetCache()
+
+
+def invalidate_assets(path=None):
+    """Call after replacing the logo or textures on disk"""
+    ASSETS.invalidate(path)
+
+
+def draw_asset(c, path, x, y, width=None, height=None, mask=None, preserveAspectRatio=False):
+    """drawImage for a cached asset.
+
+    The image is decoded, hashed and compressed once per process; each canvas only
+    registers a shallow copy of the shared XObject (and its soft mask) on first use,
+    then places it as drawImage would.
+    """
+    from reportlab.lib.boxstuff import aspectRatioFix
+    from reportlab.pdfbase import pdfdoc
+
+    path = c.__dict__.get("_asset_variants", {}).get(path, path)
+    path, proto = render_context(c).asset_cache.xobject(path, mask)
+    doc = c._doc
+    reg_name = doc.getXObjectName(proto.name)
+    if reg_name not in doc.idToObject:
+        img = copy.copy(proto)
+        embedded = len(img.streamContent)  # counted for the stage hooks
+        smask = img.__dict__.pop("_smask", None)
+        if smask is not None:
+            mask_name = doc.getXObjectName(smask.name)
+            if mask_name in doc.idToObject:
+                img.smask = pdfdoc.PDFObjectReference(mask_name)
+            else:
+                img.smask = doc.Reference(copy.copy(smask), mask_name)
+                embedded += len(smask.streamContent)
+        doc.Reference(img, reg_name)
+        c._image_bytes = c.__dict__.get("_image_bytes", 0) + embedded
+    # drawImage(path) would look the XObject up by a digest of the path; place it directly
+    x, y, width, height, _scaled = aspectRatioFix(preserveAspectRatio, "c", x, y, width, height,
+                                                  proto.width, proto.height)
+    c._currentPageHasImages = 1
+    c.saveState()
+    c.translate(x, y)
+    c.scale(width, height)
+    c._code.append(f"/{reg_name} Do")
+    c.restoreState()
+    c._formsinuse.append(proto.name)
+
+
+# ─── ASSET DRAW SIZES (points) ───────────────────────────────────
+HEADER_LOGO_SIZE = (35 * mm, 35 * mm)
+WATERMARK_SIZE = (180 * mm, 130 * mm)
+WATERMARK_POS = ((W - WATERMARK_SIZE[0]) / 2, (H - WATERMARK_SIZE[1]) / 2 - 15 * mm)
+WOOD_OVERLAY_ALPHA = 0.80
+FRAME_THICKNESS = 4 * mm  # enough to see carved wood detail
+GOLD_BAR_HEIGHT = 3 * mm
+TABLE_HEADER_SIZE = (W - 40 * mm, 7 * mm)
+
+# Largest size each asset is printed at, and whether its aspect ratio is kept
+ASSET_DRAW_SIZES = {
+    LOGO_HEADER: (HEADER_LOGO_SIZE, True),
+    LOGO_WATERMARK: (WATERMARK_SIZE, True),
+    WOOD_BG: ((W, H), False),
+    WOOD_BAR_TEXTURE: ((W, GOLD_BAR_HEIGHT), False),
+    WOOD_HEADER_TEXTURE: (TABLE_HEADER_SIZE, False),
+    FRAME_TOP: ((W, FRAME_THICKNESS), False),
+    FRAME_BOTTOM: ((W, FRAME_THICKNESS), False),
+    FRAME_LEFT: ((FRAME_THICKNESS, H), False),
+    FRAME_RIGHT: ((FRAME_THICKNESS, H), False),
+}
+# The same by asset name, for a RenderContext's own paths
+ASSET_SIZES = {name: ASSET_DRAW_SIZES[globals()[name]] for name in ASSET_NAMES}
+
+
+# ─── ASSET OPTIMISATION ──────────────────────────────────────────
+ASSET_VARIANT_DIR = os.path.join(tempfile.gettempdir(), "tatche-asset-variants")
+
+
+def _has_alpha(im):
+    """True if the image has transparency that is actually used"""
+    if im.mode == "P" and "transparency" in im.info:
+        im = im.convert("RGBA")
+    if im.mode not in ("RGBA", "LA"):
+        return False
+    return im.getchannel("A").getextrema()[0] < 255
+
+
+def _target_pixels(src_size, draw_size, keep_aspect, dpi):
+    """Pixel size needed to print draw_size (points) at dpi, never upscaling"""
+    src_w, src_h = src_size
+    want_w = max(1, round(draw_size[0] / 72 * dpi))
+    want_h = max(1, round(draw_size[1] / 72 * dpi))
+    if keep_aspect:
+        scale = min(want_w / src_w, want_h / src_h, 1.0)
+        return max(1, round(src_w * scale)), max(1, round(src_h * scale))
+    return min(want_w, src_w), min(want_h, src_h)
+
+
+def build_asset_variant(path, dpi=150, jpeg_quality=85, cache_dir=ASSET_VARIANT_DIR, draw=None):
+    """Resample one asset to its printed size (draw: its ASSET_DRAW_SIZES entry,
+    looked up by path when not given); returns the cached variant path"""
+    from PIL import Image
+
+    (draw_size, keep_aspect) = draw or ASSET_DRAW_SIZES[path]
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content + f"|{dpi}|{jpeg_quality}|{draw_size}".encode()).hexdigest()
+
+    im = Image.open(path)
+    alpha = _has_alpha(im)
+    ext = ".png" if alpha else ".jpg"
+    stem = os.path.splitext(os.path.basename(path))[0]
+    out = os.path.join(cache_dir, f"{stem}-{digest[:32]}{ext}")
+    if os.path.exists(out):
+        return out
+
+    os.makedirs(cache_dir, exist_ok=True)
+    size = _target_pixels(im.size, draw_size, keep_aspect, dpi)
+    im = im.convert("RGBA" if alpha else "RGB")
+    if size != im.size:
+        im = im.resize(size, Image.LANCZOS)
+    tmp = out + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    if alpha:
+        im.save(tmp, "PNG", optimize=True)  # embedded as Flate + soft mask
+    else:
+        im.save(tmp, "JPEG", quality=jpeg_quality, optimize=True)  # embedded as DCT
+    os.replace(tmp, out)
+    return out
+
+
+def optimise_assets(dpi=150, jpeg_quality=85, cache_dir=ASSET_VARIANT_DIR):
+    """Build (or reuse) print-size variants of every asset and switch the generator to them"""
+    variants = {}
+    for path in ASSET_DRAW_SIZES:
+        try:
+            variants[path] = build_asset_variant(path, dpi, jpeg_quality, cache_dir)
+        except OSError:
+            pass  # missing asset: draw helpers fall back as before
+    ASSETS.invalidate()
+    ASSETS.variants.update(variants)
+    return variants
+
+
+# ─── FLATTENED BACKGROUND ────────────────────────────────────────
+FLAT_BACKGROUND = None  # path of the pre-composited page background, when enabled
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_flat_background(dpi=150, watermark_opacity=0.06, cache_dir=ASSET_VARIANT_DIR, context=None):
+    """Flatten wood texture + white overlay + watermark (the context's, default
+    the module's) into one opaque JPEG"""
+    from PIL import Image
+
+    assets = (context or RenderContext()).assets
+    px_w, px_h = round(W / 72 * dpi), round(H / 72 * dpi)
+    key = hashlib.sha256(
+        f"{_file_digest(assets.WOOD_BG)}|{_file_digest(assets.LOGO_WATERMARK)}|{px_w}x{px_h}"
+        f"|{WOOD_OVERLAY_ALPHA}|{watermark_opacity}".encode()).hexdigest()
+    out = os.path.join(cache_dir, f"flat-bg-{key[:32]}.jpg")
+    if os.path.exists(out):
+        return out
+
+    # Wood stretched to the page, then the 80% white overlay
+    wood = Image.open(assets.WOOD_BG).convert("RGB").resize((px_w, px_h), Image.LANCZOS)
+    page = Image.blend(wood, Image.new("RGB", (px_w, px_h), "white"), WOOD_OVERLAY_ALPHA)
+
+    # Watermark fitted and centred in its box, as drawImage(preserveAspectRatio=True) does
+    logo = Image.open(assets.LOGO_WATERMARK).convert("RGBA")
+    box_w, box_h = WATERMARK_SIZE
+    scale = min(box_w / logo.width, box_h / logo.height)
+    draw_w, draw_h = logo.width * scale, logo.height * scale
+    x = WATERMARK_POS[0] + (box_w - draw_w) / 2
+    top = H - (WATERMARK_POS[1] + (box_h - draw_h) / 2 + draw_h)
+    logo = logo.resize((round(draw_w / 72 * dpi), round(draw_h / 72 * dpi)), Image.LANCZOS)
+    alpha = logo.getchannel("A").point(lambda v: round(v * watermark_opacity))
+    page.paste(logo.convert("RGB"), (round(x / 72 * dpi), round(top / 72 * dpi)), mask=alpha)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = out + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    page.save(tmp, "JPEG", quality=92, optimize=True)
+    os.replace(tmp, out)
+    return out
+
+
+def use_flat_background(dpi=150):
+    """Draw pages on a single pre-composited background (no transparency groups)"""
+    global FLAT_BACKGROUND
+    FLAT_BACKGROUND = build_flat_background(dpi) if dpi else None
+    return FLAT_BACKGROUND
+
+
+def check_flat_background(dpi=150, tolerance=8, max_bad_ratio=0.005):
+    """Raster-diff the layered and flattened backgrounds (needs PyMuPDF)"""
+    import pymupdf  # optional, only used for this check
+    from PIL import Image
+
+    def rasterise(flat):
+        c = new_canvas(context=RenderContext(flat_background=flat or False))
+        _underlay(c)
+        pix = pymupdf.open(stream=c.getpdfdata(), filetype="pdf")[0].get_pixmap(dpi=dpi)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+    from PIL import ImageChops
+    layered = rasterise(None)
+    flat = rasterise(build_flat_background(dpi))
+    hist = ImageChops.difference(layered, flat).convert("L").histogram()
+    total = sum(hist)
+    bad = sum(hist[tolerance + 1:])
+    mean = sum(i * n for i, n in enumerate(hist)) / total
+    ok = bad / total <= max_bad_ratio
+    print(f"mean diff {mean:.2f}/255, {bad / total:.3%} pixels over {tolerance} "
+          f"-> {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+# ─── OUTPUT PROFILES ────────────────────────────────────────────
+# Image resolution, JPEG quality and page compression per destination.
+# Text is set in the standard-14 Helvetica family, which every viewer and
+# printer supplies, so no profile has fonts to embed or subset.
+OUTPUT_PROFILES = {
+    "print": {"dpi": 300, "jpeg_quality": 92, "compress": True},
+    "screen": {"dpi": 150, "jpeg_quality": 80, "compress": True},
+    "email": {"dpi": 110, "jpeg_quality": 70, "compress": True, "max_bytes": 600 * 1024},
+}
+# What a custom settings dict leaves out (the build_asset_variant defaults)
+PROFILE_DEFAULTS = {"dpi": 150, "jpeg_quality": 85, "compress": True}
+# (dpi, JPEG quality) tried in order while a render is over its byte budget
+BUDGET_STEPS = ((150, 80), (110, 70), (96, 60), (84, 50), (72, 40), (60, 30), (48, 25))
+
+
+def resolve_profile(profile):
+    """Profile name or settings dict -> complete settings dict (a custom dict is
+    filled in from PROFILE_DEFAULTS); None keeps the original assets"""
+    if profile is None:
+        return None
+    if isinstance(profile, dict):
+        unknown = set(profile) - set(PROFILE_DEFAULTS) - {"max_bytes"}
+        if unknown:
+            raise ValueError(f"unknown output profile settings {', '.join(sorted(unknown))} "
+                             f"(expected dpi, jpeg_quality, compress, max_bytes)")
+        settings = {**PROFILE_DEFAULTS, **profile}
+        for name in ("dpi", "jpeg_quality"):
+            if not (_is_number(settings[name]) and settings[name] > 0):
+                raise ValueError(f"output profile {name} must be a positive number, not {settings[name]!r}")
+        return settings
+    try:
+        return OUTPUT_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"unknown output profile {profile!r} "
+                         f"(expected one of {', '.join(OUTPUT_PROFILES)})") from None
+
+
+@functools.lru_cache(maxsize=32)
+def _profile_variants(dpi, jpeg_quality, assets, fingerprint):
+    variants = {}
+    for name, path in assets._asdict().items():
+        try:
+            variants[path] = build_asset_variant(path, dpi, jpeg_quality, draw=ASSET_SIZES[name])
+        except OSError:
+            pass  # missing asset: draw helpers fall back as before
+    return variants
+
+
+def profile_variants(dpi, jpeg_quality, assets=None):
+    """Asset -> resampled variant map for one profile and set of asset paths
+    (default: the module's); rebuilt when an asset file changes"""
+    assets = assets or RenderContext().assets
+    return _profile_variants(dpi, jpeg_quality, assets, asset_fingerprint(assets))
+
+
+# ─── RENDER QUALITY ─────────────────────────────────────────────
+# "draft" (admin previews) draws every texture as flat colour or a vector
+# gradient and skips the frame and watermark; all geometry is unchanged, so
+# positions and page breaks match the final output
+QUALITIES = ("final", "draft")
+
+
+def is_draft(c):
+    return render_context(c).quality == "draft"
+
+
+@functools.lru_cache(maxsize=16)
+def _average_colour(path, mtime_ns):
+    from PIL import Image
+    from reportlab.lib.colors import Color
+
+    r, g, b = Image.open(path).convert("RGB").resize((1, 1), Image.BOX).getpixel((0, 0))
+    return Color(r / 255, g / 255, b / 255)
+
+
+def average_colour(path):
+    """Mean colour of an asset (draft stand-in for its texture)"""
+    return _average_colour(path, os.stat(path).st_mtime_ns)
+
+
+DRAFT_LOGO_DPI = 72
+
+
+@functools.lru_cache(maxsize=16)
+def _draft_variant(path, mtime_ns):
+    return build_asset_variant(path, DRAFT_LOGO_DPI, draw=ASSET_SIZES["LOGO_HEADER"])
+
+
+def draft_asset(path):
+    """Screen-resolution variant of an asset, for the images a draft still draws"""
+    return _draft_variant(path, os.stat(path).st_mtime_ns)
 
 
 def _draw_wood_header_bg(c, x, y, width, height):
     """Draw wood texture clipped to a rectangular area (for badges, table headers)"""
+    context = render_context(c)
+    theme, assets = context.theme, context.assets
+    if is_draft(c):
+        c.saveState()
+        c.setFillColor(average_colour(assets.WOOD_HEADER_TEXTURE))
+        c.rect(x, y, width, height, fill=1, stroke=0)
+        c.restoreState()
+        return
     try:
         c.saveState()
         p = c.beginPath()
         p.rect(x, y, width, height)
         c.clipPath(p, stroke=0)
-        c.drawImage(WOOD_HEADER_TEXTURE, x, y, width=width, height=height, preserveAspectRatio=False)
+        draw_asset(c, assets.WOOD_HEADER_TEXTURE, x, y, width=width, height=height, preserveAspectRatio=False)
         c.restoreState()
     except:
         # Fallback brown
         c.saveState()
-        c.setFillColor(BROWN_DARK)
+        c.setFillColor(theme.BROWN_DARK)
         c.rect(x, y, width, height, fill=1, stroke=0)
         c.restoreState()
 
 
 def draw_gold_gradient_bar(c, x, y, width, height):
     """Draw a wood texture bar instead of gold gradient"""
+    context = render_context(c)
+    theme, assets = context.theme, context.assets
+    if is_draft(c):
+        c.saveState()
+        p = c.beginPath()
+        p.rect(x, y, width, height)
+        c.clipPath(p, stroke=0)
+        c.linearGradient(x, y, x + width, y, (theme.GOLD_DARK, theme.GOLD_LIGHT), extend=False)
+        c.restoreState()
+        return
     try:
         c.saveState()
         c.clipPath(c.beginPath())  # reset
@@ -88,54 +745,67 @@ def draw_gold_gradient_bar(c, x, y, width, height):
         p = c.beginPath()
         p.rect(x, y, width, height)
         c.clipPath(p, stroke=0)
-        c.drawImage(WOOD_BAR_TEXTURE, x, y, width=width, height=height, preserveAspectRatio=False)
+        draw_asset(c, assets.WOOD_BAR_TEXTURE, x, y, width=width, height=height, preserveAspectRatio=False)
         c.restoreState()
     except:
         # Fallback to gold gradient
+        from reportlab.lib.colors import Color, toColor
+
         c.saveState()
         steps = 60
         step_w = width / steps
         for i in range(steps):
             ratio = i / steps
-            r = GOLD_DARK.red + (GOLD_LIGHT.red - GOLD_DARK.red) * ratio
-            g = GOLD_DARK.green + (GOLD_LIGHT.green - GOLD_DARK.green) * ratio
-            b = GOLD_DARK.blue + (GOLD_LIGHT.blue - GOLD_DARK.blue) * ratio
+            dark, light = toColor(theme.GOLD_DARK), toColor(theme.GOLD_LIGHT)
+            r = dark.red + (light.red - dark.red) * ratio
+            g = dark.green + (light.green - dark.green) * ratio
+            b = dark.blue + (light.blue - dark.blue) * ratio
             c.setFillColor(Color(r, g, b))
             c.rect(x + i * step_w, y, step_w + 0.5, height, fill=1, stroke=0)
         c.restoreState()
 
 
-def draw_decorative_border(c, x, y, width, height, color=GOLD):
-    """Draw a thin decorative double-line border"""
-    c.setStrokeColor(color)
+def draw_decorative_border(c, x, y, width, height, color=None):
+    """Draw a thin decorative double-line border (default: the theme's gold)"""
+    c.setStrokeColor(color or render_context(c).theme.GOLD)
     c.setLineWidth(1.5)
     c.rect(x, y, width, height, fill=0, stroke=1)
     c.setLineWidth(0.5)
     c.rect(x + 2, y + 2, width - 4, height - 4, fill=0, stroke=1)
 
 
+@stage
 def draw_wood_background(c):
     """Draw wood texture as full page background with subtle opacity"""
+    from reportlab.lib.colors import Color
+
+    assets = render_context(c).assets
+    if is_draft(c):
+        # Mean wood colour already mixed with the white overlay: one opaque fill
+        wood, a = average_colour(assets.WOOD_BG), WOOD_OVERLAY_ALPHA
+        c.setFillColor(Color(*(v * (1 - a) + a for v in (wood.red, wood.green, wood.blue))))
+        c.rect(0, 0, W, H, fill=1, stroke=0)
+        return
     try:
         c.saveState()
-        c.drawImage(WOOD_BG, 0, 0, width=W, height=H, preserveAspectRatio=False)
+        draw_asset(c, assets.WOOD_BG, 0, 0, width=W, height=H, preserveAspectRatio=False)
         # Semi-transparent white overlay so content is readable
-        c.setFillColor(Color(1, 1, 1, alpha=0.80))
+        c.setFillColor(Color(1, 1, 1, alpha=WOOD_OVERLAY_ALPHA))
         c.rect(0, 0, W, H, fill=1, stroke=0)
         c.restoreState()
     except:
         pass
 
 
+@stage
 def draw_center_watermark(c, opacity=0.06):
     """Draw centered logo watermark - big, subtle, professional"""
+    assets = render_context(c).assets
     try:
-        center_logo = ImageReader(LOGO_WATERMARK)
-        logo_w = 180 * mm
-        logo_h = 130 * mm
+        logo_w, logo_h = WATERMARK_SIZE
         c.saveState()
         c.setFillAlpha(opacity)
-        c.drawImage(center_logo, (W - logo_w) / 2, (H - logo_h) / 2 - 15 * mm,
+        draw_asset(c, assets.LOGO_WATERMARK, *WATERMARK_POS,
                      width=logo_w, height=logo_h,
                      preserveAspectRatio=True, mask='auto')
         c.restoreState()
@@ -143,40 +813,40 @@ def draw_center_watermark(c, opacity=0.06):
         pass
 
 
+@stage
 def draw_border_frame(c):
     """Draw ornate carved wood frame border - thin but with visible wood sculpture"""
+    assets = render_context(c).assets
     try:
-        t = 4 * mm  # enough to see carved wood detail
+        t = FRAME_THICKNESS
         
         # Top strip
         c.saveState()
-        top_img = ImageReader("/home/claude/frame_top.png")
-        c.drawImage(top_img, 0, H - t, width=W, height=t, preserveAspectRatio=False, mask='auto')
+        draw_asset(c, assets.FRAME_TOP, 0, H - t, width=W, height=t, preserveAspectRatio=False, mask='auto')
         c.restoreState()
         
         # Bottom strip
         c.saveState()
-        bottom_img = ImageReader("/home/claude/frame_bottom.png")
-        c.drawImage(bottom_img, 0, 0, width=W, height=t, preserveAspectRatio=False, mask='auto')
+        draw_asset(c, assets.FRAME_BOTTOM, 0, 0, width=W, height=t, preserveAspectRatio=False, mask='auto')
         c.restoreState()
         
         # Left strip
         c.saveState()
-        left_img = ImageReader("/home/claude/frame_left.png")
-        c.drawImage(left_img, 0, 0, width=t, height=H, preserveAspectRatio=False, mask='auto')
+        draw_asset(c, assets.FRAME_LEFT, 0, 0, width=t, height=H, preserveAspectRatio=False, mask='auto')
         c.restoreState()
         
         # Right strip
         c.saveState()
-        right_img = ImageReader("/home/claude/frame_right.png")
-        c.drawImage(right_img, W - t, 0, width=t, height=H, preserveAspectRatio=False, mask='auto')
+        draw_asset(c, assets.FRAME_RIGHT, W - t, 0, width=t, height=H, preserveAspectRatio=False, mask='auto')
         c.restoreState()
     except:
         pass
 
 
-def draw_header(c, doc_type="", doc_number="", doc_date=""):
-    """Draw the professional header with logo and company info"""
+def _header(c):
+    context = render_context(c)
+    theme, company, assets = context.theme, context.company, context.assets
+    # Logo, company block and gold separator: the part of the header every page shares
     margin = 25 * mm
 
     # ── Header background area (no top bar) ──
@@ -186,11 +856,10 @@ def draw_header(c, doc_type="", doc_number="", doc_date=""):
 
     # ── Logo (left side) - drawn at FULL opacity ──
     try:
-        logo = ImageReader(LOGO_HEADER)
-        logo_w = 35 * mm
-        logo_h = 35 * mm
+        logo_w, logo_h = HEADER_LOGO_SIZE
         c.saveState()
-        c.drawImage(logo, 5 * mm, header_bottom + 5 * mm, 
+        logo = draft_asset(assets.LOGO_HEADER) if is_draft(c) else assets.LOGO_HEADER
+        draw_asset(c, logo, 5 * mm, header_bottom + 5 * mm,
                      width=logo_w, height=logo_h, 
                      preserveAspectRatio=True, mask='auto')
         c.restoreState()
@@ -202,35 +871,49 @@ def draw_header(c, doc_type="", doc_number="", doc_date=""):
     name_y = header_top - 12 * mm
 
     # Company name
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.setFont("Helvetica-Bold", 22)
-    c.drawString(text_x, name_y, "LE TATCHE BOIS")
+    c.drawString(text_x, name_y, company["name"])
 
     # Type + Activity on same line
     c.setFont("Helvetica-Bold", 10)
-    c.setFillColor(GOLD_DARK)
-    type_text = COMPANY["type"]
+    c.setFillColor(theme.GOLD_DARK)
+    type_text = company["type"]
     c.drawString(text_x, name_y - 15, type_text)
     type_w = c.stringWidth(type_text, "Helvetica-Bold", 10)
     c.setFont("Helvetica", 8)
-    c.setFillColor(BROWN_MEDIUM)
-    c.drawString(text_x + type_w + 5, name_y - 15, f"•  {COMPANY['activity']}")
+    c.setFillColor(theme.BROWN_MEDIUM)
+    c.drawString(text_x + type_w + 5, name_y - 15, f"•  {company['activity']}")
 
     # Contact info below
     c.setFont("Helvetica", 8.5)
-    c.setFillColor(GRAY_DARK)
-    c.drawString(text_x, name_y - 30, f"Tél : {COMPANY['tel1']}  /  {COMPANY['tel2']}")
-    c.drawString(text_x, name_y - 41, f"Email : {COMPANY['email']}")
+    c.setFillColor(theme.GRAY_DARK)
+    c.drawString(text_x, name_y - 30, f"Tél : {company['tel1']}  /  {company['tel2']}")
+    c.drawString(text_x, name_y - 41, f"Email : {company['email']}")
 
     # ── Address (right aligned) ──
     right_x = W - margin
     c.setFont("Helvetica", 9)
-    c.setFillColor(GRAY_DARK)
-    c.drawRightString(right_x, name_y - 30, COMPANY["address"])
-    c.drawRightString(right_x, name_y - 41, COMPANY["city"])
+    c.setFillColor(theme.GRAY_DARK)
+    c.drawRightString(right_x, name_y - 30, company["address"])
+    c.drawRightString(right_x, name_y - 41, company["city"])
 
     # ── Bottom gold gradient line (separator) ──
-    draw_gold_gradient_bar(c, 0, header_bottom + 1 * mm, W, 3 * mm)
+    draw_gold_gradient_bar(c, 0, header_bottom + 1 * mm, W, GOLD_BAR_HEIGHT)
+
+
+@stage
+def draw_header(c, doc_type="", doc_number="", doc_date=""):
+    """Draw the professional header with logo and company info"""
+    theme = render_context(c).theme
+    margin = 25 * mm
+    header_bottom = H - 50 * mm
+
+    if render_context(c).overlay:
+        # Shared with every page: a letterhead layer (see LETTERHEAD OVERLAY)
+        _draw_static_layer(c, "TatchePageHeader", _header)
+    else:
+        _header(c)
 
     # ── Document type title (if specified) ──
     if doc_type:
@@ -248,14 +931,14 @@ def draw_header(c, doc_type="", doc_number="", doc_date=""):
         # All elements start at same left X
         left_x = margin
 
-        c.setFillColor(BROWN_DARK)
+        c.setFillColor(theme.BROWN_DARK)
         c.setFont("Helvetica-Bold", font_size)
         c.drawString(left_x, title_y, title_text)
 
         # Date - same left_x start, bold
         date_y = title_y - 16
         c.setFont("Helvetica-Bold", 10)
-        c.setFillColor(BROWN_DARK)
+        c.setFillColor(theme.BROWN_DARK)
         if doc_date:
             c.drawString(left_x, date_y, f"Date :  {doc_date}")
 
@@ -265,13 +948,18 @@ def draw_header(c, doc_type="", doc_number="", doc_date=""):
     return (header_bottom - 10 * mm, header_bottom - 20 * mm, margin)
 
 
+@stage
 def draw_footer(c):
     """Draw the professional footer with legal info"""
+    from reportlab.lib.colors import Color
+
+    context = render_context(c)
+    theme, company = context.theme, context.company
     margin = 25 * mm
     footer_top = 22 * mm
 
     # ── Gold gradient bar (separator at top of footer) ──
-    draw_gold_gradient_bar(c, 0, footer_top, W, 3 * mm)
+    draw_gold_gradient_bar(c, 0, footer_top, W, GOLD_BAR_HEIGHT)
 
     # ── Footer background ──
     c.setFillColor(Color(1, 0.98, 0.95, alpha=0.6))
@@ -280,16 +968,16 @@ def draw_footer(c):
     # ── Legal identifiers ──
     y = footer_top - 5 * mm
     c.setFont("Helvetica", 7.5)
-    c.setFillColor(GRAY_DARK)
-    c.drawCentredString(W / 2, y, f"{COMPANY['address']} - {COMPANY['city']}")
+    c.setFillColor(theme.GRAY_DARK)
+    c.drawCentredString(W / 2, y, f"{company['address']} - {company['city']}")
 
     # Line 2: Legal identifiers with bold labels
     y -= 8
     items = [
-        ("RC : ", COMPANY["rc"]),
-        ("  |  IF : ", COMPANY["if_num"]),
-        ("  |  ICE : ", COMPANY["ice"]),
-        ("  |  PAT : ", COMPANY["pat"]),
+        ("RC : ", company["rc"]),
+        ("  |  IF : ", company["if_num"]),
+        ("  |  ICE : ", company["ice"]),
+        ("  |  PAT : ", company["pat"]),
     ]
     
     # Calculate total width
@@ -301,27 +989,90 @@ def draw_footer(c):
     x_pos = (W - total_w) / 2
     for label, value in items:
         c.setFont("Helvetica-Bold", 7)
-        c.setFillColor(BROWN_DARK)
+        c.setFillColor(theme.BROWN_DARK)
         c.drawString(x_pos, y, label)
         x_pos += c.stringWidth(label, "Helvetica-Bold", 7)
         c.setFont("Helvetica", 7)
-        c.setFillColor(GRAY_DARK)
+        c.setFillColor(theme.GRAY_DARK)
         c.drawString(x_pos, y, value)
         x_pos += c.stringWidth(value, "Helvetica", 7)
 
     # Line 3: Contact
     y -= 8
     c.setFont("Helvetica", 7)
-    c.setFillColor(GRAY_DARK)
-    c.drawCentredString(W / 2, y, f"Email : {COMPANY['email']}  |  contact@letatchebois.com  |  Tél : {COMPANY['tel1']} / {COMPANY['tel2']}")
+    c.setFillColor(theme.GRAY_DARK)
+    c.drawCentredString(W / 2, y, f"Email : {company['email']}  |  contact@letatchebois.com  |  Tél : {company['tel1']} / {company['tel2']}")
     y -= 8
     c.setFont("Helvetica-Bold", 7)
-    c.setFillColor(GOLD_DARK)
+    c.setFillColor(theme.GOLD_DARK)
     c.drawCentredString(W / 2, y, "www.letatchebois.com")
 
 
+# ─── STATIC PAGE LAYERS ─────────────────────────────────────────
+def _draw_static_layer(c, name, draw):
+    """Record a page layer as a form XObject once per canvas, then reference it"""
+    from reportlab.pdfbase import pdfdoc
+
+    layers = c.__dict__.setdefault("_static_layers", set())
+    if name not in layers:
+        c.beginForm(name)
+        # In overlay mode the form stays empty: overlay_letterhead swaps in the
+        # cached letterhead's copy when the document is saved
+        if not render_context(c).overlay:
+            draw(c)
+        shading = dict(c._shadingUsed)  # endForm drops the form's own shadings
+        c.endForm()
+        # ReportLab forms only list fonts and XObjects as resources; add the
+        # ExtGState entries so the alpha overlays resolve inside the form, and
+        # the shadings used by draft gradients
+        form = c._doc.idToObject[c._doc.getXObjectName(name)]
+        resources = pdfdoc.PDFResourceDictionary(ExtGState=form.ExtGState or {})
+        resources.basicFonts()
+        resources.allProcs()
+        resources.XObject = form.XObjects or {}
+        resources.setShading(shading)
+        form.Resources = resources
+        layers.add(name)
+    c.doForm(name)
+
+
+def _underlay(c):
+    if is_draft(c):
+        draw_wood_background(c)
+        return
+    flat_background = render_context(c).flat_background
+    if flat_background:
+        try:
+            draw_asset(c, flat_background, 0, 0, width=W, height=H, preserveAspectRatio=False)
+            return
+        except:
+            pass
+    draw_wood_background(c)
+    draw_center_watermark(c, opacity=0.06)
+
+
+def _overlay(c):
+    draw_footer(c)
+    if not is_draft(c):
+        draw_border_frame(c)
+
+
+@stage
+def draw_page_underlay(c):
+    """Wood background + centered watermark, drawn under the page content"""
+    _draw_static_layer(c, "TatchePageUnderlay", _underlay)
+
+
+@stage
+def draw_page_overlay(c):
+    """Footer + carved frame, drawn over the page content"""
+    _draw_static_layer(c, "TatchePageOverlay", _overlay)
+
+
+@stage
 def draw_client_box(c, y_start, client_info, is_facture=True):
     """Draw client information box - clean style, compact"""
+    theme = render_context(c).theme
     margin = 20 * mm
     box_w = 75 * mm
     box_x = W - margin - box_w
@@ -329,12 +1080,12 @@ def draw_client_box(c, y_start, client_info, is_facture=True):
     box_y = y_start - box_h
 
     # Box border only - clear background
-    c.setStrokeColor(GOLD)
+    c.setStrokeColor(theme.GOLD)
     c.setLineWidth(0.8)
     c.rect(box_x, box_y, box_w, box_h, fill=0, stroke=1)
 
     # "Client :" label
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.setFont("Helvetica-Bold", 8.5)
     c.drawString(box_x + 3 * mm, box_y + box_h - 5 * mm, "Client :")
 
@@ -342,11 +1093,11 @@ def draw_client_box(c, y_start, client_info, is_facture=True):
     text_x = box_x + 3 * mm
     text_y = box_y + box_h - 12 * mm
     c.setFont("Helvetica-Bold", 8.5)
-    c.setFillColor(BLACK)
+    c.setFillColor(theme.BLACK)
     c.drawString(text_x, text_y, client_info.get("name", "[Nom du client]"))
 
     c.setFont("Helvetica", 8)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     text_y -= 11
     c.drawString(text_x, text_y, client_info.get("address", "[Adresse du client]"))
     text_y -= 10
@@ -355,7 +1106,7 @@ def draw_client_box(c, y_start, client_info, is_facture=True):
     if client_info.get("ice"):
         text_y -= 10
         c.setFont("Helvetica-Bold", 7.5)
-        c.setFillColor(BROWN_DARK)
+        c.setFillColor(theme.BROWN_DARK)
         c.drawString(text_x, text_y, f"ICE : {client_info['ice']}")
 
     return box_y
@@ -430,183 +1181,280 @@ def amount_in_french(amount):
     return f"{words} Dirhams ; {cents_str} Cts TTC"
 
 
-def draw_items_table(c, y_start, items, tva_rate=0.20, show_tva=True):
-    """Draw the items table - compact, clear headers, handles 15-20+ items with page overflow"""
-    margin = 20 * mm
-    table_w = W - 2 * margin
-    footer_limit = 28 * mm  # Don't draw below this
-
-    # Table headers - matching old invoice style
-    headers = ["N°", "DÉSIGNATION", "U", "QTÉ", "P.U. HT", "TOTAL HT"]
-    col_widths = [8 * mm, table_w - 68 * mm, 10 * mm, 12 * mm, 19 * mm, 19 * mm]
-
-    # Build table data
-    table_data = [headers]
-    subtotal = 0
-    for i, item in enumerate(items):
-        total = item["qty"] * item["price"]
-        subtotal += total
-        row = [
-            str(i + 1),
-            item["desc"],
-            item.get("unit", "U"),
-            str(item["qty"]),
-            f"{item['price']:,.2f}",
-            f"{total:,.2f}",
-        ]
-        table_data.append(row)
-
-    # Row height: compact (header 7mm, data 5.5mm)
-    header_row_h = 7 * mm
-    data_row_h = 5.5 * mm
-
-    row_heights = [header_row_h] + [data_row_h] * (len(table_data) - 1)
-
-    # Create table
-    table = Table(table_data, colWidths=col_widths, rowHeights=row_heights)
-
-    # Style - clear, bold, centered headers
-    style = TableStyle([
-        # Header row - TRANSPARENT bg (wood texture drawn separately), WHITE text
-        ('BACKGROUND', (0, 0), (-1, 0), Color(0, 0, 0, alpha=0)),  # transparent
-        ('TEXTCOLOR', (0, 0), (-1, 0), WHITE),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 9),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, 0), 2),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 2),
-
-        # Data rows - compact
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 7.5),
-        ('TEXTCOLOR', (0, 1), (-1, -1), BROWN_DARK),
-        ('TOPPADDING', (0, 1), (-1, -1), 1.5),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 1.5),
-
-        # Alignment
-        ('ALIGN', (0, 1), (0, -1), 'CENTER'),  # N°
-        ('ALIGN', (2, 1), (3, -1), 'CENTER'),   # U + Qté
-        ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),   # Prices
-
-        # Grid
-        ('GRID', (0, 0), (-1, -1), 0.4, GOLD),
-        ('LINEBELOW', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-        ('LINEABOVE', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-    ])
-
-    # Alternating rows - transparent
-    for i in range(1, len(table_data)):
-        if i % 2 == 0:
-            style.add('BACKGROUND', (0, i), (-1, i), Color(0.98, 0.96, 0.92, alpha=0.35))
-        else:
-            style.add('BACKGROUND', (0, i), (-1, i), Color(1, 1, 1, alpha=0.35))
-
-    table.setStyle(style)
-
-    # Calculate table height
-    table_height = sum(row_heights)
-    table.wrap(table_w, H)  # Initialize internal attributes
-    table_y = y_start - table_height
-
-    # Check if table overflows into footer zone
-    if table_y < footer_limit + 45 * mm:  # Need space for totals + payment + signature
-        # Split: draw what fits on page 1, continue on page 2
-        available_h = y_start - footer_limit - 45 * mm
-        rows_that_fit = max(1, int(available_h / data_row_h))
-
-        # Page 1 table - draw wood texture behind header
-        p1_data = table_data[:1 + rows_that_fit]
-        p1_heights = row_heights[:1 + rows_that_fit]
-        p1_table = Table(p1_data, colWidths=col_widths, rowHeights=p1_heights)
-        p1_style = TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), Color(0, 0, 0, alpha=0)),
-            ('TEXTCOLOR', (0, 0), (-1, 0), WHITE),
+# ─── TEXT MEASUREMENT ───────────────────────────────────────────
+@functools.lru_cache(maxsize=65536)
+def string_width(text, font, size):
+    """Memoized pdfmetrics.stringWidth, keyed by (text, font, size)"""
+    from reportlab.pdfbase import pdfmetrics
+
+    return pdfmetrics.stringWidth(text, font, size)
+
+
+def _split_long_word(word, font, size, width):
+    """Hard-break a word that is wider than the column"""
+    parts, part, part_w = [], "", 0
+    for ch in word:
+        ch_w = string_width(ch, font, size)
+        if part and part_w + ch_w > width:
+            parts.append(part)
+            part, part_w = "", 0
+        part += ch
+        part_w += ch_w
+    parts.append(part)
+    return parts
+
+
+@functools.lru_cache(maxsize=16384)
+def wrap_text(text, font, size, width):
+    """Greedy word wrap of text into lines no wider than width (tuple of lines)"""
+    space_w = string_width(" ", font, size)
+    lines = []
+    for paragraph in text.split("\n"):
+        line, line_w = [], 0
+        for word in paragraph.split():
+            word_w = string_width(word, font, size)
+            if word_w > width:
+                *full, word = _split_long_word(word, font, size, width)
+                for part in full:
+                    if line:
+                        lines.append(" ".join(line))
+                    line, line_w = [], 0
+                    lines.append(part)
+                word_w = string_width(word, font, size)
+            if line and line_w + space_w + word_w > width:
+                lines.append(" ".join(line))
+                line, line_w = [word], word_w
+            else:
+                line_w += (space_w if line else 0) + word_w
+                line.append(word)
+        lines.append(" ".join(line))
+    return tuple(lines)
+
+
+ITEMS_TABLE_HEADERS = ["N°", "DÉSIGNATION", "U", "QTÉ", "P.U. HT", "TOTAL HT"]
+TABLE_ROW_LEADING = 12  # ReportLab's cell default; the table style never overrides it
+TABLE_CELL_PADDING = 6  # default LEFT/RIGHTPADDING of table cells
+TABLE_FOOTER_LIMIT = 28 * mm  # Don't draw below this
+TABLE_CLOSING_RESERVE = 45 * mm  # Space kept for totals + payment + signature
+TABLE_CARRY_ROW_H = 5.5 * mm  # "Report" / "À reporter" subtotal lines
+CONTINUATION_TABLE_TOP = H - 55 * mm
+
+
+# ─── TABLE STYLES ───────────────────────────────────────────────
+# One immutable command list per table kind; striping is a single ROWBACKGROUNDS
+# rule, so the same compiled style fits any number of rows, pages and documents
+@functools.lru_cache(maxsize=64)
+def table_style(kind, theme):
+    """Compiled TableStyle for a table kind in a Theme, built once per process
+    and theme (never .add() to it)"""
+    from reportlab.lib.colors import Color, toColor
+    from reportlab.platypus import TableStyle
+
+    commands = {
+        "priced_items": (
+            # Header row - TRANSPARENT bg (wood texture drawn separately), WHITE text
+            ('BACKGROUND', (0, 0), (-1, 0), Color(0, 0, 0, alpha=0)),  # transparent
+            ('TEXTCOLOR', (0, 0), (-1, 0), theme.WHITE),
             ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
             ('FONTSIZE', (0, 0), (-1, 0), 9),
             ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
             ('TOPPADDING', (0, 0), (-1, 0), 2),
             ('BOTTOMPADDING', (0, 0), (-1, 0), 2),
+
+            # Data rows - compact, alternating transparent stripes
             ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
             ('FONTSIZE', (0, 1), (-1, -1), 7.5),
-            ('TEXTCOLOR', (0, 1), (-1, -1), BROWN_DARK),
+            ('TEXTCOLOR', (0, 1), (-1, -1), theme.BROWN_DARK),
             ('TOPPADDING', (0, 1), (-1, -1), 1.5),
             ('BOTTOMPADDING', (0, 1), (-1, -1), 1.5),
-            ('ALIGN', (0, 1), (0, -1), 'CENTER'),
-            ('ALIGN', (2, 1), (3, -1), 'CENTER'),  # U + Qté
-            ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),  # Prices
-            ('GRID', (0, 0), (-1, -1), 0.4, GOLD),
-            ('LINEBELOW', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-            ('LINEABOVE', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-        ])
-        for i in range(1, len(p1_data)):
-            if i % 2 == 0:
-                p1_style.add('BACKGROUND', (0, i), (-1, i), Color(0.98, 0.96, 0.92, alpha=0.35))
-            else:
-                p1_style.add('BACKGROUND', (0, i), (-1, i), Color(1, 1, 1, alpha=0.35))
-        p1_table.setStyle(p1_style)
-        p1_h = sum(p1_heights)
-        # Draw wood texture behind header row
-        _draw_wood_header_bg(c, margin, y_start - header_row_h, table_w, header_row_h)
-        p1_table.wrap(table_w, H)
-        p1_table.drawOn(c, margin, y_start - p1_h)
-
-        # "Suite page suivante" mention
-        c.setFont("Helvetica-Oblique", 7)
-        c.setFillColor(GRAY)
-        c.drawRightString(W - margin, y_start - p1_h - 4 * mm, ">>> Suite page suivante")
-
-        draw_footer(c)
-        draw_border_frame(c)
-        c.showPage()
-
-        # Page 2
-        draw_wood_background(c)
-        draw_header(c)
-        draw_center_watermark(c, opacity=0.06)
-        p2_start = H - 55 * mm
-
-        p2_data = [headers] + table_data[1 + rows_that_fit:]
-        p2_heights = [header_row_h] + [data_row_h] * (len(p2_data) - 1)
-        p2_table = Table(p2_data, colWidths=col_widths, rowHeights=p2_heights)
-        p2_style = TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), Color(0, 0, 0, alpha=0)),
-            ('TEXTCOLOR', (0, 0), (-1, 0), WHITE),
+            ('ROWBACKGROUNDS', (0, 1), (-1, -1),
+             [Color(1, 1, 1, alpha=0.35), Color(0.98, 0.96, 0.92, alpha=0.35)]),
+
+            # Alignment
+            ('ALIGN', (0, 1), (0, -1), 'CENTER'),  # N°
+            ('ALIGN', (2, 1), (3, -1), 'CENTER'),   # U + Qté
+            ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),   # Prices
+
+            # Grid
+            ('GRID', (0, 0), (-1, -1), 0.4, theme.GOLD),
+            ('LINEBELOW', (0, 0), (-1, 0), 1.5, theme.GOLD_DARK),
+            ('LINEABOVE', (0, 0), (-1, 0), 1.5, theme.GOLD_DARK),
+        ),
+        "delivery_items": (
+            ('BACKGROUND', (0, 0), (-1, 0), theme.BROWN_DARK),
+            ('TEXTCOLOR', (0, 0), (-1, 0), theme.GOLD_LIGHT),
             ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 9),
+            ('FONTSIZE', (0, 0), (-1, 0), 8.5),
             ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('TOPPADDING', (0, 0), (-1, 0), 2),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 2),
+            ('TOPPADDING', (0, 0), (-1, -1), 4),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
             ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -1), 7.5),
-            ('TEXTCOLOR', (0, 1), (-1, -1), BROWN_DARK),
-            ('TOPPADDING', (0, 1), (-1, -1), 1.5),
-            ('BOTTOMPADDING', (0, 1), (-1, -1), 1.5),
+            ('FONTSIZE', (0, 1), (-1, -1), 8),
+            ('TEXTCOLOR', (0, 1), (-1, -1), theme.GRAY_DARK),
+            ('ROWBACKGROUNDS', (0, 1), (-1, -1),
+             [Color(1, 1, 1, alpha=0.4), Color(0.98, 0.96, 0.92, alpha=0.4)]),
             ('ALIGN', (0, 1), (0, -1), 'CENTER'),
             ('ALIGN', (2, 1), (3, -1), 'CENTER'),  # U + Qté
-            ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),  # Prices
-            ('GRID', (0, 0), (-1, -1), 0.4, GOLD),
-            ('LINEBELOW', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-            ('LINEABOVE', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-        ])
-        for i in range(1, len(p2_data)):
-            if i % 2 == 0:
-                p2_style.add('BACKGROUND', (0, i), (-1, i), Color(0.98, 0.96, 0.92, alpha=0.35))
-            else:
-                p2_style.add('BACKGROUND', (0, i), (-1, i), Color(1, 1, 1, alpha=0.35))
-        p2_table.setStyle(p2_style)
-        p2_h = sum(p2_heights)
-        # Draw wood texture behind page 2 header row
-        _draw_wood_header_bg(c, margin, p2_start - header_row_h, table_w, header_row_h)
-        p2_table.wrap(table_w, H)
-        p2_table.drawOn(c, margin, p2_start - p2_h)
-        table_y = p2_start - p2_h
-    else:
+            ('GRID', (0, 0), (-1, -1), 0.5, theme.GOLD),
+            ('LINEBELOW', (0, 0), (-1, 0), 1.5, theme.GOLD_DARK),
+        ),
+    }
+    # Resolve the hex colours once: Table would parse them again for every cell
+    return TableStyle([tuple(toColor(v) if isinstance(v, str) and v.startswith("#") else v for v in command)
+                       for command in commands[kind]])
+
+
+def iter_pages(rows, first_avail, next_avail, height=lambda row: row,
+               carry_h=TABLE_CARRY_ROW_H, closing_h=TABLE_CLOSING_RESERVE):
+    """Pack data rows into pages in a single streaming pass.
+
+    first_avail / next_avail are the heights available for data rows on the first
+    and continuation pages. Non-final pages keep room for the "À reporter" line,
+    continuation pages for the "Report" line, and the final page for the closing
+    block. Yields (rows, is_last) per page; only the page being filled is held,
+    so rows may come from a generator of any length.
+    """
+    page = []
+    used = 0
+    avail = first_avail  # room for rows + closing block on the current page
+    for row in rows:
+        h = height(row)
+        if used + h + carry_h > avail and page:
+            yield page, False
+            page, used = [], 0
+            avail = next_avail - carry_h
+        page.append(row)
+        used += h
+
+    # Keep the closing block with the last rows: if it doesn't fit, carry the
+    # last row over so the totals never sit alone at the top of a page. A row
+    # alone on its page stays there - moving it would leave an empty page.
+    if used + closing_h > avail and len(page) > 1:
+        yield page[:-1], False
+        page = page[-1:]
+    yield page, True
+
+
+def paginate_rows(row_heights, first_avail, next_avail, carry_h=TABLE_CARRY_ROW_H,
+                  closing_h=TABLE_CLOSING_RESERVE):
+    """(start, end) row ranges per page for a list of row heights (see iter_pages)"""
+    pages = []
+    start = 0
+    for page, _last in iter_pages(row_heights, first_avail, next_avail,
+                                  carry_h=carry_h, closing_h=closing_h):
+        pages.append((start, start + len(page)))
+        start += len(page)
+    return pages
+
+
+def _draw_carry_line(c, x, y, width, col_widths, label, amount, note=""):
+    """Draw a "Report" / "À reporter" subtotal line spanning the table width"""
+    from reportlab.lib.colors import Color
+
+    theme = render_context(c).theme
+    c.saveState()
+    c.setFillColor(Color(0.98, 0.96, 0.92, alpha=0.6))
+    c.setStrokeColor(theme.GOLD)
+    c.setLineWidth(0.4)
+    c.rect(x, y, width, TABLE_CARRY_ROW_H, fill=1, stroke=1)
+    c.setFont("Helvetica-Bold", 7.5)
+    c.setFillColor(theme.BROWN_DARK)
+    text_y = y + (TABLE_CARRY_ROW_H - 7.5) / 2 + 1.5
+    c.drawRightString(x + width - col_widths[-1] - 2, text_y, label)
+    c.drawRightString(x + width - 2, text_y, f"{amount:,.2f}")
+    if note:
+        c.setFont("Helvetica-Oblique", 7)
+        c.setFillColor(theme.GRAY)
+        c.drawString(x + 2 * mm, text_y, note)
+    c.restoreState()
+
+
+@stage
+def draw_items_table(c, y_start, items, tva_rate=0.20, show_tva=True):
+    """Draw the items table - compact, clear headers, spills over as many pages as needed.
+
+    items may be any iterable, including a generator streaming lines from a file
+    or a database cursor; it is consumed once, page by page.
+    """
+    from reportlab.lib.colors import Color
+    from reportlab.platypus import Table
+
+    theme = render_context(c).theme
+    margin = 20 * mm
+    table_w = W - 2 * margin
+
+    # Table headers - matching old invoice style
+    headers = ITEMS_TABLE_HEADERS
+    col_widths = [8 * mm, table_w - 68 * mm, 10 * mm, 12 * mm, 19 * mm, 19 * mm]
+
+    # Row height: compact (header 7mm, data 5.5mm), taller for wrapped designations
+    header_row_h = TABLE_HEADER_SIZE[1]
+    data_row_h = 5.5 * mm
+    desc_w = col_widths[1] - 2 * TABLE_CELL_PADDING
+
+    first_avail = y_start - header_row_h - TABLE_FOOTER_LIMIT
+    next_avail = CONTINUATION_TABLE_TOP - header_row_h - TABLE_FOOTER_LIMIT
+    # Tallest row that fits on any page between its carry lines, closing block included
+    max_row_h = min(first_avail, next_avail - TABLE_CARRY_ROW_H) - TABLE_CARRY_ROW_H - TABLE_CLOSING_RESERVE
+    max_lines = max(1, int((max_row_h - 3) // TABLE_ROW_LEADING))
+
+    def table_rows():
+        # (cells, height, amount) per item, built lazily as the paginator asks
+        for i, item in enumerate(items):
+            total = item["qty"] * item["price"]
+            lines = wrap_text(item["desc"], "Helvetica", 7.5, desc_w)
+            if item.get("description"):
+                lines += wrap_text(item["description"], "Helvetica", 7.5, desc_w)
+            # A designation taller than a page continues on the next rows
+            # (and pages); only its first row carries the figures
+            for start in range(0, len(lines), max_lines):
+                chunk = lines[start:start + max_lines]
+                if start == 0:
+                    cells = [
+                        str(i + 1),
+                        "\n".join(chunk),
+                        item.get("unit", "U"),
+                        str(item["qty"]),
+                        f"{item['price']:,.2f}",
+                        f"{total:,.2f}",
+                    ]
+                else:
+                    cells = ["", "\n".join(chunk), "", "", "", ""]
+                yield cells, max(data_row_h, len(chunk) * TABLE_ROW_LEADING + 3), total if start == 0 else 0
+
+    pages = iter_pages(table_rows(), first_avail, next_avail, height=lambda row: row[1])
+
+    # Each page is drawn and closed as soon as it is full, so memory holds one
+    # page of rows whatever the length of the document
+    subtotal = 0
+    top = y_start
+    for page_no, (page, last) in enumerate(pages):
+        if page_no > 0:
+            # Continuation page: static layers + header, then the carried subtotal
+            draw_page_underlay(c)
+            draw_header(c)
+            top = CONTINUATION_TABLE_TOP
+            _draw_carry_line(c, margin, top - TABLE_CARRY_ROW_H, table_w, col_widths, "Report", subtotal)
+            top -= TABLE_CARRY_ROW_H
+
+        page_heights = [header_row_h] + [h for _cells, h, _amount in page]
+        table = Table([headers] + [cells for cells, _h, _amount in page],
+                      colWidths=col_widths, rowHeights=page_heights)
+        table.setStyle(table_style("priced_items", theme))
+        table_y = top - sum(page_heights)
         # Draw wood texture behind header row
-        _draw_wood_header_bg(c, margin, y_start - header_row_h, table_w, header_row_h)
+        _draw_wood_header_bg(c, margin, top - header_row_h, table_w, header_row_h)
+        table.wrap(table_w, H)
         table.drawOn(c, margin, table_y)
+        subtotal += sum(amount for _cells, _h, amount in page)
+
+        if not last:
+            _draw_carry_line(c, margin, table_y - TABLE_CARRY_ROW_H, table_w, col_widths,
+                             "À reporter", subtotal, note=">>> Suite page suivante")
+            draw_page_overlay(c)
+            c.showPage()
 
     # ── Totals section (compact) ──
     totals_y = table_y - 5 * mm
@@ -620,7 +1468,7 @@ def draw_items_table(c, y_start, items, tva_rate=0.20, show_tva=True):
     box_h = 25 * mm if show_tva else 15 * mm
     c.setFillColor(Color(1, 0.99, 0.96, alpha=0.5))
     c.roundRect(totals_x, totals_y - box_h, totals_w, box_h, 2, fill=1, stroke=0)
-    c.setStrokeColor(GOLD)
+    c.setStrokeColor(theme.GOLD)
     c.setLineWidth(0.5)
     c.roundRect(totals_x, totals_y - box_h, totals_w, box_h, 2, fill=0, stroke=1)
 
@@ -630,7 +1478,7 @@ def draw_items_table(c, y_start, items, tva_rate=0.20, show_tva=True):
 
     # Total HT
     c.setFont("Helvetica", 8)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(label_x, row_y, "Total HT")
     c.drawRightString(value_x, row_y, f"{subtotal:,.2f} DH")
 
@@ -640,29 +1488,31 @@ def draw_items_table(c, y_start, items, tva_rate=0.20, show_tva=True):
         c.drawRightString(value_x, row_y, f"{tva_amount:,.2f} DH")
 
         row_y -= 4
-        c.setStrokeColor(GOLD)
+        c.setStrokeColor(theme.GOLD)
         c.setLineWidth(0.5)
         c.line(label_x, row_y, value_x, row_y)
 
         row_y -= 9
-        c.setFillColor(BROWN_DARK)
+        c.setFillColor(theme.BROWN_DARK)
         c.setFont("Helvetica-Bold", 10)
         c.drawString(label_x, row_y, "Total TTC")
         c.drawRightString(value_x, row_y, f"{total_ttc:,.2f} DH")
     else:
         row_y -= 4
-        c.setStrokeColor(GOLD)
+        c.setStrokeColor(theme.GOLD)
         c.line(label_x, row_y, value_x, row_y)
         row_y -= 9
         c.setFont("Helvetica-Oblique", 7.5)
-        c.setFillColor(GRAY)
+        c.setFillColor(theme.GRAY)
         c.drawString(label_x, row_y, "TVA non applicable")
 
     return totals_y - box_h - 3 * mm, total_ttc
 
 
+@stage
 def draw_payment_section(c, y_start, payment_info=None):
     """Draw payment method and conditions"""
+    theme = render_context(c).theme
     margin = 25 * mm
 
     if payment_info is None:
@@ -675,18 +1525,20 @@ def draw_payment_section(c, y_start, payment_info=None):
     y = y_start
 
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, y, "Mode de paiement :")
 
     c.setFont("Helvetica", 8.5)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(margin + 40 * mm, y, payment_info["mode"])
 
     return y - 8 * mm
 
 
+@stage
 def draw_signature_section(c, y_start):
     """Draw signature boxes - compact"""
+    theme = render_context(c).theme
     margin = 20 * mm
 
     y = y_start
@@ -695,9 +1547,9 @@ def draw_signature_section(c, y_start):
 
     # Vendor signature
     c.setFont("Helvetica-Bold", 8)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, y, "Cachet et signature du vendeur")
-    c.setStrokeColor(GOLD)
+    c.setStrokeColor(theme.GOLD)
     c.setLineWidth(0.5)
     c.setDash(2, 2)
     c.rect(margin, y - box_h, box_w, box_h - 3, fill=0, stroke=1)
@@ -711,34 +1563,120 @@ def draw_signature_section(c, y_start):
     c.setDash()
 
 
-def create_letterhead(filename="papier_entete.pdf"):
-    """Create blank letterhead"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - Papier En-Tête")
-    c.setAuthor("LE TATCHE BOIS")
+# ─── DETERMINISTIC OUTPUT ───────────────────────────────────────
+DETERMINISTIC = False  # see use_deterministic_output
 
-    draw_wood_background(c)
-    draw_header(c)
-    draw_footer(c)
-    draw_border_frame(c)
 
-    # ── Centered logo watermark ──
-    draw_center_watermark(c, opacity=0.06)
+def use_deterministic_output(enabled=True):
+    """Make identical inputs produce identical bytes (stable archivedPdfHash, cache dedup):
+    metadata dates come from the document date and the file ID from the content"""
+    global DETERMINISTIC
+    DETERMINISTIC = enabled
+
 
-    c.save()
+def _document_timestamp(date):
+    """TimeStamp at midnight UTC of a dd/mm/YYYY document date; placeholder
+    dates ("__/__/2026") fall back to ReportLab's invariant epoch"""
+    from reportlab.lib.utils import TimeStamp
+
+    ts = TimeStamp(invariant=1)
+    try:
+        t = calendar.timegm(time.strptime(date, "%d/%m/%Y"))
+    except (TypeError, ValueError):
+        t = 946684800  # 2000-01-01, ReportLab's invariant date
+    ts.t = t
+    ts.lt = time.gmtime(t)
+    ts.YMDhms = tuple(ts.lt)[:6]
+    return ts
+
+
+def new_canvas(data=None, quality=None, profile=None, context=None):
+    """A4 canvas for a builder, carrying its RenderContext (context, else the
+    module settings; quality and profile override the context's): render
+    quality, output profile (see OUTPUT_PROFILES), and in deterministic mode
+    fixed dates and ID"""
+    from reportlab.pdfgen import canvas
+
+    if context is None:
+        context = RenderContext(quality=quality or "final", profile=profile)
+    else:
+        changes = {name: value for name, value in (("quality", quality), ("profile", profile))
+                   if value is not None and value != getattr(context, name)}
+        if changes:
+            context = context.replace(**changes)
+    settings = resolve_profile(context.profile) or {}
+    compression = int(settings.get("compress", _rl_config().pageCompression))
+    if not context.deterministic:
+        c = canvas.Canvas(None, pagesize=A4, pageCompression=compression)
+    else:
+        c = canvas.Canvas(None, pagesize=A4, pageCompression=compression, invariant=1)
+        c._doc._timeStamp = _document_timestamp((data or {}).get("date"))
+    c._context = context
+    if settings:
+        c._asset_variants = profile_variants(settings["dpi"], settings["jpeg_quality"], context.assets)
+    return c
+
+
+def _content_id(c, pdf):
+    """Replace the (constant, invariant-mode) trailer /ID with an MD5 of the file.
+
+    The ID sits after the xref table and keeps its length, so no offset moves.
+    """
+    from reportlab.pdfbase import pdfdoc
+
+    placeholder = c._doc.ID()
+    digest = hashlib.md5(pdf, usedforsecurity=False).digest()
+    ids = pdfdoc.PDFText(digest, enc="raw").format(pdfdoc.DummyDoc())
+    stable = placeholder.replace(placeholder[2:placeholder.index(b"]")], ids + ids, 1)
+    return pdf.replace(placeholder, stable, 1)
+
+
+@stage("save")
+def _finish_document(c, filename, output=None):
+    """Serialize the canvas: write to the output stream and return the bytes,
+    or (no stream) save in the context's output_dir and return the file path"""
+    data = c.getpdfdata()
+    context = render_context(c)
+    if context.overlay:
+        data = overlay_letterhead(data, letterhead_layers(context))
+    if c._doc.invariant:
+        data = _content_id(c, data)
+    if output is not None:
+        output.write(data)
+        return data
+    filepath = os.path.join(context.output_dir, filename)
+    with open(filepath, "wb") as f:
+        f.write(data)
     return filepath
 
 
-def create_facture(filename="facture_template.pdf"):
-    """Create invoice template conforming to Moroccan CGI art. 145"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - Facture")
-    c.setAuthor("LE TATCHE BOIS")
+@stage
+def draw_letterhead(c, data=None):
+    """Draw a blank letterhead page onto c, starting on its current page"""
+    # Background + centered logo watermark, then header, footer and frame
+    draw_page_underlay(c)
+    draw_header(c)
+    draw_page_overlay(c)
+
+
+@stage
+def create_letterhead(filename="papier_entete.pdf", output=None, data=None,
+                      quality=None, profile=None, context=None):
+    """Create blank letterhead"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - Papier En-Tête")
+    c.setAuthor(company)
+    draw_letterhead(c, data)
+    return _finish_document(c, filename, output)
 
-    draw_wood_background(c)
-    draw_center_watermark(c, opacity=0.06)
+
+@stage
+def draw_facture(c, data=None):
+    """Draw a facture onto c, starting on its current page"""
+    theme = render_context(c).theme
+    data = data or {}
+    draw_page_underlay(c)
 
     # Sample data - 15 items to demo space handling
     sample_items = [
@@ -767,30 +1705,33 @@ def create_facture(filename="facture_template.pdf"):
     }
 
     # Draw elements
-    title_y, fields_y, left_x = draw_header(c, doc_type="FACTURE", doc_number="F-2026/0001", doc_date="__/__/2026")
+    title_y, fields_y, left_x = draw_header(c, doc_type="FACTURE",
+                                            doc_number=data.get("number", "F-2026/0001"),
+                                            doc_date=data.get("date", "__/__/2026"))
     
     # Left side: reference fields - same left_x, 16pt spacing
     LINE_H = 16
     fy = fields_y
     c.setFont("Helvetica", 9)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(left_x, fy, "Réf. Bon de commande :  ____________________")
     fy -= LINE_H
     c.drawString(left_x, fy, "Réf. Bon de livraison :    ____________________")
     left_bottom = fy
     
     # Right side: client box top aligned with title
-    client_bottom = draw_client_box(c, title_y + 3, sample_client)
+    client_bottom = draw_client_box(c, title_y + 3, data.get("client", sample_client))
 
     # Table starts below whichever is lower
     table_y = min(left_bottom, client_bottom) - 4 * mm
-    after_table_y, total_ttc = draw_items_table(c, table_y, sample_items, tva_rate=0.20, show_tva=True)
+    after_table_y, total_ttc = draw_items_table(c, table_y, data.get("items", sample_items),
+                                                tva_rate=data.get("tva_rate", 0.20), show_tva=True)
 
     # Amount in letters
     margin = 20 * mm
     arr_y = after_table_y + 1 * mm
     c.setFont("Helvetica-Bold", 7.5)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, arr_y, "*****Arrêté la présente facture à la somme de : ******")
     arr_y -= 10
     c.setFont("Helvetica-Bold", 7.5)
@@ -803,29 +1744,34 @@ def create_facture(filename="facture_template.pdf"):
     draw_signature_section(c, payment_y + 3 * mm)
 
     # Footer
-    draw_footer(c)
-    draw_border_frame(c)
+    draw_page_overlay(c)
 
     # ── "Acquittée" watermark area (small text at bottom left) ──
     margin = 25 * mm
     c.setFont("Helvetica-Oblique", 7)
-    c.setFillColor(GRAY)
+    c.setFillColor(theme.GRAY)
     c.drawString(margin, 27 * mm, "Mention « Acquittée » + date si paiement reçu")
 
-    c.save()
-    return filepath
 
+@stage
+def create_facture(filename="facture_template.pdf", output=None, data=None,
+                   quality=None, profile=None, context=None):
+    """Create invoice template conforming to Moroccan CGI art. 145"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - Facture")
+    c.setAuthor(company)
+    draw_facture(c, data)
+    return _finish_document(c, filename, output)
 
-def create_devis(filename="devis_template.pdf"):
-    """Create quotation template"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - Devis")
-    c.setAuthor("LE TATCHE BOIS")
 
-    draw_wood_background(c)
+@stage
+def draw_devis(c, data=None):
+    """Draw a devis onto c, starting on its current page"""
+    theme = render_context(c).theme
+    data = data or {}
+    draw_page_underlay(c)
 
-    draw_center_watermark(c, opacity=0.06)
     # Sample data
     sample_items = [
         {"desc": "Cuisine complète en bois massif (chêne)", "qty": 1, "price": 25000.00},
@@ -844,35 +1790,38 @@ def create_devis(filename="devis_template.pdf"):
     }
 
     # Draw elements
-    title_y, fields_y, left_x = draw_header(c, doc_type="DEVIS", doc_number="D-2026/0001", doc_date="__/__/2026")
+    title_y, fields_y, left_x = draw_header(c, doc_type="DEVIS",
+                                            doc_number=data.get("number", "D-2026/0001"),
+                                            doc_date=data.get("date", "__/__/2026"))
     
     # Left side fields
     LINE_H = 16
     fy = fields_y
     c.setFont("Helvetica", 9)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(left_x, fy, "Validité :  30 jours")
     fy -= LINE_H
     c.drawString(left_x, fy, "Nature :    Menuiserie bois")
     left_bottom = fy
     
     # Client box
-    client_bottom = draw_client_box(c, title_y + 3, sample_client)
+    client_bottom = draw_client_box(c, title_y + 3, data.get("client", sample_client))
 
     # Items table
     table_y = min(left_bottom, client_bottom) - 4 * mm
-    after_table_y, _ttc = draw_items_table(c, table_y, sample_items, tva_rate=0.20, show_tva=True)
+    after_table_y, _ttc = draw_items_table(c, table_y, data.get("items", sample_items),
+                                           tva_rate=data.get("tva_rate", 0.20), show_tva=True)
 
     # Validity & conditions
     margin = 25 * mm
     cond_y = after_table_y
 
     c.setFont("Helvetica-Bold", 8.5)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, cond_y, "Conditions :")
 
     c.setFont("Helvetica", 8)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     conditions = [
         "• Validité du devis : 30 jours à compter de la date d'émission",
         "• Acompte de 50% à la commande, solde à la livraison",
@@ -887,27 +1836,34 @@ def create_devis(filename="devis_template.pdf"):
 
     # Mention bon pour accord
     c.setFont("Helvetica-Oblique", 7.5)
-    c.setFillColor(GRAY)
+    c.setFillColor(theme.GRAY)
     c.drawString(W - margin - 60 * mm, cond_y - 85, 'Mention manuscrite "Bon pour accord"')
 
     # Footer
-    draw_footer(c)
-    draw_border_frame(c)
+    draw_page_overlay(c)
 
-    c.save()
-    return filepath
+
+@stage
+def create_devis(filename="devis_template.pdf", output=None, data=None,
+                 quality=None, profile=None, context=None):
+    """Create quotation template"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - Devis")
+    c.setAuthor(company)
+    draw_devis(c, data)
+    return _finish_document(c, filename, output)
 
 
-def create_bon_livraison(filename="bon_livraison_template.pdf"):
-    """Create delivery note template"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - Bon de Livraison")
-    c.setAuthor("LE TATCHE BOIS")
+@stage
+def draw_bon_livraison(c, data=None):
+    """Draw a bon de livraison onto c, starting on its current page"""
+    from reportlab.platypus import Table
 
-    draw_wood_background(c)
+    theme = render_context(c).theme
+    data = data or {}
+    draw_page_underlay(c)
 
-    draw_center_watermark(c, opacity=0.06)
     sample_items = [
         {"desc": "Porte en bois massif sur mesure (chêne)", "qty": 2, "price": 0},
         {"desc": "Fenêtre en bois avec vitrage double", "qty": 4, "price": 0},
@@ -921,19 +1877,21 @@ def create_bon_livraison(filename="bon_livraison_template.pdf"):
     }
 
     # Draw elements
-    title_y, fields_y, left_x = draw_header(c, doc_type="BON DE LIVRAISON", doc_number="BL-2026/0001", doc_date="__/__/2026")
+    title_y, fields_y, left_x = draw_header(c, doc_type="BON DE LIVRAISON",
+                                            doc_number=data.get("number", "BL-2026/0001"),
+                                            doc_date=data.get("date", "__/__/2026"))
     
     # Reference fields
     line_h = 16
     fy = fields_y
     c.setFont("Helvetica", 9)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(left_x, fy, "Réf. Facture :  ____________________")
     fy -= line_h
     c.drawString(left_x, fy, "Réf. Devis :     ____________________")
     left_bottom = fy
     
-    client_bottom = draw_client_box(c, title_y + 3, sample_client, is_facture=False)
+    client_bottom = draw_client_box(c, title_y + 3, data.get("client", sample_client), is_facture=False)
 
     # Simplified table (no prices)
     margin = 20 * mm
@@ -941,37 +1899,20 @@ def create_bon_livraison(filename="bon_livraison_template.pdf"):
     headers = ["N°", "Désignation", "Qté", "Observations"]
     col_widths = [12 * mm, 80 * mm, 15 * mm, 53 * mm]
 
+    # Wrapped like draw_items_table: designation, then the item's description
+    desc_w = col_widths[1] - 2 * TABLE_CELL_PADDING
     table_data = [headers]
-    for i, item in enumerate(sample_items):
-        table_data.append([str(i + 1), item["desc"], str(item["qty"]), ""])
+    for i, item in enumerate(data.get("items", sample_items)):
+        lines = wrap_text(item["desc"], "Helvetica", 8, desc_w)
+        if item.get("description"):
+            lines += wrap_text(item["description"], "Helvetica", 8, desc_w)
+        table_data.append([str(i + 1), "\n".join(lines), str(item["qty"]), ""])
 
     while len(table_data) < 8:
         table_data.append(["", "", "", ""])
 
     table = Table(table_data, colWidths=col_widths)
-    style = TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), BROWN_DARK),
-        ('TEXTCOLOR', (0, 0), (-1, 0), GOLD_LIGHT),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 8.5),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-        ('TEXTCOLOR', (0, 1), (-1, -1), GRAY_DARK),
-        ('ALIGN', (0, 1), (0, -1), 'CENTER'),
-        ('ALIGN', (2, 1), (3, -1), 'CENTER'),  # U + Qté
-        ('GRID', (0, 0), (-1, -1), 0.5, GOLD),
-        ('LINEBELOW', (0, 0), (-1, 0), 1.5, GOLD_DARK),
-    ])
-    for i in range(1, len(table_data)):
-        if i % 2 == 0:
-            style.add('BACKGROUND', (0, i), (-1, i), Color(0.98, 0.96, 0.92, alpha=0.4))
-        else:
-            style.add('BACKGROUND', (0, i), (-1, i), Color(1, 1, 1, alpha=0.4))
-    table.setStyle(style)
+    table.setStyle(table_style("delivery_items", theme))
 
     table_height = table.wrap(W - 2 * margin, H)[1]
     table.drawOn(c, margin, table_y - table_height)
@@ -980,24 +1921,29 @@ def create_bon_livraison(filename="bon_livraison_template.pdf"):
     draw_signature_section(c, table_y - table_height - 20 * mm)
 
     # Footer
-    draw_footer(c)
-    draw_border_frame(c)
+    draw_page_overlay(c)
 
-    c.save()
-    return filepath
+
+@stage
+def create_bon_livraison(filename="bon_livraison_template.pdf", output=None, data=None,
+                         quality=None, profile=None, context=None):
+    """Create delivery note template"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - Bon de Livraison")
+    c.setAuthor(company)
+    draw_bon_livraison(c, data)
+    return _finish_document(c, filename, output)
 
 
 # ─── GENERATE ALL DOCUMENTS ─────────────────────────────────────
 
-def create_attachement(filename="attachement_template.pdf"):
-    """Create Attachement template - work progress tracking"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - Attachement")
-    c.setAuthor("LE TATCHE BOIS")
-
-    draw_wood_background(c)
-    draw_center_watermark(c, opacity=0.06)
+@stage
+def draw_attachement(c, data=None):
+    """Draw an attachement onto c, starting on its current page"""
+    theme = render_context(c).theme
+    data = data or {}
+    draw_page_underlay(c)
 
     sample_items = [
         {"desc": "Fourniture et pose portes intérieures en bois hêtre", "unit": "U", "qty": 12, "price": 1500.00},
@@ -1016,47 +1962,56 @@ def create_attachement(filename="attachement_template.pdf"):
         "ice": "[ICE du client]",
     }
 
-    title_y, fields_y, left_x = draw_header(c, doc_type="ATTACHEMENT", doc_number="ATT-2026/0001", doc_date="__/__/2026")
+    title_y, fields_y, left_x = draw_header(c, doc_type="ATTACHEMENT",
+                                            doc_number=data.get("number", "ATT-2026/0001"),
+                                            doc_date=data.get("date", "__/__/2026"))
 
     # Attachement-specific fields
     line_h = 16
     fy = fields_y
     c.setFont("Helvetica", 9)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(left_x, fy, "Nature :          Menuiserie bois")
     fy -= line_h
     c.drawString(left_x, fy, "Marché N° :    ____________________")
     left_bottom = fy
 
-    client_bottom = draw_client_box(c, title_y + 3, sample_client)
+    client_bottom = draw_client_box(c, title_y + 3, data.get("client", sample_client))
 
     table_y = min(left_bottom, client_bottom) - 4 * mm
-    after_table_y, total_ttc = draw_items_table(c, table_y, sample_items, tva_rate=0.20, show_tva=True)
+    after_table_y, total_ttc = draw_items_table(c, table_y, data.get("items", sample_items),
+                                                tva_rate=data.get("tva_rate", 0.20), show_tva=True)
 
     margin = 20 * mm
     arr_y = after_table_y + 1 * mm
     c.setFont("Helvetica-Bold", 7.5)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, arr_y, "*****Arrêté le présent attachement à la somme de : ******")
     arr_y -= 10
     c.drawString(margin, arr_y, f"*** {amount_in_french(total_ttc)} ***")
 
     draw_signature_section(c, arr_y - 8 * mm)
-    draw_footer(c)
-    draw_border_frame(c)
-    c.save()
-    return filepath
+    draw_page_overlay(c)
 
 
-def create_situation_travaux(filename="situation_travaux_template.pdf"):
-    """Create Situation de Travaux template - progress billing"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - Situation de Travaux")
-    c.setAuthor("LE TATCHE BOIS")
+@stage
+def create_attachement(filename="attachement_template.pdf", output=None, data=None,
+                       quality=None, profile=None, context=None):
+    """Create Attachement template - work progress tracking"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - Attachement")
+    c.setAuthor(company)
+    draw_attachement(c, data)
+    return _finish_document(c, filename, output)
 
-    draw_wood_background(c)
-    draw_center_watermark(c, opacity=0.06)
+
+@stage
+def draw_situation_travaux(c, data=None):
+    """Draw a situation de travaux onto c, starting on its current page"""
+    theme = render_context(c).theme
+    data = data or {}
+    draw_page_underlay(c)
 
     sample_items = [
         {"desc": "Portes intérieures en bois hêtre (lot complet)", "unit": "U", "qty": 24, "price": 1500.00},
@@ -1074,14 +2029,16 @@ def create_situation_travaux(filename="situation_travaux_template.pdf"):
         "ice": "[ICE du client]",
     }
 
-    title_y, fields_y, left_x = draw_header(c, doc_type="SITUATION DE TRAVAUX", doc_number="ST-2026/0001", doc_date="__/__/2026")
+    title_y, fields_y, left_x = draw_header(c, doc_type="SITUATION DE TRAVAUX",
+                                            doc_number=data.get("number", "ST-2026/0001"),
+                                            doc_date=data.get("date", "__/__/2026"))
 
     # Left side fields
     # Left side fields
     line_h = 16
     fy = fields_y
     c.setFont("Helvetica", 9)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(left_x, fy, "Nature :          Menuiserie bois")
     fy -= line_h
     c.drawString(left_x, fy, "Situation N° :  ___  /  Période : du __/__/___ au __/__/___")
@@ -1089,37 +2046,46 @@ def create_situation_travaux(filename="situation_travaux_template.pdf"):
     c.drawString(left_x, fy, "Marché N° :    ____________________")
     left_bottom = fy
 
-    client_bottom = draw_client_box(c, title_y + 3, sample_client)
+    client_bottom = draw_client_box(c, title_y + 3, data.get("client", sample_client))
 
     table_y = min(left_bottom, client_bottom) - 4 * mm
-    after_table_y, total_ttc = draw_items_table(c, table_y, sample_items, tva_rate=0.20, show_tva=True)
+    after_table_y, total_ttc = draw_items_table(c, table_y, data.get("items", sample_items),
+                                                tva_rate=data.get("tva_rate", 0.20), show_tva=True)
 
     margin = 20 * mm
     arr_y = after_table_y + 1 * mm
     c.setFont("Helvetica-Bold", 7.5)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, arr_y, "*****Arrêté la présente situation à la somme de : ******")
     arr_y -= 10
     c.drawString(margin, arr_y, f"*** {amount_in_french(total_ttc)} ***")
 
     draw_signature_section(c, arr_y - 8 * mm)
-    draw_footer(c)
-    draw_border_frame(c)
-    c.save()
-    return filepath
+    draw_page_overlay(c)
 
 
-def create_fin_travaux(filename="fin_travaux_template.pdf"):
-    """Create PV de Réception / Fin de Travaux template"""
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    c = canvas.Canvas(filepath, pagesize=A4)
-    c.setTitle("LE TATCHE BOIS - PV Fin de Travaux")
-    c.setAuthor("LE TATCHE BOIS")
+@stage
+def create_situation_travaux(filename="situation_travaux_template.pdf", output=None, data=None,
+                             quality=None, profile=None, context=None):
+    """Create Situation de Travaux template - progress billing"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - Situation de Travaux")
+    c.setAuthor(company)
+    draw_situation_travaux(c, data)
+    return _finish_document(c, filename, output)
 
-    draw_wood_background(c)
-    draw_center_watermark(c, opacity=0.06)
 
-    title_y, fields_y, left_x = draw_header(c, doc_type="PV DE RÉCEPTION — FIN DE TRAVAUX", doc_number="PV-2026/0001", doc_date="__/__/2026")
+@stage
+def draw_fin_travaux(c, data=None):
+    """Draw a PV de fin de travaux onto c, starting on its current page"""
+    theme = render_context(c).theme
+    data = data or {}
+    draw_page_underlay(c)
+
+    title_y, fields_y, left_x = draw_header(c, doc_type="PV DE RÉCEPTION — FIN DE TRAVAUX",
+                                            doc_number=data.get("number", "PV-2026/0001"),
+                                            doc_date=data.get("date", "__/__/2026"))
 
     line_h = 16
     label_x = left_x
@@ -1128,43 +2094,43 @@ def create_fin_travaux(filename="fin_travaux_template.pdf"):
 
     # Client / Project info - consistent 16pt spacing, aligned columns
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(label_x, y, "Maître d'ouvrage :")
     c.setFont("Helvetica", 9)
-    c.setFillColor(BLACK)
-    c.drawString(val_x, y, "[Nom du client]")
+    c.setFillColor(theme.BLACK)
+    c.drawString(val_x, y, data.get("client", {}).get("name", "[Nom du client]"))
 
     y -= line_h
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(label_x, y, "Adresse du chantier :")
     c.setFont("Helvetica", 9)
-    c.setFillColor(BLACK)
-    c.drawString(val_x, y, "[Adresse]")
+    c.setFillColor(theme.BLACK)
+    c.drawString(val_x, y, data.get("client", {}).get("address", "[Adresse]"))
 
     y -= line_h
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(label_x, y, "Nature des travaux :")
     c.setFont("Helvetica", 9)
-    c.setFillColor(BLACK)
+    c.setFillColor(theme.BLACK)
     c.drawString(val_x, y, "Menuiserie bois")
 
     y -= line_h
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(label_x, y, "Réf. Devis / Marché :")
     c.setFont("Helvetica", 9)
     c.drawString(val_x, y, "____________________")
 
     y -= line_h
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(label_x, y, "Date début travaux :")
     c.setFont("Helvetica", 9)
     c.drawString(val_x, y, "___/___/______")
     c.setFont("Helvetica-Bold", 9)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(label_x + 80 * mm, y, "Date fin travaux :")
     c.setFont("Helvetica", 9)
     c.drawString(label_x + 80 * mm + 38 * mm, y, "___/___/______")
@@ -1172,7 +2138,7 @@ def create_fin_travaux(filename="fin_travaux_template.pdf"):
     # Body text
     y -= line_h * 2
     c.setFont("Helvetica", 9.5)
-    c.setFillColor(BLACK)
+    c.setFillColor(theme.BLACK)
     lines = [
         "En date de ce jour, nous soussignés :",
         "",
@@ -1204,13 +2170,13 @@ def create_fin_travaux(filename="fin_travaux_template.pdf"):
     y -= 10
     sig_y = y
     c.setFont("Helvetica-Bold", 8)
-    c.setFillColor(BROWN_DARK)
+    c.setFillColor(theme.BROWN_DARK)
     c.drawString(margin, sig_y, "Pour l'entreprise")
     c.drawRightString(W - margin, sig_y, "Pour le maître d'ouvrage")
 
     sig_y -= 10
     c.setFont("Helvetica", 7.5)
-    c.setFillColor(GRAY_DARK)
+    c.setFillColor(theme.GRAY_DARK)
     c.drawString(margin, sig_y, "Cachet, signature et date")
     c.drawRightString(W - margin, sig_y, "Cachet, signature et date")
 
@@ -1218,20 +2184,2685 @@ def create_fin_travaux(filename="fin_travaux_template.pdf"):
     sig_y -= 5
     box_w = 60 * mm
     box_h = 22 * mm
-    c.setStrokeColor(GOLD)
+    c.setStrokeColor(theme.GOLD)
     c.setLineWidth(0.5)
     c.setDash(3, 3)
     c.rect(margin, sig_y - box_h, box_w, box_h, fill=0, stroke=1)
     c.rect(W - margin - box_w, sig_y - box_h, box_w, box_h, fill=0, stroke=1)
     c.setDash()
 
-    draw_footer(c)
-    draw_border_frame(c)
-    c.save()
-    return filepath
+    draw_page_overlay(c)
 
 
-if __name__ == "__main__":
+@stage
+def create_fin_travaux(filename="fin_travaux_template.pdf", output=None, data=None,
+                       quality=None, profile=None, context=None):
+    """Create PV de Réception / Fin de Travaux template"""
+    c = new_canvas(data, quality, profile, context)
+    company = render_context(c).company["name"]
+    c.setTitle(f"{company} - PV Fin de Travaux")
+    c.setAuthor(company)
+    draw_fin_travaux(c, data)
+    return _finish_document(c, filename, output)
+
+
+# ─── DOCUMENT REGISTRY ──────────────────────────────────────────
+DOCUMENT_BUILDERS = {
+    "papier_entete": create_letterhead,
+    "facture": create_facture,
+    "devis": create_devis,
+    "bon_livraison": create_bon_livraison,
+    "attachement": create_attachement,
+    "situation_travaux": create_situation_travaux,
+    "fin_travaux": create_fin_travaux,
+}
+
+
+def render_pdf(doc_type, output=None, data=None, quality=None, profile=None, context=None):
+    """Render a document in memory and return its PDF bytes (no filesystem access)"""
+    return DOCUMENT_BUILDERS[doc_type](output=output if output is not None else io.BytesIO(),
+                                       data=data, quality=quality, profile=profile, context=context)
+
+
+def render_profile(doc_type, data=None, profile="email", max_bytes=None, quality=None, context=None):
+    """Render with an output profile. With a byte budget (the profile's
+    max_bytes, or max_bytes here) image resolution and JPEG quality are
+    stepped down (BUDGET_STEPS) until the PDF fits. profile=None takes the
+    context's profile, or "screen" if it has none.
+
+    Returns {"pdf", "size", "profile", "dpi", "jpeg_quality", "compress",
+    "max_bytes", "fits", "attempts"}; if even the last step is over budget,
+    its (smallest) render is returned with fits=False.
+    """
+    if profile is None:
+        profile = (context.profile if context else None) or "screen"
+    settings = dict(resolve_profile(profile))
+    budget = max_bytes if max_bytes is not None else settings.pop("max_bytes", None)
+    settings.pop("max_bytes", None)
+    start = (settings["dpi"], settings["jpeg_quality"])
+    steps = [start]
+    if budget:
+        steps += [s for s in BUDGET_STEPS if s != start and s[0] <= start[0] and s[1] <= start[1]]
+    for attempt, (dpi, jpeg_quality) in enumerate(steps, 1):
+        settings.update(dpi=dpi, jpeg_quality=jpeg_quality)
+        pdf = render_pdf(doc_type, data=data, quality=quality, profile=settings, context=context)
+        if not budget or len(pdf) <= budget:
+            break
+    return {"pdf": pdf, "size": len(pdf), "profile": profile if isinstance(profile, str) else "custom",
+            "dpi": dpi, "jpeg_quality": jpeg_quality, "compress": settings["compress"],
+            "max_bytes": budget, "fits": not budget or len(pdf) <= budget, "attempts": attempt}
+
+
+# Same documents, drawn onto a caller's canvas (bulk export)
+DOCUMENT_DRAWERS = {
+    "papier_entete": draw_letterhead,
+    "facture": draw_facture,
+    "devis": draw_devis,
+    "bon_livraison": draw_bon_livraison,
+    "attachement": draw_attachement,
+    "situation_travaux": draw_situation_travaux,
+    "fin_travaux": draw_fin_travaux,
+}
+DOCUMENT_LABELS = {
+    "papier_entete": "Papier en-tête",
+    "facture": "Facture",
+    "devis": "Devis",
+    "bon_livraison": "Bon de livraison",
+    "attachement": "Attachement",
+    "situation_travaux": "Situation de travaux",
+    "fin_travaux": "PV de réception",
+}
+
+
+# ─── BULK EXPORT ────────────────────────────────────────────────
+@stage
+def export_bulk(jobs, filename="export.pdf", output=None, title=None, quality=None, context=None):
+    """Render many documents one after another into a single PDF.
+
+    Everything goes onto one canvas, so each branding image (and the static
+    page layers) is embedded once and referenced from every page: size grows
+    with pages, not with documents x assets. Each document gets a bookmark
+    with its number. Jobs are {"type", "data"} dicts or CRMDocument payloads.
+    """
+    c = new_canvas(quality=quality, context=context)
+    company = render_context(c).company["name"]
+    c.setTitle(title or f"{company} - Export")
+    c.setAuthor(company)
+    for i, job in enumerate(jobs):
+        doc_type, data = payload_to_job(job)
+        data = data or {}
+        key = f"doc-{i + 1}"
+        c.bookmarkPage(key)
+        c.addOutlineEntry(f"{DOCUMENT_LABELS[doc_type]} {data.get('number') or f'#{i + 1}'}", key, level=0)
+        DOCUMENT_DRAWERS[doc_type](c, data)
+        c.showPage()
+    c.showOutline()
+    return _finish_document(c, filename, output)
+
+
+def report_asset_optimisation(dpi=150, jpeg_quality=85):
+    """Render every document with original and resampled assets; print size and time"""
+    def render_all():
+        results = {}
+        for name in DOCUMENT_BUILDERS:
+            start = time.perf_counter()
+            data = render_pdf(name)
+            results[name] = (len(data), time.perf_counter() - start)
+        return results
+
+    saved = dict(ASSETS.variants)
+    ASSETS.invalidate()
+    before = render_all()
+    optimise_assets(dpi, jpeg_quality)
+    after = render_all()
+    ASSETS.invalidate()
+    ASSETS.variants.update(saved)
+
+    print(f"{'Document':<20}{'Size before':>14}{'Size after':>14}{'Time before':>13}{'Time after':>12}")
+    for name in DOCUMENT_BUILDERS:
+        (b_size, b_time), (a_size, a_time) = before[name], after[name]
+        print(f"{name:<20}{b_size / 1024:>11.0f} KB{a_size / 1024:>11.0f} KB"
+              f"{b_time * 1000:>10.0f} ms{a_time * 1000:>9.0f} ms")
+    return before, after
+
+
+def iter_synthetic_items(n, desc="Fourniture et pose menuiserie bois"):
+    """n catalogue-like lines for benchmarks, generated one at a time"""
+    units = ["U", "ML", "M²", "ENS"]
+    for i in range(n):
+        yield {"desc": f"{desc} #{i + 1}", "unit": units[i % 4], "qty": i % 9 + 1,
+               "price": 100.0 + (i * 37) % 5000}
+
+
+def synthetic_items(n, desc="Fourniture et pose menuiserie bois"):
+    """n catalogue-like lines for benchmarks"""
+    return list(iter_synthetic_items(n, desc))
+
+
+LONG_DESIGNATION = ("Fourniture et pose de portes intérieures en bois hêtre massif, "
+                    "chambranles moulurés, quincaillerie laiton et finition vernis mat")
+
+
+def benchmark_items_table(counts=(10, 100, 1000, 10000), desc=None):
+    """Time draw_items_table pagination + drawing for growing line counts"""
+    from reportlab.pdfgen import canvas
+
+    print(f"{'Lines':>8}{'Pages':>8}{'Time':>12}{'Rows/s':>12}")
+    results = {}
+    for n in counts:
+        items = synthetic_items(n, desc) if desc else synthetic_items(n)
+        c = canvas.Canvas(None, pagesize=A4)
+        draw_page_underlay(c)
+        title_y, fields_y, left_x = draw_header(c, doc_type="SITUATION DE TRAVAUX",
+                                                doc_number="ST-BENCH", doc_date="01/01/2026")
+        start = time.perf_counter()
+        draw_items_table(c, fields_y - 20 * mm, items)
+        elapsed = time.perf_counter() - start
+        pages = c.getPageNumber()
+        results[n] = (pages, elapsed)
+        print(f"{n:>8}{pages:>8}{elapsed * 1000:>9.1f} ms{n / elapsed:>12.0f}")
+    return results
+
+
+def check_streaming_memory(counts=(100, 1000, 10000, 100000), tolerance=1.5):
+    """Stream generated lines through draw_items_table and check with tracemalloc
+    that the working memory stays flat as the line count grows.
+
+    The canvas keeps every finished page until it is saved, so what is retained
+    when drawing ends is the document itself; the working memory is the peak
+    above that. Returns True if the largest run needs at most tolerance x the
+    working memory of the smallest.
+    """
+    import tracemalloc
+
+    def working_memory(n):
+        c = new_canvas()
+        draw_page_underlay(c)
+        title_y, fields_y, left_x = draw_header(c, doc_type="ATTACHEMENT",
+                                                doc_number="AT-STREAM", doc_date="01/01/2026")
+        tracemalloc.start()
+        try:
+            draw_items_table(c, fields_y - 20 * mm, iter_synthetic_items(n))
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return c.getPageNumber(), peak - retained, retained
+
+    working_memory(counts[0])  # decode assets and fill caches outside the measurement
+    print(f"{'Lines':>8}{'Pages':>8}{'Working':>12}{'Document':>12}")
+    results = {}
+    for n in counts:
+        pages, working, retained = results[n] = working_memory(n)
+        print(f"{n:>8}{pages:>8}{working / 1024:>9.0f} KB{retained / 1024:>9.0f} KB")
+    ok = results[counts[-1]][1] <= tolerance * results[counts[0]][1]
+    print("OK: working memory is flat" if ok else
+          f"FAIL: working memory grew more than {tolerance}x")
+    return ok
+
+
+def pdf_page_count(pdf):
+    """Number of pages in a ReportLab-written PDF (no parser needed)"""
+    return pdf.count(b"/Type /Page\n")
+
+
+def benchmark_quality(runs=10):
+    """Compare the final and draft profiles on every document type: cold
+    (first render, assets not yet decoded) and warm time, size, page count"""
+    def cold(quality, name):
+        ASSETS.invalidate()
+        _average_colour.cache_clear()
+        _draft_variant.cache_clear()
+        start = time.perf_counter()
+        render_pdf(name, quality=quality)
+        return time.perf_counter() - start
+
+    print(f"{'Document':<20}{'Cold final':>12}{'Cold draft':>12}{'Warm final':>12}{'Warm draft':>12}"
+          f"{'Ratio':>8}{'Size final':>12}{'Size draft':>12}  Pages")
+    results = {}
+    saved = dict(ASSETS.variants)
+    for name in DOCUMENT_BUILDERS:
+        row = {}
+        for quality in QUALITIES:
+            row[f"cold_{quality}"] = cold(quality, name)
+            ASSETS.variants.update(saved)
+            pdf = render_pdf(name, quality=quality)
+            start = time.perf_counter()
+            for _ in range(runs):
+                render_pdf(name, quality=quality)
+            row[f"warm_{quality}"] = (time.perf_counter() - start) / runs
+            row[f"size_{quality}"] = len(pdf)
+            row[f"pages_{quality}"] = pdf_page_count(pdf)
+        results[name] = row
+        pages = "same" if row["pages_final"] == row["pages_draft"] else "DIFFER"
+        print(f"{name:<20}{row['cold_final'] * 1000:>9.0f} ms{row['cold_draft'] * 1000:>9.0f} ms"
+              f"{row['warm_final'] * 1000:>9.1f} ms{row['warm_draft'] * 1000:>9.1f} ms"
+              f"{row['cold_draft'] / row['cold_final']:>7.0%} "
+              f"{row['size_final'] / 1024:>8.0f} KB{row['size_draft'] / 1024:>9.0f} KB  {pages}")
+    return results
+
+
+# ─── BATCH RENDERING ────────────────────────────────────────────
+def apply_asset_options(asset_dpi=None, flat_background=None):
+    """Install resampled variants and/or the flattened background (CLI --asset-dpi / --flat-background)"""
+    if asset_dpi:
+        optimise_assets(asset_dpi)
+    if flat_background:
+        use_flat_background(flat_background)
+
+
+def _warm_worker(asset_dpi=None, flat_background=None, deterministic=False, overlay=False):
+    """Pool initializer: decode assets, load font metrics and build every code path once"""
+    apply_asset_options(asset_dpi, flat_background)
+    use_deterministic_output(deterministic)
+    use_letterhead_overlay(overlay)
+    for name in DOCUMENT_BUILDERS:
+        for quality in QUALITIES:
+            render_pdf(name, quality=quality)
+
+
+def _render_job(job, out_dir=None):
+    """Render one batch job; exceptions are reported in the result, never raised"""
+    start = time.perf_counter()
+    result = {"id": job["id"], "type": job.get("type"), "pid": os.getpid()}
+    try:
+        quality = job.get("quality", "final")
+        thumb = job.get("thumbnail")
+        image = pdf = None
+        if job.get("profile"):
+            report = render_profile(job["type"], job.get("data"), job["profile"], job.get("max_bytes"), quality)
+            pdf = report.pop("pdf")
+            result["profile"] = report
+        elif thumb:
+            # Both come from (and go to) the render cache under the same content key
+            thumb = thumb if isinstance(thumb, dict) else {"width": thumb}
+            fmt = thumb.get("format", "png")
+            image, key, hit = thumbnail_cached(job["type"], job.get("data"), thumb.get("width", 240), fmt,
+                                               quality=quality)
+            result.update(key=key, thumbnail_hit=hit, thumbnail_size=len(image))
+            if not job.get("thumbnail_only"):
+                pdf = render_cached(job["type"], job.get("data"), quality=quality)[0]
+        else:
+            pdf = render_pdf(job["type"], data=job.get("data"), quality=quality)
+        path = os.path.join(out_dir or "", job.get("filename") or f"{job['type']}_{job['id']}.pdf")
+        if out_dir:
+            if pdf is not None:
+                with open(path, "wb") as f:
+                    f.write(pdf)
+                result["path"] = path
+            if image is not None:
+                result["thumbnail_path"] = f"{os.path.splitext(path)[0]}.{fmt}"
+                with open(result["thumbnail_path"], "wb") as f:
+                    f.write(image)
+        else:
+            if pdf is not None:
+                result["pdf"] = pdf
+            if image is not None:
+                result["thumbnail"] = image
+        result.update(ok=True, size=len(pdf) if pdf is not None else 0)
+    except Exception as exc:
+        import traceback
+
+        result.update(ok=False, error=f"{type(exc).__name__}: {exc}", traceback=traceback.format_exc())
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _start_batch_pool(workers, initargs):
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(workers, initializer=_warm_worker, initargs=initargs)
+
+
+def _failed_job(job, error, seconds=0.0):
+    return {"id": job["id"], "type": job.get("type"), "ok": False, "error": error, "seconds": seconds}
+
+
+def render_batch(jobs, workers=None, out_dir=None, asset_dpi=None, flat_background=None):
+    """Render document jobs over a pool of warm worker processes, yielding
+    one result dict per job as soon as it finishes (completion order).
+
+    A job is {"type": "facture", "data": {...}, "id": ..., "filename": ...,
+    "quality": "final"|"draft", "profile": "email", "max_bytes": ...,
+    "thumbnail": width or {"width", "format"}, "thumbnail_only": bool}; only
+    "type" is required. Profiled jobs report the settings chosen in
+    "profile"; thumbnails are written next to the PDF (or returned in
+    "thumbnail"). Results carry id, ok, size, seconds and either "pdf"
+    (bytes) or, with out_dir, "path"; failed jobs carry error/traceback.
+
+    A job that raises, or cannot be sent to a worker (data that does not
+    pickle, such as streamed items), fails alone. A worker crash breaks the
+    whole pool: only the jobs running at that moment become suspects, the
+    others carry on in one fresh pool, and each suspect is then run with
+    nothing beside it, so a second crash names the culprit. Workers inherit
+    the current DETERMINISTIC and LETTERHEAD_OVERLAY modes.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    pending = deque()
+    for i, job in enumerate(jobs):
+        job = dict(job)
+        job.setdefault("id", i)
+        pending.append((i, job))
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    initargs = (asset_dpi, flat_background, DETERMINISTIC, LETTERHEAD_OVERLAY)
+    suspects = set()  # indices of jobs that were running when a worker crashed
+    running = {}  # future -> (index, job); at most `workers`, so all of them really run
+    pool = _start_batch_pool(workers, initargs)
+    try:
+        while pending or running:
+            # A suspect runs alone: nothing starts beside it, it waits for an empty pool
+            while pending and len(running) < workers and not suspects.intersection(i for i, _ in running.values()):
+                if pending[0][0] in suspects and running:
+                    break
+                i, job = pending.popleft()
+                try:
+                    running[pool.submit(_render_job, job, out_dir)] = i, job
+                except Exception as exc:
+                    yield _failed_job(job, f"{type(exc).__name__}: {exc}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            lost = []
+            for future in done:
+                i, job = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    lost.append((i, job))
+                except Exception as exc:  # the job could not be pickled for its worker
+                    yield _failed_job(job, f"{type(exc).__name__}: {exc}")
+            if not lost:
+                continue
+            # Every other running job dies with the pool too
+            for future, (i, job) in list(running.items()):
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    lost.append((i, job))
+                except Exception as exc:
+                    yield _failed_job(job, f"{type(exc).__name__}: {exc}")
+            running.clear()
+            pool.shutdown(wait=True, cancel_futures=True)
+            if len(lost) == 1:
+                yield _failed_job(lost[0][1], "worker process crashed")  # it was running alone
+            else:
+                suspects.update(i for i, _ in lost)
+                pending.extendleft(reversed(lost))
+            if pending:
+                pool = _start_batch_pool(workers, initargs)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def load_batch_jobs(path):
+    """Read a batch job list: a JSON array, or JSON Lines, from a file or '-' (stdin)"""
+    text = sys.stdin.read() if path == "-" else open(path, encoding="utf-8").read()
+    text = text.strip()
+    if text.startswith("["):
+        entries = json.loads(text)
+    else:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [as_batch_job(entry) for entry in entries]
+
+
+def as_batch_job(entry):
+    """Batch job from a job dict or a CRMDocument payload (keeping its id)"""
+    if "data" in entry or entry.get("type") in DOCUMENT_BUILDERS:
+        return entry
+    doc_type, data = crm_document_to_job(entry)
+    job = {"type": doc_type, "data": data}
+    if "id" in entry:
+        job["id"] = entry["id"]
+    return job
+
+
+def _relocated_context(directory):
+    """RenderContext drawing copies of the module's assets (and of their active
+    variants) placed in directory, as another checkout or a container would"""
+    import shutil
+
+    os.makedirs(os.path.join(directory, "variants"))
+    assets, cache = {}, AssetCache()
+    for name, path in RenderContext().assets._asdict().items():
+        if not os.path.exists(path):
+            continue
+        assets[name] = shutil.copy2(path, os.path.join(directory, os.path.basename(path)))
+        variant = ASSETS.variants.get(path)
+        if variant:
+            cache.variants[assets[name]] = shutil.copy2(
+                variant, os.path.join(directory, "variants", os.path.basename(variant)))
+    return RenderContext(assets=assets, asset_cache=cache)
+
+
+def check_deterministic(runs=1000, doc_types=None):
+    """Render each document type repeatedly in this process, once in a fresh
+    worker and once from a copy of the assets in another directory
+    (deterministic mode); every SHA-256 must match the first render"""
+    doc_types = list(doc_types or DOCUMENT_BUILDERS)
+    saved = DETERMINISTIC
+    use_deterministic_output(True)
+    try:
+        data = {"date": "31/03/2026"}
+        expected = {name: hashlib.sha256(render_pdf(name, data=data)).hexdigest() for name in doc_types}
+        mismatches = 0
+        start = time.perf_counter()
+        for i in range(runs):
+            name = doc_types[i % len(doc_types)]
+            mismatches += hashlib.sha256(render_pdf(name, data=data)).hexdigest() != expected[name]
+        elapsed = time.perf_counter() - start
+        jobs = [{"type": name, "data": data} for name in doc_types]
+        for result in render_batch(jobs, workers=1):
+            if not result["ok"] or hashlib.sha256(result["pdf"]).hexdigest() != expected[result["type"]]:
+                print(f"{result['type']}: fresh process render differs")
+                mismatches += 1
+        with tempfile.TemporaryDirectory() as directory:
+            context = _relocated_context(directory)
+            for name in doc_types:
+                if hashlib.sha256(render_pdf(name, data=data, context=context)).hexdigest() != expected[name]:
+                    print(f"{name}: render from relocated assets differs")
+                    mismatches += 1
+    finally:
+        use_deterministic_output(saved)
+    for name in doc_types:
+        print(f"{name:<20}{expected[name]}")
+    print(f"{runs} renders in {elapsed:.1f} s + {len(jobs)} in a fresh process + {len(jobs)} from "
+          f"relocated assets: {'all identical' if not mismatches else f'{mismatches} mismatches'}")
+    return mismatches == 0
+
+
+def benchmark_threads(runs=24, workers=(1, 2, 4), doc_types=None, check=True):
+    """Render the same jobs serially and on thread pools of each size, warm
+    (shared asset cache) and cold (a fresh AssetCache per job, so PNG decoding
+    and image compression are in the timing). Only that image work and zlib
+    release the GIL, so the speed-up is bounded by their share of a render and
+    by the CPU count. With check, two deterministic contexts for different
+    companies and themes are rendered concurrently and every PDF must match
+    its serial render byte for byte. Returns True when they all do."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    doc_types = list(doc_types or DOCUMENT_BUILDERS)
+    data = {"date": "31/03/2026"}
+    base = RenderContext(deterministic=True)
+    contexts = [base, base.replace(company=dict(COMPANY, name="MENUISERIE ATLAS", city="AGADIR"),
+                                   theme=base.theme._replace(GOLD="#2E7D32", BROWN_DARK="#1B3A2B"))]
+
+    ok = True
+    if check:
+        jobs = [(name, context) for context in contexts for name in doc_types]
+        expected = [render_pdf(name, data=data, context=context) for name, context in jobs]
+        with ThreadPoolExecutor(max(workers)) as pool:
+            got = list(pool.map(lambda job: render_pdf(job[0], data=data, context=job[1]), jobs * 4))
+        mismatches = sum(pdf != expected[i % len(jobs)] for i, pdf in enumerate(got))
+        ok = not mismatches and expected[0] != expected[len(doc_types)]
+        print(f"{len(got)} concurrent renders over {len(contexts)} contexts: "
+              f"{'all identical to the serial renders' if ok else f'{mismatches} mismatches'}")
+
+    def render(i, cold):
+        context = contexts[i % 2]
+        if cold:
+            cache = AssetCache()
+            cache.variants.update(context.asset_cache.variants)
+            context = context.replace(asset_cache=cache)
+        return render_pdf(doc_types[i % len(doc_types)], data=data, context=context)
+
+    print(f"{os.cpu_count()} CPU(s), {runs} renders per row")
+    print(f"{'Assets':<8}{'Threads':>8}{'Wall':>10}{'Renders/s':>11}{'Speed-up':>10}")
+    for cold in (False, True):
+        for i in range(len(contexts)):
+            render(i, False)  # warm the shared caches either way
+        start = time.perf_counter()
+        for i in range(runs):
+            render(i, cold)
+        serial = time.perf_counter() - start
+        label = "cold" if cold else "warm"
+        print(f"{label:<8}{'serial':>8}{serial:>8.2f} s{runs / serial:>11.1f}{1:>9.2f}x")
+        for n in workers:
+            with ThreadPoolExecutor(n) as pool:
+                start = time.perf_counter()
+                list(pool.map(render, range(runs), [cold] * runs))
+                wall = time.perf_counter() - start
+            print(f"{label:<8}{n:>8}{wall:>8.2f} s{runs / wall:>11.1f}{serial / wall:>9.2f}x")
+    return ok
+
+
+# ─── BENCHMARK SUITE ────────────────────────────────────────────
+# Builders that draw data["items"]; the others are benchmarked once per profile
+ITEM_DOCUMENTS = ("facture", "devis", "bon_livraison", "attachement", "situation_travaux")
+BENCH_LINES = (1, 10, 100, 1000, 10000)
+BENCH_DESIGNATIONS = {"short": "Fourniture et pose menuiserie bois", "long": LONG_DESIGNATION}
+BENCH_PROFILES = ("source",) + tuple(OUTPUT_PROFILES)  # "source": assets as shipped
+BENCH_BASE_LINES = 100  # line count used when sweeping the asset profile
+BENCH_METRICS = (  # (metric, lower is better) compared by compare_benchmarks
+    ("p50_ms", True),
+    ("p95_ms", True),
+    ("pages_per_s", False),
+    ("peak_rss_mb", True),
+    ("bytes", True),
+)
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted, non-empty list"""
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * q // 100)]
+
+
+def benchmark_cases(doc_types=None, lines=BENCH_LINES, designations=tuple(BENCH_DESIGNATIONS),
+                    profiles=BENCH_PROFILES):
+    """The benchmark matrix, one dimension at a time: every line count x designation
+    length with the shipped assets, then every asset profile at BENCH_BASE_LINES"""
+    cases = []
+    for doc_type in doc_types or DOCUMENT_BUILDERS:
+        if doc_type in ITEM_DOCUMENTS:
+            sweep = [(n, desc, "source") for n in lines for desc in designations]
+            sweep += [(BENCH_BASE_LINES, "short", p) for p in profiles if p != "source"]
+        else:
+            sweep = [(0, "short", p) for p in profiles]
+        for n, desc, profile in sweep:
+            case = {"type": doc_type, "lines": n, "designation": desc, "profile": profile}
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def case_id(case):
+    return f"{case['type']}/lines={case['lines']}/{case['designation']}/{case['profile']}"
+
+
+def _bench_case(case, runs=20, max_seconds=5.0):
+    """Time one case in this (fresh) process: a cold render, then up to runs
+    warm renders within max_seconds (at least 3)"""
+    import resource
+
+    data = {"items": synthetic_items(case["lines"], BENCH_DESIGNATIONS[case["designation"]])} \
+        if case["lines"] else None
+    profile = None if case["profile"] == "source" else case["profile"]
+    start = time.perf_counter()
+    pdf = render_pdf(case["type"], data=data, profile=profile)
+    cold = time.perf_counter() - start
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    while len(latencies) < runs and (len(latencies) < 3 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        render_pdf(case["type"], data=data, profile=profile)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    pages = pdf_page_count(pdf)
+    return dict(case, runs=len(latencies), cold_ms=cold * 1000,
+                p50_ms=percentile(latencies, 50) * 1000, p95_ms=percentile(latencies, 95) * 1000,
+                p99_ms=percentile(latencies, 99) * 1000, mean_ms=sum(latencies) / len(latencies) * 1000,
+                pages=pages, pages_per_s=pages * len(latencies) / sum(latencies), bytes=len(pdf),
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def run_benchmarks(cases, runs=20, max_seconds=5.0, asset_dpi=None, flat_background=None):
+    """Run each case in its own fresh worker process (so peak RSS is per case)
+    and return the baseline document: environment + {case id: result}"""
+    import platform
+    from concurrent.futures import ProcessPoolExecutor
+    from reportlab import Version as reportlab_version
+
+    results = {}
+    print(f"{'Case':<52}{'Runs':>5}{'p50':>11}{'p95':>11}{'Pages/s':>9}{'RSS':>8}{'Size':>10}")
+    for case in cases:
+        with ProcessPoolExecutor(1, max_tasks_per_child=1, initializer=apply_asset_options,
+                                 initargs=(asset_dpi, flat_background)) as pool:
+            r = pool.submit(_bench_case, case, runs, max_seconds).result()
+        results[case_id(case)] = r
+        print(f"{case_id(case):<52}{r['runs']:>5}{r['p50_ms']:>8.1f} ms{r['p95_ms']:>8.1f} ms"
+              f"{r['pages_per_s']:>9.1f}{r['peak_rss_mb']:>5.0f} MB{r['bytes'] / 1024:>7.0f} KB", flush=True)
+    return {
+        "generator_version": GENERATOR_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "reportlab": reportlab_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "asset_dpi": asset_dpi,
+        "flat_background": flat_background,
+        "results": results,
+    }
+
+
+def compare_benchmarks(baseline, current, threshold=0.10):
+    """Print the relative change of each BENCH_METRICS metric for the cases in
+    both runs and return the regressions worse than threshold (0.10 = 10%)"""
+    regressions = []
+    print(f"{'Case':<52}" + "".join(f"{metric:>13}" for metric, _ in BENCH_METRICS))
+    for cid, new in current["results"].items():
+        old = baseline["results"].get(cid)
+        if old is None:
+            continue
+        cells = []
+        for metric, lower_is_better in BENCH_METRICS:
+            change = (new[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+            worse = change > threshold if lower_is_better else change < -threshold
+            if worse:
+                regressions.append((cid, metric, old[metric], new[metric], change))
+            cells.append(f"{change:>+11.1%}{' !' if worse else '  '}")
+        print(f"{cid:<52}" + "".join(cells))
+    missing = sorted(set(baseline["results"]) - set(current["results"]))
+    if missing:
+        print(f"{len(missing)} baseline cases not run")
+    print(f"{len(regressions)} regression(s) above {threshold:.0%}" if regressions else
+          f"no regressions above {threshold:.0%}")
+    return regressions
+
+
+# Modules the CLI must not import before it renders (they are most of ReportLab's
+# start-up cost); check_import_time fails if --help, list or validate pulls one in
+STARTUP_EXCLUDED_MODULES = ("PIL", "reportlab.lib.utils", "reportlab.lib.colors", "reportlab.pdfgen",
+                            "reportlab.pdfbase", "reportlab.platypus", "http.server", "socketserver",
+                            "multiprocessing", "concurrent.futures.process")
+# Self time of the modules the script adds to a bare interpreter: --help and list
+# measure 30-39 ms here, the budget leaves room for a busy machine
+IMPORT_BUDGET_MS = 60
+
+
+def _import_times(args):
+    """{module: self import time in µs} from python -X importtime"""
+    import subprocess
+
+    stderr = subprocess.run([sys.executable, "-X", "importtime", *args],
+                            capture_output=True, text=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:"):
+            own, _cumulative, module = line[len("import time:"):].split("|")
+            if own.strip().isdigit():
+                times[module.strip()] = int(own)
+    return times
+
+
+def check_import_time(budget_ms=IMPORT_BUDGET_MS, commands=(["--help"], ["list"]), runs=3):
+    """Import cost of the CLI's fast paths, measured with python -X importtime
+    against a bare interpreter (best of runs): fails over budget_ms or if any
+    STARTUP_EXCLUDED_MODULES is imported"""
+    baseline = set(_import_times(["-c", "pass"]))
+    ok = True
+    for command in commands:
+        samples = [_import_times([os.path.abspath(__file__), *command]) for _ in range(runs)]
+        extra = {module: min(s.get(module, 0) for s in samples)
+                 for module in samples[0] if module not in baseline}
+        total = sum(extra.values()) / 1000
+        excluded = [m for m in extra if m.startswith(STARTUP_EXCLUDED_MODULES)]
+        slowest = sorted(extra.items(), key=lambda kv: -kv[1])[:5]
+        print(f"{' '.join(command):<10}{len(extra):>4} modules {total:>6.1f} ms  (budget {budget_ms} ms)  "
+              + ", ".join(f"{m} {t / 1000:.1f}" for m, t in slowest))
+        if excluded:
+            print(f"  imports modules reserved for rendering: {', '.join(sorted(excluded))}")
+        ok &= total <= budget_ms and not excluded
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+# ─── RENDER CACHE ───────────────────────────────────────────────
+# Bump whenever a drawing change alters the output for the same inputs
+GENERATOR_VERSION = "2026.10.2"
+
+# Branding images (AssetPaths names) each document draws; items-table
+# documents add the header texture
+PAGE_ASSETS = ("WOOD_BG", "LOGO_WATERMARK", "LOGO_HEADER", "WOOD_BAR_TEXTURE",
+               "FRAME_TOP", "FRAME_BOTTOM", "FRAME_LEFT", "FRAME_RIGHT")
+DOCUMENT_ASSETS = {
+    "papier_entete": PAGE_ASSETS,
+    "facture": PAGE_ASSETS + ("WOOD_HEADER_TEXTURE",),
+    "devis": PAGE_ASSETS + ("WOOD_HEADER_TEXTURE",),
+    "bon_livraison": PAGE_ASSETS,
+    "attachement": PAGE_ASSETS + ("WOOD_HEADER_TEXTURE",),
+    "situation_travaux": PAGE_ASSETS + ("WOOD_HEADER_TEXTURE",),
+    "fin_travaux": PAGE_ASSETS,
+}
+RENDER_CACHE_DIR = os.path.join(tempfile.gettempdir(), "tatche-render-cache")
+
+
+@functools.lru_cache(maxsize=256)
+def _asset_digest(path, mtime_ns, size):
+    return _file_digest(path)
+
+
+def asset_digest(path, asset_cache=None):
+    """Content digest of the file actually drawn for path (through asset_cache,
+    default ASSETS), hashed once per file version"""
+    path = (ASSETS if asset_cache is None else asset_cache).variants.get(path, path)
+    st = os.stat(path)
+    return _asset_digest(path, st.st_mtime_ns, st.st_size)
+
+
+def _canonical_json(obj):
+    # No default=: a value without a JSON form (a generator of items, say) would
+    # hash by its repr, i.e. its address, and two documents could share a key
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def render_key(doc_type, data=None, quality=None, profile=None, max_bytes=None, context=None):
+    """Content address of a document: hash of everything that decides its bytes
+    (data, the context's company, colours and the assets this type draws,
+    generator version); quality and profile override the context's.
+    Raises TypeError for data that is not plain JSON (streamed items): such
+    a document has no content address and is rendered uncached."""
+    context = context or RenderContext()
+    quality = quality or context.quality
+    profile = context.profile if profile is None else profile
+    names = DOCUMENT_ASSETS[doc_type]
+    if context.flat_background:
+        names = [name for name in names if name not in ("WOOD_BG", "LOGO_WATERMARK")]
+    assets = [getattr(context.assets, name) for name in names]
+    if context.flat_background:
+        assets.insert(0, context.flat_background)
+    colours = {name: value for name, value in globals().items()
+               if name.isupper() and isinstance(value, str) and value.startswith("#")}
+    colours.update(context.theme._asdict())
+    inputs = {
+        "version": GENERATOR_VERSION,
+        "type": doc_type,
+        "quality": quality,
+        "profile": [resolve_profile(profile), max_bytes],
+        "data": data,
+        "company": dict(context.company),
+        "colours": colours,
+        "assets": {os.path.basename(path): asset_digest(path, context.asset_cache) for path in assets},
+        "a85": _rl_config().useA85,
+        "deterministic": context.deterministic,
+    }
+    if context.overlay:
+        inputs["overlay"] = True  # same pages, different objects; other keys stay as they were
+    return hashlib.sha256(_canonical_json(inputs).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """Two-level cache of rendered PDFs by render_key: an in-memory LRU bounded
+    by bytes in front of an on-disk store (oldest files evicted past its budget).
+    Keys are content addresses, so nothing is invalidated explicitly: entries
+    whose inputs changed are simply never asked for again and age out."""
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, disk_dir=RENDER_CACHE_DIR,
+                 disk_max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(
+            ("memory_hits", "disk_hits", "misses", "evictions", "disk_evictions"), 0)
+        self._disk_bytes = 0
+        if disk_dir and os.path.isdir(disk_dir):
+            self._disk_bytes = sum(e.stat().st_size for e in self._entries())
+
+    def _disk_path(self, key):
+        # Bare keys are PDFs; derived entries (thumbnails) carry their own extension
+        return os.path.join(self.disk_dir, key if os.path.splitext(key)[1] else f"{key}.pdf")
+
+    def _entries(self):
+        return [e for e in os.scandir(self.disk_dir) if not e.name.endswith(".tmp")]
+
+    def get(self, key):
+        """PDF bytes for key, or None"""
+        with self._lock:
+            pdf = self._memory.get(key)
+            if pdf is not None:
+                self._memory.move_to_end(key)
+                self._counts["memory_hits"] += 1
+                return pdf
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    pdf = f.read()
+                os.utime(path)  # disk eviction is least-recently-used by mtime
+            except OSError:
+                pdf = None
+            if pdf is not None:
+                self._remember(key, pdf)
+                self._count("disk_hits")
+                return pdf
+        self._count("misses")
+        return None
+
+    def put(self, key, pdf):
+        self._remember(key, pdf)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                return
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp, path)
+            with self._lock:
+                self._disk_bytes += len(pdf)
+                over = self._disk_bytes > self.disk_max_bytes
+            if over:
+                self._evict_disk()
+
+    def _remember(self, key, pdf):
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._memory[key] = pdf
+            self._bytes += len(pdf)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._counts["evictions"] += 1
+
+    def _evict_disk(self):
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime_ns)
+        total = sum(e.stat().st_size for e in entries)
+        # Evict down to 90% so a full store does not rescan on every put
+        for entry in entries:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.unlink(entry.path)
+            except OSError:
+                continue
+            total -= size
+            self._count("disk_evictions")
+        with self._lock:
+            self._disk_bytes = total
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._bytes = 0
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for entry in self._entries():
+                os.unlink(entry.path)
+            self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update(entries=len(self._memory), bytes=self._bytes, disk_bytes=self._disk_bytes)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else None
+        return stats
+
+
+RENDER_CACHE = RenderCache()
+
+
+def render_cached(doc_type, data=None, cache=None, quality=None, context=None):
+    """render_pdf through the render cache; returns (pdf bytes, key, hit)"""
+    cache = cache or RENDER_CACHE
+    try:
+        key = render_key(doc_type, data, quality, context=context)
+    except TypeError:  # streamed items: nothing to look up or store
+        return render_pdf(doc_type, data=data, quality=quality, context=context), None, False
+    pdf = cache.get(key)
+    if pdf is not None:
+        return pdf, key, True
+    pdf = render_pdf(doc_type, data=data, quality=quality, context=context)
+    cache.put(key, pdf)
+    return pdf, key, False
+
+
+# ─── THUMBNAILS ─────────────────────────────────────────────────
+THUMBNAIL_FORMATS = ("png", "webp")
+
+
+def rasterise_thumbnail(pdf, width=240, fmt="png"):
+    """Page 1 of a PDF as PNG/WebP bytes, width pixels wide (needs PyMuPDF)"""
+    import pymupdf  # optional, only used for thumbnails
+    from PIL import Image
+
+    if fmt not in THUMBNAIL_FORMATS:
+        raise ValueError(f"unknown thumbnail format {fmt!r} (expected one of {', '.join(THUMBNAIL_FORMATS)})")
+    page = pymupdf.open(stream=pdf, filetype="pdf")[0]
+    zoom = width / page.rect.width
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+    if fmt == "png":
+        return pix.tobytes("png")
+    buf = io.BytesIO()
+    Image.frombytes("RGB", (pix.width, pix.height), pix.samples).save(buf, "WEBP", quality=80, method=4)
+    return buf.getvalue()
+
+
+def thumbnail_key(key, width=240, fmt="png"):
+    """Cache key of a thumbnail: the PDF's content key plus size and format"""
+    return f"{key}.w{width}.{fmt}"
+
+
+def thumbnail_cached(doc_type, data=None, width=240, fmt="png", cache=None, quality=None, context=None):
+    """Page-1 thumbnail, cached under the PDF's content key; returns (image bytes, key, hit).
+
+    On a miss the same drawing calls are replayed with assets resampled to
+    twice the thumbnail's resolution, which rasterises about twice as fast
+    as the full-resolution PDF and is indistinguishable at this size.
+    """
+    cache = cache or RENDER_CACHE
+    try:
+        key = render_key(doc_type, data, quality, context=context)
+    except TypeError:  # streamed items: rendered uncached (see render_key)
+        key = None
+    thumb = cache.get(thumbnail_key(key, width, fmt)) if key else None
+    if thumb is not None:
+        return thumb, key, True
+    dpi = max(36, math.ceil(2 * width / (W / 72)))
+    pdf = render_pdf(doc_type, data=data, quality=quality, profile={"dpi": dpi, "jpeg_quality": 80},
+                     context=context)
+    thumb = rasterise_thumbnail(pdf, width, fmt)
+    if key:
+        cache.put(thumbnail_key(key, width, fmt), thumb)
+    return thumb, key, False
+
+
+# ─── STAMPING (INCREMENTAL UPDATES) ─────────────────────────────
+# Marks added after a document is issued (« Acquittée » + date, the company
+# cachet, BROUILLON / ANNULÉ) are appended to the archived PDF as an incremental
+# update: new objects, revised page dictionaries and a new xref section after
+# the original %%EOF. Nothing is re-rendered and the archived bytes stay an
+# unchanged prefix of the result, so archivedPdfHash still verifies against
+# them (see pdf_revisions).
+CACHET = os.path.join(ASSET_DIR, "cachet.png")
+CACHET_SIZE = 44 * mm  # same stamp as drawCachet in the web layout
+CACHET_OPACITY = 0.85
+CACHET_ROTATION = 7  # degrees, counter-clockwise
+CACHET_DPI = 200
+CACHET_DEFAULT_CENTER = (47.5 * mm, 65 * mm)  # vendor box of a one-page facture
+PAID_MENTION_POS = (25 * mm, 31 * mm)  # just above create_facture's placeholder line
+VENDOR_LABEL = "Cachet et signature du vendeur"
+STAMP_WATERMARKS = {  # watermark -> (text, colour)
+    "brouillon": ("BROUILLON", GRAY),
+    "annule": ("ANNULÉ", "#B3261E"),
+}
+STAMP_WATERMARK_OPACITY = 0.25
+
+PdfRef = namedtuple("PdfRef", "num gen")
+
+_PDF_DELIM = rb"\x00\t\n\x0c\r ()<>\[\]{}/%"
+_PDF_SKIP = re.compile(rb"(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*")
+_PDF_REF = re.compile(rb"(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?![^" + _PDF_DELIM + rb"])")
+_PDF_TOKEN = re.compile(rb"<<|>>|\[|\]|<[0-9A-Fa-f\x00\t\n\x0c\r ]*>|/[^" + _PDF_DELIM + rb"]*|[^" + _PDF_DELIM + rb"]+")
+_PDF_OBJ = re.compile(rb"(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj")
+_PDF_XREF_ENTRY = re.compile(rb"[\x00\t\n\x0c\r ]*(\d{10}) (\d{5}) ([nf])")
+_PDF_XREF_SECTION = re.compile(rb"[\x00\t\n\x0c\r ]*(\d+) (\d+)")
+
+
+def _pdf_string(buf, pos):
+    # Literal string: balanced parentheses, backslash escapes
+    depth, i = 0, pos
+    while i < len(buf):
+        ch = buf[i]
+        if ch == 0x5C:
+            i += 2
+            continue
+        if ch == 0x28:
+            depth += 1
+        elif ch == 0x29:
+            depth -= 1
+            if not depth:
+                return bytes(buf[pos:i + 1]), i + 1
+        i += 1
+    raise ValueError(f"unterminated PDF string at byte {pos}")
+
+
+def pdf_parse(buf, pos=0):
+    """Parse one PDF object at buf[pos:]; returns (value, end).
+
+    Dictionaries and arrays become dict / list, indirect references PdfRef, and
+    every other token (names, numbers, strings) is kept as its raw bytes, so
+    pdf_serialise writes unchanged values back exactly.
+    """
+    pos = _PDF_SKIP.match(buf, pos).end()
+    ref = _PDF_REF.match(buf, pos)
+    if ref:
+        return PdfRef(int(ref[1]), int(ref[2])), ref.end()
+    if buf[pos:pos + 1] == b"(":
+        return _pdf_string(buf, pos)
+    token = _PDF_TOKEN.match(buf, pos)
+    if token is None or token[0] in (b">>", b"]"):
+        raise ValueError(f"unexpected PDF syntax at byte {pos}")
+    pos = token.end()
+    if token[0] == b"<<":
+        value = {}
+        while True:
+            pos = _PDF_SKIP.match(buf, pos).end()
+            if buf[pos:pos + 2] == b">>":
+                return value, pos + 2
+            key, pos = pdf_parse(buf, pos)
+            value[key], pos = pdf_parse(buf, pos)
+    if token[0] == b"[":
+        value = []
+        while True:
+            pos = _PDF_SKIP.match(buf, pos).end()
+            if buf[pos:pos + 1] == b"]":
+                return value, pos + 1
+            item, pos = pdf_parse(buf, pos)
+            value.append(item)
+    return bytes(token[0]), pos
+
+
+def pdf_serialise(value):
+    """Inverse of pdf_parse"""
+    if isinstance(value, dict):
+        return b"<< " + b" ".join(key + b" " + pdf_serialise(item) for key, item in value.items()) + b" >>"
+    if isinstance(value, list):
+        return b"[ " + b" ".join(map(pdf_serialise, value)) + b" ]"
+    if isinstance(value, PdfRef):
+        return b"%d %d R" % value
+    return value
+
+
+class PdfIndex:
+    """Cross-reference index of a PDF with classic xref tables (as ReportLab
+    writes them, and stamp_update appends them).
+
+    Only the xref sections, the trailer and the objects asked for are parsed,
+    so opening an mmap of a large archive reads a few KB of it.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        tail = buf.rfind(b"startxref", max(0, len(buf) - 1024))
+        if tail < 0:
+            raise ValueError("not a PDF: no startxref in the last 1024 bytes")
+        self.startxref = int(pdf_parse(buf, tail + 9)[0])
+        self.offsets = {}  # object number -> (offset, generation) of its latest revision
+        self.xrefs = []  # xref section offsets, newest first
+        self.trailer = None
+        offset = self.startxref
+        while offset is not None:
+            if offset in self.xrefs:
+                raise ValueError("xref /Prev chain loops")
+            self.xrefs.append(offset)
+            trailer = self._read_xref(offset)
+            self.trailer = self.trailer or trailer
+            offset = int(trailer[b"/Prev"]) if b"/Prev" in trailer else None
+
+    def _read_xref(self, offset):
+        buf = self.buf
+        pos = _PDF_SKIP.match(buf, offset).end()
+        if buf[pos:pos + 4] != b"xref":
+            raise ValueError(f"no xref table at byte {offset} (cross-reference streams are not supported)")
+        pos += 4
+        while True:
+            section = _PDF_XREF_SECTION.match(buf, pos)
+            if section is None:
+                break
+            start, count = int(section[1]), int(section[2])
+            pos = section.end()
+            for num in range(start, start + count):
+                entry = _PDF_XREF_ENTRY.match(buf, pos)
+                if entry is None:
+                    raise ValueError(f"bad xref entry at byte {pos}")
+                pos = entry.end()
+                # Newer sections are read first and win
+                if num not in self.offsets:
+                    self.offsets[num] = (int(entry[1]), int(entry[2])) if entry[3] == b"n" else None
+        pos = _PDF_SKIP.match(buf, pos).end()
+        if buf[pos:pos + 7] != b"trailer":
+            raise ValueError(f"no trailer after the xref table at byte {offset}")
+        return pdf_parse(buf, pos + 7)[0]
+
+    def _locate(self, ref):
+        located = self.offsets.get(ref.num)
+        if located is None or located[1] != ref.gen:
+            raise ValueError(f"object {ref.num} {ref.gen} R is not in the xref table")
+        head = _PDF_OBJ.match(self.buf, _PDF_SKIP.match(self.buf, located[0]).end())
+        if head is None or int(head[1]) != ref.num:
+            raise ValueError(f"xref offset of object {ref.num} does not point at it")
+        return head.end()
+
+    def object(self, ref):
+        """The parsed object ref points at (a stream's dictionary, for streams)"""
+        return pdf_parse(self.buf, self._locate(ref))[0]
+
+    def resolve(self, value):
+        return self.object(value) if isinstance(value, PdfRef) else value
+
+    def stream(self, ref):
+        """Decoded data of a stream object, or None under a filter other than Flate"""
+        head, pos = pdf_parse(self.buf, self._locate(ref))
+        pos = _PDF_SKIP.match(self.buf, pos).end()
+        if self.buf[pos:pos + 6] != b"stream":
+            raise ValueError(f"object {ref.num} is not a stream")
+        pos += 6
+        pos += 2 if self.buf[pos:pos + 2] == b"\r\n" else 1
+        data = bytes(self.buf[pos:pos + int(self.resolve(head[b"/Length"]))])
+        filters = self.resolve(head.get(b"/Filter", []))
+        filters = filters if isinstance(filters, list) else [filters]
+        for name in filters:
+            if name != b"/FlateDecode":
+                return None
+            data = zlib.decompress(data)
+        return data
+
+    def pages(self, last_only=False):
+        """[(ref, page dictionary, inherited /Resources or None)] in page order;
+        last_only descends straight to the last page without reading the others"""
+        pages = []
+
+        def walk(ref, resources, depth):
+            node = self.object(ref)
+            resources = node.get(b"/Resources", resources)
+            if node.get(b"/Type") != b"/Pages":
+                pages.append((ref, node, resources))
+            elif depth < 64:
+                kids = self.resolve(node[b"/Kids"])
+                for kid in kids[-1:] if last_only else kids:
+                    walk(kid, resources, depth + 1)
+
+        root = self.resolve(self.trailer[b"/Root"])
+        walk(root[b"/Pages"], None, 0)
+        return pages
+
+    def revisions(self):
+        """Byte length of each revision, oldest first: the original document is
+        buf[:revisions()[0]], each incremental update extends it"""
+        ends = []
+        for offset in reversed(self.xrefs):
+            eof = self.buf.find(b"%%EOF", offset)
+            if eof < 0:
+                raise ValueError(f"no %%EOF after the xref table at byte {offset}")
+            end = eof + 5
+            end += 2 if self.buf[end:end + 2] == b"\r\n" else self.buf[end:end + 1] in (b"\r", b"\n")
+            ends.append(end)
+        return ends
+
+
+def pdf_revisions(pdf):
+    """Byte length of each revision of pdf, oldest first (see PdfIndex.revisions).
+
+    hashlib.sha256(pdf[:pdf_revisions(pdf)[0]]) is the archivedPdfHash of a
+    stamped document.
+    """
+    return PdfIndex(pdf).revisions()
+
+
+@functools.lru_cache(maxsize=8)
+def _cachet_image(path, mtime_ns, pixels):
+    # (width, height, JPEG colour data, Flate alpha data), resampled to at most pixels wide
+    from PIL import Image
+
+    with Image.open(path) as im:
+        im = im.convert("RGBA")
+    if im.width > pixels:
+        im = im.resize((pixels, round(im.height * pixels / im.width)), Image.LANCZOS)
+    rgb = io.BytesIO()
+    im.convert("RGB").save(rgb, "JPEG", quality=85)
+    return im.width, im.height, rgb.getvalue(), zlib.compress(im.getchannel("A").tobytes(), 9)
+
+
+def cachet_image(path=CACHET, size=CACHET_SIZE, dpi=CACHET_DPI):
+    """The cachet encoded for stamping at size points wide, memoized per file version"""
+    return _cachet_image(path, os.stat(path).st_mtime_ns, math.ceil(size / 72 * dpi))
+
+
+def _pdf_text(text):
+    return b"(" + text.encode("cp1252").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def _pdf_rgb(colour):
+    return " ".join(f"{int(colour[i:i + 2], 16) / 255:.4g}" for i in (1, 3, 5))
+
+
+def _vendor_box_center(index, page):
+    # Centre of the vendor signature box drawn by draw_signature_section, found
+    # from its label in the page's content; None when the page has no such box
+    contents = index.resolve(page.get(b"/Contents", []))
+    label = re.escape(_pdf_text(VENDOR_LABEL))
+    for ref in contents if isinstance(contents, list) else [page[b"/Contents"]]:
+        data = index.stream(ref)
+        found = data and re.search(rb"1 0 0 1 ([-\d.]+) ([-\d.]+) Tm " + label, data)
+        if found:
+            # The label sits at the box's top left corner; the box is 55 x (18 mm - 3)
+            x, y = float(found[1]), float(found[2])
+            return x + 55 * mm / 2, y - 18 * mm + (18 * mm - 3) / 2
+    return None
+
+
+@stage("stamp")
+def stamp_update(pdf, paid_date=None, cachet=False, watermark=None, cachet_center=None,
+                 cachet_path=CACHET):
+    """Incremental update stamping an issued PDF; returns the bytes to append to it.
+
+    paid_date adds « Acquittée le <date> » and cachet the company seal to the
+    last page (over the vendor signature box when it can be found, else at
+    cachet_center or CACHET_DEFAULT_CENTER); watermark ("brouillon" / "annule")
+    marks every page. pdf may be bytes or an mmap; only its xref, trailer, the
+    dictionaries of the pages stamped and the last page's content are read, and
+    the update holds the new objects, a revision of each page dictionary stamped
+    and an xref section.
+    """
+    if watermark is not None and watermark not in STAMP_WATERMARKS:
+        raise ValueError(f"unknown watermark {watermark!r} (expected one of {', '.join(STAMP_WATERMARKS)})")
+    if paid_date is None and not cachet and watermark is None:
+        raise ValueError("nothing to stamp: give paid_date, cachet or watermark")
+    if hasattr(paid_date, "strftime"):
+        paid_date = paid_date.strftime("%d/%m/%Y")
+    index = PdfIndex(pdf)
+    pages = index.pages(last_only=watermark is None)
+    size = int(index.trailer[b"/Size"])
+    tag = f"/TatcheStamp{len(index.xrefs)}"  # resource names unique to this revision
+    objects = []  # (number, generation, body) of every object in the update
+
+    def add(body, ref=None):
+        ref = ref or PdfRef(size + sum(num >= size for num, _, _ in objects), 0)
+        objects.append((*ref, body))
+        return ref
+
+    def add_stream(data, head=None):
+        return add(pdf_serialise({**(head or {}), b"/Length": b"%d" % len(data)})
+                   + b"\nstream\n" + data + b"\nendstream")
+
+    fonts, xobjects, states = {}, {}, {}
+    if watermark is not None or paid_date is not None:
+        fonts[(tag + "F").encode()] = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold "
+                                          b"/Encoding /WinAnsiEncoding >>")
+    page_marks = last_marks = b""
+    if watermark is not None:
+        text, colour = STAMP_WATERMARKS[watermark]
+        states[(tag + "W").encode()] = {b"/ca": b"%g" % STAMP_WATERMARK_OPACITY}
+        box = index.resolve(pages[0][1].get(b"/MediaBox", [b"0", b"0", b"%g" % W, b"%g" % H]))
+        x0, y0, x1, y1 = (float(index.resolve(v)) for v in box)
+        font_size = min(110, 0.75 * math.hypot(x1 - x0, y1 - y0) / string_width(text, "Helvetica-Bold", 1))
+        width = string_width(text, "Helvetica-Bold", font_size)
+        angle = math.atan2(y1 - y0, x1 - x0)
+        cos, sin = math.cos(angle), math.sin(angle)
+        page_marks = (f"q {tag}W gs {_pdf_rgb(colour)} rg BT {tag}F {font_size:.2f} Tf "
+                      f"{cos:.4f} {sin:.4f} {-sin:.4f} {cos:.4f} {(x0 + x1) / 2:.2f} {(y0 + y1) / 2:.2f} Tm "
+                      f"{-width / 2:.2f} {-font_size * 0.35:.2f} Td ").encode() + _pdf_text(text) + b" Tj ET Q\n"
+    if paid_date is not None:
+        x, y = PAID_MENTION_POS
+        last_marks += (f"q {_pdf_rgb(BROWN_DARK)} rg BT {tag}F 10 Tf 1 0 0 1 {x:.2f} {y:.2f} Tm ").encode() \
+            + _pdf_text(f"Acquittée le {paid_date}") + b" Tj ET Q\n"
+    if cachet:
+        width, height, rgb, alpha = cachet_image(cachet_path)
+        image = {b"/Type": b"/XObject", b"/Subtype": b"/Image", b"/Width": b"%d" % width,
+                 b"/Height": b"%d" % height, b"/BitsPerComponent": b"8"}
+        smask = add_stream(alpha, {**image, b"/ColorSpace": b"/DeviceGray", b"/Filter": b"/FlateDecode"})
+        xobjects[(tag + "C").encode()] = add_stream(rgb, {**image, b"/ColorSpace": b"/DeviceRGB",
+                                                          b"/Filter": b"/DCTDecode", b"/SMask": smask})
+        states[(tag + "C").encode()] = {b"/ca": b"%g" % CACHET_OPACITY}
+        cx, cy = cachet_center or _vendor_box_center(index, pages[-1][1]) or CACHET_DEFAULT_CENTER
+        w, h = CACHET_SIZE, CACHET_SIZE * height / width
+        cos, sin = math.cos(math.radians(CACHET_ROTATION)), math.sin(math.radians(CACHET_ROTATION))
+        last_marks += (f"q {tag}C gs {cos:.4f} {sin:.4f} {-sin:.4f} {cos:.4f} {cx:.2f} {cy:.2f} cm "
+                       f"{w:.2f} 0 0 {h:.2f} {-w / 2:.2f} {-h / 2:.2f} cm {tag}C Do Q\n").encode()
+
+    # The original content runs inside q ... Q so the stamp starts from the
+    # default graphics state whatever the page leaves behind
+    save = add_stream(b"q\n")
+    restore = add_stream(b"Q\n" + page_marks) if page_marks else None
+    for i, (ref, page, resources) in enumerate(pages):
+        last = i == len(pages) - 1
+        if not (page_marks or last):
+            continue
+        contents = page.get(b"/Contents")
+        if isinstance(contents, PdfRef) and isinstance(index.object(contents), list):
+            contents = index.object(contents)
+        contents = contents if isinstance(contents, list) else [contents] if contents else []
+        resources = {key: index.resolve(value) for key, value in (index.resolve(resources) or {}).items()}
+        for key, entries in ((b"/Font", fonts), (b"/XObject", xobjects), (b"/ExtGState", states)):
+            if entries:
+                resources[key] = {**(resources.get(key) or {}), **entries}
+        marks = add_stream(b"Q\n" + page_marks + last_marks) if last else restore
+        add(pdf_serialise({**page, b"/Contents": [save, *contents, marks], b"/Resources": resources}), ref)
+
+    # The objects, an xref section for them (one subsection per run of
+    # consecutive numbers) and a trailer chaining to the previous section
+    update = bytearray(b"" if pdf[-1:] == b"\n" else b"\n")
+    entries = {}
+    for num, gen, body in objects:
+        entries[num] = b"%010d %05d n \n" % (len(pdf) + len(update), gen)
+        update += b"%d %d obj\n" % (num, gen) + body + b"\nendobj\n"
+    xref = len(pdf) + len(update)
+    update += b"xref\n"
+    runs = []
+    for num in sorted(entries):
+        if runs and runs[-1][-1] == num - 1:
+            runs[-1].append(num)
+        else:
+            runs.append([num])
+    for run in runs:
+        update += b"%d %d\n" % (run[0], len(run)) + b"".join(entries[num] for num in run)
+    trailer = {b"/Size": b"%d" % max(size, runs[-1][-1] + 1), b"/Root": index.trailer[b"/Root"],
+               b"/Prev": b"%d" % index.startxref}
+    if b"/Info" in index.trailer:
+        trailer[b"/Info"] = index.trailer[b"/Info"]
+    original_id = index.trailer.get(b"/ID", [b"<>"])[0]
+    trailer[b"/ID"] = [original_id, b"<" + hashlib.md5(update).hexdigest().encode() + b">"]
+    update += b"trailer\n" + pdf_serialise(trailer) + b"\nstartxref\n%d\n%%%%EOF\n" % xref
+    return bytes(update)
+
+
+def stamp_pdf(pdf, **stamp):
+    """pdf with a stamp_update appended"""
+    return bytes(pdf) + stamp_update(pdf, **stamp)
+
+
+def stamp_file(path, out=None, **stamp):
+    """Stamp the PDF at path, appending in place (or writing out); returns the
+    update's size. In place, the file is mapped rather than read, and only the
+    update is written."""
+    import mmap
+    import shutil
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        update = stamp_update(buf, **stamp)
+    if out is not None and os.path.abspath(out) != os.path.abspath(path):
+        shutil.copyfile(path, out)
+        path = out
+    with open(path, "ab") as f:
+        f.write(update)
+    return len(update)
+
+
+# ─── LETTERHEAD OVERLAY ─────────────────────────────────────────
+# The branded page (wood background and watermark, header block, footer and
+# frame) only changes with the company settings and assets, yet every page of
+# every document redraws and re-serialises it. In overlay mode a canvas draws
+# the variable content only, leaving the static layers as empty forms, and
+# _finish_document splices in the forms of a letterhead rendered once per
+# settings version (kept in RENDER_CACHE under letterhead_key).
+LETTERHEAD_OVERLAY = False  # see use_letterhead_overlay
+LETTERHEAD_LAYERS = {  # form name -> what it draws
+    "TatchePageUnderlay": _underlay,
+    "TatchePageHeader": _header,
+    "TatchePageOverlay": _overlay,
+}
+_LETTERHEADS = OrderedDict()  # letterhead_key -> LetterheadLayers, most recent last
+_letterheads_lock = threading.Lock()
+
+
+def use_letterhead_overlay(enabled=True):
+    """Render documents as their variable content over the cached letterhead
+    (same pages, a fraction of the drawing and serialising)"""
+    global LETTERHEAD_OVERLAY
+    LETTERHEAD_OVERLAY = enabled
+
+
+def letterhead_key(context):
+    """Content address of a context's letterhead layers: company, theme, page
+    assets, generator version, quality and profile (see render_key)"""
+    return "letterhead-" + render_key("papier_entete", {"layers": list(LETTERHEAD_LAYERS)}, context=context)
+
+
+def render_letterhead_layers(context):
+    """One-page PDF whose page draws every LETTERHEAD_LAYERS form"""
+    c = new_canvas(context=context)
+    for name, draw in LETTERHEAD_LAYERS.items():
+        _draw_static_layer(c, name, draw)
+    c.showPage()
+    return c.getpdfdata()
+
+
+def _pdf_refs(value):
+    # Every PdfRef inside a parsed value
+    if isinstance(value, PdfRef):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _pdf_refs(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _pdf_refs(item)
+
+
+def _pdf_renumber(value, numbers):
+    if isinstance(value, PdfRef):
+        return PdfRef(numbers[value.num], 0)
+    if isinstance(value, dict):
+        return {key: _pdf_renumber(item, numbers) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_pdf_renumber(item, numbers) for item in value]
+    return value
+
+
+def _pdf_object_spans(index):
+    # Object number -> (start, end) of "N G obj ... endobj" in a single-revision PDF
+    starts = sorted((offset, num) for num, (offset, _gen) in
+                    ((num, located) for num, located in index.offsets.items() if located))
+    ends = [offset for offset, _ in starts[1:]] + [index.startxref]
+    return {num: (start, end) for (start, num), end in zip(starts, ends)}
+
+
+def _form_name(name):
+    return b"/FormXob." + name.encode()
+
+
+class LetterheadLayers:
+    """The letterhead's layer forms with every object they use, parsed once so
+    overlay_letterhead only renumbers a few dictionaries per document"""
+
+    def __init__(self, pdf):
+        index = PdfIndex(pdf)
+        (_, _page, resources), = index.pages()
+        xobjects = index.resolve(index.resolve(resources)[b"/XObject"])
+        self.forms = {_form_name(name): xobjects[_form_name(name)].num for name in LETTERHEAD_LAYERS}
+        spans = _pdf_object_spans(index)
+        self.objects = {}  # number -> (parsed dictionary, rest of the object: stream and endobj)
+        self.uses = {}  # form name -> numbers of the objects it needs, itself first
+        for name, num in self.forms.items():
+            uses, todo = [], [num]
+            while todo:
+                num = todo.pop(0)
+                if num in uses:
+                    continue
+                uses.append(num)
+                if num not in self.objects:
+                    start, end = spans[num]
+                    body = pdf[_PDF_OBJ.match(pdf, start).end():end]
+                    head, pos = pdf_parse(body)
+                    self.objects[num] = (head, body[pos:])
+                todo.extend(ref.num for ref in _pdf_refs(self.objects[num][0]))
+            self.uses[name] = uses
+
+    def object_chunks(self, num, numbers):
+        """Object num renumbered into a document, as chunks (the stream is not copied)"""
+        head, rest = self.objects[num]
+        return b"%d 0 obj\n" % numbers[num] + pdf_serialise(_pdf_renumber(head, numbers)), rest
+
+
+def letterhead_layers(context):
+    """LetterheadLayers for a context: rendered once per settings version
+    (RENDER_CACHE keeps it across processes), parsed once per process"""
+    context = context.replace(overlay=False)
+    key = letterhead_key(context)
+    with _letterheads_lock:
+        layers = _LETTERHEADS.get(key)
+        if layers is not None:
+            _LETTERHEADS.move_to_end(key)
+            return layers
+    pdf = RENDER_CACHE.get(key)
+    if pdf is None:
+        pdf = render_letterhead_layers(context)
+        RENDER_CACHE.put(key, pdf)
+    layers = LetterheadLayers(pdf)
+    with _letterheads_lock:
+        _LETTERHEADS[key] = layers
+        while len(_LETTERHEADS) > 8:
+            _LETTERHEADS.popitem(last=False)
+    return layers
+
+
+def overlay_letterhead(pdf, layers):
+    """Put the letterhead's layers into an overlay-mode document: each empty
+    layer form becomes the letterhead's (same object number), the objects the
+    forms use are appended, and the xref is rebuilt. The document's own objects
+    and trailer are copied byte for byte."""
+    index = PdfIndex(pdf)
+    numbers = {}  # letterhead object -> its number in the document
+    for _, _page, resources in index.pages():
+        xobjects = index.resolve(index.resolve(resources or {}).get(b"/XObject", {}))
+        for name, num in layers.forms.items():
+            if name in xobjects:
+                numbers[num] = xobjects[name].num
+    size = int(index.trailer[b"/Size"])
+    for name, num in layers.forms.items():
+        if num in numbers:
+            for used in layers.uses[name]:
+                if used not in numbers:
+                    numbers[used] = size
+                    size += 1
+    replaced = {numbers[num]: num for num in layers.forms.values() if num in numbers}
+
+    # Collected as chunks (views of pdf, the letterhead's stream bytes) and
+    # joined once: the images are copied a single time
+    view = memoryview(pdf)
+    spans = _pdf_object_spans(index)
+    chunks = [view[:min(start for start, _ in spans.values())]]
+    offsets, pos = {}, len(chunks[0])
+
+    def emit(num, parts):
+        nonlocal pos
+        offsets[num] = pos
+        chunks.extend(parts)
+        pos += sum(map(len, parts))
+
+    for num, (start, end) in sorted(spans.items(), key=lambda span: span[1]):
+        emit(num, layers.object_chunks(replaced[num], numbers) if num in replaced else (view[start:end],))
+    for num, new in numbers.items():
+        if new not in offsets:
+            emit(new, layers.object_chunks(num, numbers))
+    chunks.append(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+    chunks.extend(b"%010d 00000 n \n" % offsets[num] if num in offsets else b"0000000000 65535 f \n"
+                  for num in range(1, size))
+    trailer = pdf[pdf.index(b"trailer", index.startxref):pdf.rindex(b"startxref")]
+    chunks.append(re.sub(rb"/Size \d+", b"/Size %d" % size, trailer, count=1) + b"startxref\n%d\n%%%%EOF\n" % pos)
+    return b"".join(chunks)
+
+
+def benchmark_overlay(runs=10, lines=(15, 100, 1000), check=True):
+    """Full path against overlay mode on every document type (and factures of
+    several lengths): warm wall / CPU time per render, size, and with PyMuPDF
+    whether the pages rasterise the same. Returns True when overlay mode is
+    faster overall and every checked page matches."""
+    def timed(name, data, overlay):
+        context = RenderContext(overlay=overlay)
+        pdf = render_pdf(name, data=data, context=context)  # warm: assets, letterhead
+        wall, cpu = time.perf_counter(), time.process_time()
+        for _ in range(runs):
+            render_pdf(name, data=data, context=context)
+        return pdf, (time.perf_counter() - wall) / runs, (time.process_time() - cpu) / runs
+
+    def same_pages(a, b):
+        try:
+            import pymupdf  # optional, only used for the raster check
+        except ImportError:
+            return None
+        pages_a = pymupdf.open(stream=a, filetype="pdf")
+        pages_b = pymupdf.open(stream=b, filetype="pdf")
+        return len(pages_a) == len(pages_b) and all(
+            x.get_pixmap(dpi=50).samples == y.get_pixmap(dpi=50).samples for x, y in zip(pages_a, pages_b))
+
+    cases = [(name, None) for name in DOCUMENT_BUILDERS]
+    cases += [("facture", {"items": synthetic_items(n)}) for n in lines]
+    print(f"{'Document':<26}{'Full':>10}{'CPU':>10}{'Overlay':>10}{'CPU':>10}{'Speed-up':>10}"
+          f"{'Size full':>11}{'Size ovl':>10}  Pages")
+    totals = [0.0, 0.0]
+    ok = True
+    for name, data in cases:
+        full, full_wall, full_cpu = timed(name, data, False)
+        over, over_wall, over_cpu = timed(name, data, True)
+        totals[0] += full_wall
+        totals[1] += over_wall
+        same = same_pages(full, over) if check else None
+        ok &= same is not False
+        label = name if data is None else f"{name} ({len(data['items'])} lines)"
+        print(f"{label:<26}{full_wall * 1000:>7.1f} ms{full_cpu * 1000:>7.1f} ms{over_wall * 1000:>7.1f} ms"
+              f"{over_cpu * 1000:>7.1f} ms{full_wall / over_wall:>9.1f}x{len(full) / 1024:>8.0f} KB"
+              f"{len(over) / 1024:>7.0f} KB  {'n/a' if same is None else 'same' if same else 'DIFFER'}")
+    print(f"total: {totals[0] * 1000:.1f} ms full, {totals[1] * 1000:.1f} ms overlay "
+          f"({totals[0] / totals[1]:.1f}x)")
+    return ok and totals[1] < totals[0]
+
+
+# ─── CRM PAYLOADS ───────────────────────────────────────────────
+# CRMDocument.type -> builder; attachement/situation have no CRM type yet and
+# can be requested by builder name directly
+CRM_DOCUMENT_TYPES = {
+    "FACTURE": "facture",
+    "FACTURE_ACOMPTE": "facture",
+    "AVOIR": "facture",
+    "DEVIS": "devis",
+    "BON_COMMANDE": "devis",
+    "BON_LIVRAISON": "bon_livraison",
+    "PV_RECEPTION": "fin_travaux",
+}
+
+
+def _number(value):
+    """Prisma Decimal (serialised as a string) -> int when whole, else float"""
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _crm_date(value):
+    """ISO DateTime from the API -> dd/mm/YYYY as printed on the documents"""
+    if not value:
+        return "__/__/____"
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00")).strftime("%d/%m/%Y")
+
+
+class InvalidDocument(ValueError):
+    """A payload or document data that cannot be rendered; errors lists why"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def crm_document_to_job(doc):
+    """Map a CRMDocument JSON payload (with its items) to (builder name, data);
+    raises InvalidDocument naming the fields it lacks"""
+    doc_type = CRM_DOCUMENT_TYPES.get(doc["type"], doc["type"])
+    if doc_type not in DOCUMENT_BUILDERS:
+        raise ValueError(f"unknown document type {doc['type']!r}")
+    delivery = doc_type == "bon_livraison" and doc.get("deliveryAddress")
+    client = {
+        "name": doc.get("clientName") or "",
+        "address": (doc.get("deliveryAddress") if delivery else doc.get("clientAddress")) or "",
+        "city": (doc.get("deliveryCity") if delivery else doc.get("clientCity")) or "",
+    }
+    if doc.get("clientIce"):
+        client["ice"] = doc["clientIce"]
+    if not isinstance(doc.get("items", []), list) or not all(isinstance(it, dict) for it in doc.get("items", [])):
+        raise InvalidDocument(["items: expected a list of objects"])
+    items = []
+    for item in sorted(doc.get("items", []), key=lambda it: it.get("order", 0)):
+        items.append({
+            "desc": item.get("designation"),
+            "description": item.get("description") or "",
+            "unit": item.get("unit") or "U",
+            "qty": None if item.get("quantity") is None else _number(item["quantity"]),
+            "price": float(item.get("unitPriceHT", 0)),
+        })
+    data = {
+        "number": doc.get("draftNumber") if doc.get("isDraft") and doc.get("draftNumber") else doc.get("number"),
+        "date": _crm_date(doc.get("date")),
+        "client": client,
+        "items": items,
+    }
+    if items and doc["items"][0].get("tvaRate") is not None:
+        data["tva_rate"] = float(doc["items"][0]["tvaRate"]) / 100
+    errors = validate_document_data(doc_type, data)
+    if errors:
+        raise InvalidDocument(errors)
+    return doc_type, data
+
+
+def payload_to_job(payload):
+    """Accept either a CRMDocument ({"type": "FACTURE", "items": [...], ...})
+    or a plain job ({"type": "facture", "data": {...}})"""
+    if not isinstance(payload, dict):
+        raise InvalidDocument(["request body must be a JSON object"])
+    if "type" not in payload:
+        raise InvalidDocument(["type: missing"])
+    if "data" in payload or payload.get("type") in DOCUMENT_BUILDERS:
+        return payload["type"], payload.get("data")
+    return crm_document_to_job(payload)
+
+
+def load_document_data(path, doc_type=None):
+    """(type, data) from a JSON file or '-' (stdin) holding a builder's data dict,
+    a {"type", "data"} job or a CRMDocument. A type named in the file must match
+    doc_type; a bare data dict needs doc_type."""
+    text = sys.stdin.read() if path == "-" else open(path, encoding="utf-8").read()
+    payload = json.loads(text)
+    if isinstance(payload, dict) and "type" in payload:
+        payload_type, data = payload_to_job(payload)
+        if doc_type and payload_type != doc_type:
+            raise ValueError(f"holds a {payload_type}, not a {doc_type}")
+        return payload_type, data
+    if doc_type is None:
+        raise ValueError("holds no document type; name one")
+    return doc_type, payload
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _type_error(field, value, expected):
+    return f"{field}: missing" if value is None else f"{field}: expected {expected}"
+
+
+def validate_document_data(doc_type, data):
+    """Problems that would stop (or garble) a render of data; empty if it is fine"""
+    if doc_type not in DOCUMENT_BUILDERS:
+        return [f"unknown document type {doc_type!r}"]
+    if data is None:
+        return []
+    if not isinstance(data, dict):
+        return ["data: expected a JSON object"]
+    errors = [_type_error(field, data[field], "a string") for field in ("number", "date")
+              if field in data and not isinstance(data[field], str)]
+    client = data.get("client", {})
+    if not isinstance(client, dict):
+        errors.append("client: expected an object")
+    else:
+        errors += [f"client.{field}: expected a string" for field, value in client.items()
+                   if not isinstance(value, str)]
+    if "tva_rate" in data and not (_is_number(data["tva_rate"]) and 0 <= data["tva_rate"] <= 1):
+        errors.append("tva_rate: expected a number between 0 and 1 (0.20 for 20%)")
+    items = data.get("items", [])
+    if not isinstance(items, list):
+        return errors + ["items: expected a list"]
+    priced = doc_type != "bon_livraison"
+    for i, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            errors.append(f"items[{i}]: expected an object")
+            continue
+        if not isinstance(item.get("desc"), str):
+            errors.append(_type_error(f"items[{i}].desc", item.get("desc"), "a string"))
+        for field in ("qty", "price") if priced else ("qty",):
+            if not _is_number(item.get(field)):
+                errors.append(_type_error(f"items[{i}].{field}", item.get(field), "a number"))
+        for field in ("description", "unit"):
+            if field in item and not isinstance(item[field], str):
+                errors.append(f"items[{i}].{field}: expected a string")
+    return errors
+
+
+# ─── RENDER DAEMON ──────────────────────────────────────────────
+def asset_fingerprint(assets=None):
+    """(path, mtime, size) of every branding asset (of an AssetPaths, default
+    the module's); changes when one is replaced"""
+    fingerprint = []
+    for path in (assets or ASSET_DRAW_SIZES):
+        try:
+            st = os.stat(path)
+            fingerprint.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+class RenderDaemon:
+    """Long-running renderer: a pool of warm worker processes behind a small HTTP API.
+
+    POST /render  CRMDocument or {"type", "data"} JSON -> application/pdf
+                  (?quality=draft for admin previews, ?profile=email&max_bytes=N)
+                  (X-Render-Key: content address, X-Cache: hit|miss);
+                  400 {"error", "errors"} for a body that is not a valid document
+    GET  /health  liveness, worker count, asset generation
+    GET  /metrics request counts, latency percentiles and cache stats (JSON)
+
+    Identical requests are answered from the render cache without touching
+    the pool; pass cache=None to always render.
+
+    Assets are polled every watch_interval seconds (or reloaded on SIGHUP);
+    a new pool is warmed before it replaces the old one, whose in-flight
+    requests are allowed to finish.
+    """
+
+    def __init__(self, workers=None, timeout=30.0, asset_dpi=None, flat_background=None,
+                 watch_interval=2.0, cache=RENDER_CACHE):
+        self.workers = workers or os.cpu_count()
+        self.cache = cache
+        self.timeout = timeout
+        self.watch_interval = watch_interval
+        self._initargs = (asset_dpi, flat_background, DETERMINISTIC, LETTERHEAD_OVERLAY)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=2048)
+        self._counts = {"requests": 0, "ok": 0, "errors": 0, "timeouts": 0, "reloads": 0}
+        self._fingerprint = asset_fingerprint()
+        # Cache keys are computed here, so mirror the workers' asset options
+        apply_asset_options(asset_dpi, flat_background)
+        self._pool = self._start_pool()
+        self.generation = 1
+        self.started = time.time()
+        self._stop = threading.Event()
+
+    def _start_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(self.workers, initializer=_warm_worker, initargs=self._initargs)
+        # Wait until every worker has run the initializer before taking traffic
+        for future in [pool.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def render(self, payload, quality="final", profile=None, max_bytes=None):
+        """Render one payload (cache first, then a worker); returns (pdf, key, hit) or raises"""
+        from concurrent.futures.process import BrokenProcessPool
+
+        start = time.perf_counter()
+        with self._lock:
+            self._counts["requests"] += 1
+            pool = self._pool
+        try:
+            doc_type, data = payload_to_job(payload)
+            errors = validate_document_data(doc_type, data)
+            if errors:
+                raise InvalidDocument(errors)
+            if quality not in QUALITIES:
+                raise ValueError(f"unknown quality {quality!r}")
+            key = render_key(doc_type, data, quality, profile, max_bytes) if self.cache else None
+        except Exception:
+            self._count("errors")
+            raise
+        pdf = self.cache.get(key) if self.cache else None
+        if pdf is not None:
+            self._done(start)
+            return pdf, key, True
+        try:
+            job = {"id": 0, "type": doc_type, "data": data, "quality": quality,
+                   "profile": profile, "max_bytes": max_bytes}
+            result = pool.submit(_render_job, job).result(self.timeout)
+        except TimeoutError:
+            self._count("timeouts")
+            raise
+        except BrokenProcessPool:
+            self._count("errors")
+            self.reload()
+            raise
+        if not result["ok"]:
+            self._count("errors")
+            raise RuntimeError(result["error"])
+        if self.cache:
+            self.cache.put(key, result["pdf"])
+        self._done(start)
+        return result["pdf"], key, False
+
+    def _done(self, start):
+        with self._lock:
+            self._counts["ok"] += 1
+            self._latencies.append(time.perf_counter() - start)
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def reload(self):
+        """Swap in a freshly warmed pool (assets re-read from disk)"""
+        invalidate_assets()
+        apply_asset_options(*self._initargs[:2])
+        new_pool = self._start_pool()
+        with self._lock:
+            old_pool, self._pool = self._pool, new_pool
+            self._fingerprint = asset_fingerprint()
+            self.generation += 1
+            self._counts["reloads"] += 1
+        old_pool.shutdown(wait=False)
+
+    def _watch(self):
+        while not self._stop.wait(self.watch_interval):
+            if asset_fingerprint() != self._fingerprint:
+                self.reload()
+
+    def health(self):
+        return {"status": "ok", "workers": self.workers, "generation": self.generation,
+                "uptime": round(time.time() - self.started, 1)}
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = dict(self._counts)
+        for q in (50, 95, 99):
+            value = percentile(latencies, q) if latencies else None
+            metrics[f"p{q}_ms"] = round(value * 1000, 2) if value is not None else None
+        metrics["generation"] = self.generation
+        if self.cache:
+            metrics["cache"] = self.cache.stats()
+        return metrics
+
+    def serve(self, host="127.0.0.1", port=8765, socket_path=None):
+        """Serve until interrupted, on a Unix socket if given, else localhost HTTP"""
+        import signal
+        import socketserver
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        handler = type("DaemonHandler", (_DaemonHandler, BaseHTTPRequestHandler), {})
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = UnixHTTPServer(socket_path, handler)
+        else:
+            server = ThreadingHTTPServer((host, port), handler)
+        server.renderer = self
+        if self.watch_interval:
+            threading.Thread(target=self._watch, daemon=True).start()
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=self.reload).start())
+        try:
+            server.serve_forever()
+        finally:
+            self._stop.set()
+            server.server_close()
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class _DaemonHandler:
+    """RenderDaemon's HTTP endpoints, mixed into BaseHTTPRequestHandler by serve()"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, self.server.renderer.health())
+        elif self.path == "/metrics":
+            self._send(200, self.server.renderer.metrics())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        from urllib.parse import parse_qs
+
+        path, _, query = self.path.partition("?")
+        if path != "/render":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            params = {k: v[0] for k, v in parse_qs(query).items()}
+            max_bytes = int(params["max_bytes"]) if "max_bytes" in params else None
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            pdf, key, hit = self.server.renderer.render(payload, params.get("quality", "final"),
+                                                        params.get("profile"), max_bytes)
+        except TimeoutError:
+            self._send(504, {"error": "render timed out"})
+        except InvalidDocument as exc:
+            self._send(400, {"error": str(exc), "errors": exc.errors})
+        except (ValueError, KeyError, TypeError) as exc:
+            self._send(400, {"error": f"{type(exc).__name__}: {exc}"})
+        except Exception as exc:
+            self._send(500, {"error": str(exc)})
+        else:
+            headers = {"X-Cache": "hit" if hit else "miss"}
+            if key:
+                headers["X-Render-Key"] = key
+            self._send(200, pdf, "application/pdf", headers)
+
+    def address_string(self):
+        # Unix socket peers have no (host, port)
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ─── ASYNC RENDERING ────────────────────────────────────────────
+class QueueFull(RuntimeError):
+    """AsyncRenderer.render's fast rejection: max_queue renders are already waiting"""
+
+
+# Scheduling classes, most urgent first: admin previews ("View PDF") before
+# month-end batches
+RENDER_PRIORITIES = ("interactive", "bulk")
+# Documents up to this many lines are hashed on the event loop (a fraction of
+# a millisecond); longer ones in a thread, where they cannot hold up the loop
+INLINE_KEY_LINES = 200
+
+
+class _ScheduledRender:
+    """One render known to an AsyncRenderer, queued or running, shared by every
+    request for the same document (render_key)"""
+
+    __slots__ = ("key", "args", "priority", "future", "waiters", "queued_at")
+
+    def __init__(self, key, args, priority, future):
+        self.key = key
+        self.args = args
+        self.priority = priority
+        self.future = future
+        self.waiters = 1
+        self.queued_at = time.perf_counter()
+
+
+class AsyncRenderer:
+    """asyncio front end to the builders: ``await renderer.render(document)``
+    runs the blocking render on a thread pool, so the event loop keeps serving.
+
+    At most max_in_flight renders run at once; up to max_queue more wait for
+    a slot (None: no limit), and a render asked for while the queue is full
+    fails at once with QueueFull, so a burst costs one exception per excess
+    request rather than memory and latency for all. timeout (per render,
+    overridable per call) covers the wait and the render and raises
+    TimeoutError. A render cancelled or timed out while queued just gives up
+    its place; one already running keeps its slot until the thread finishes
+    (threads cannot be interrupted) and its PDF is dropped.
+
+    Each render has a priority (RENDER_PRIORITIES). A free slot goes to the
+    oldest interactive render, except that bulk renders, when waiting, get
+    at least one slot in every bulk_every + 1, so a stream of previews
+    cannot starve a batch. reserved slots are kept for interactive renders
+    (bulk never holds more than max_in_flight - reserved), so a preview
+    waits for at most a render in progress, not a batch.
+
+    Requests for a document already queued or running (same render_key)
+    join it instead of rendering it again; an interactive request promotes
+    a queued bulk render. Renders use context (a RenderContext, default the
+    module settings when the renderer is built), which is what lets them run
+    side by side in threads; the render cache is consulted in threads too,
+    and long documents are hashed there (INLINE_KEY_LINES), so the loop never
+    serialises a large document. Pass cache=None to always render. The
+    bookkeeping lives on the event loop: use one renderer per loop.
+    """
+
+    def __init__(self, max_in_flight=None, max_queue=64, timeout=30.0, context=None, cache=RENDER_CACHE,
+                 reserved=None, bulk_every=4):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.max_in_flight = max_in_flight or os.cpu_count()
+        if reserved is None:
+            reserved = max(1, self.max_in_flight // 4) if self.max_in_flight > 1 else 0
+        if not 0 <= reserved < self.max_in_flight:
+            raise ValueError(f"reserved must leave bulk renders a slot (0 <= reserved < {self.max_in_flight})")
+        self.reserved = reserved
+        self.bulk_every = bulk_every
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.context = context or RenderContext()
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(self.max_in_flight, thread_name_prefix="render")
+        self._waiting = {priority: deque() for priority in RENDER_PRIORITIES}
+        self._running = dict.fromkeys(RENDER_PRIORITIES, 0)
+        self._renders = {}  # render_key (else a unique token) -> _ScheduledRender, queued or running
+        self._since_bulk = 0  # interactive dispatches while bulk renders waited
+        self._waits = {priority: deque(maxlen=2048) for priority in RENDER_PRIORITIES}
+        self._latencies = {priority: deque(maxlen=2048) for priority in RENDER_PRIORITIES}
+        self._counts = {"requests": 0, "ok": 0, "errors": 0, "timeouts": 0, "cancelled": 0,
+                        "rejected": 0, "cache_hits": 0, "deduplicated": 0, "max_queued": 0}
+        self._class_counts = {priority: {"requests": 0, "ok": 0} for priority in RENDER_PRIORITIES}
+
+    def _queued(self):
+        return sum(len(waiting) for waiting in self._waiting.values())
+
+    def _full(self):
+        return (self.max_queue is not None
+                and self._queued() + sum(self._running.values()) >= self.max_in_flight + self.max_queue)
+
+    async def render(self, document, quality=None, profile=None, timeout=None, priority="interactive"):
+        """Render a CRMDocument or {"type", "data"} job and return its PDF bytes.
+        Raises QueueFull, TimeoutError, or whatever the render raised."""
+        import asyncio
+
+        start = time.perf_counter()
+        self._counts["requests"] += 1
+        try:
+            if priority not in RENDER_PRIORITIES:
+                raise ValueError(f"unknown priority {priority!r} (expected one of {', '.join(RENDER_PRIORITIES)})")
+            doc_type, data = payload_to_job(document)
+        except Exception:
+            self._counts["errors"] += 1
+            raise
+        self._class_counts[priority]["requests"] += 1
+        if self._full():
+            # Decided before the first await, so a burst scheduled in one go is
+            # counted render by render (duplicates too: telling them apart
+            # would mean hashing every rejected document)
+            self._counts["rejected"] += 1
+            raise QueueFull(f"{self._queued()} renders already queued (max_queue={self.max_queue})")
+        job = None
+        try:
+            async with asyncio.timeout(self.timeout if timeout is None else timeout):
+                key = await self._key(doc_type, data, quality, profile)
+                job = self._schedule(key, (doc_type, data, quality, profile), priority)
+                pdf, hit = await asyncio.shield(job.future)
+        except QueueFull:
+            raise
+        except TimeoutError:
+            self._counts["timeouts"] += 1
+            raise
+        except asyncio.CancelledError:
+            self._counts["cancelled"] += 1
+            raise
+        except Exception:
+            self._counts["errors"] += 1
+            raise
+        finally:
+            if job is not None and not job.future.done():
+                self._leave(job)
+        self._counts["ok"] += 1
+        self._counts["cache_hits"] += hit
+        self._class_counts[priority]["ok"] += 1
+        self._latencies[priority].append(time.perf_counter() - start)
+        return pdf
+
+    async def _key(self, doc_type, data, quality, profile):
+        # render_key, or None for a document without one: streamed items (any
+        # iterable, consumed once by the render) or other data that isn't JSON
+        import asyncio
+        from collections.abc import Sized
+
+        items = (data or {}).get("items") or ()
+        if not isinstance(items, Sized):
+            return None
+        args = (doc_type, data, quality, profile, None, self.context)
+        try:
+            if len(items) <= INLINE_KEY_LINES:
+                return render_key(*args)
+            return await asyncio.to_thread(render_key, *args)
+        except TypeError:
+            return None
+
+    def _schedule(self, key, args, priority):
+        # Join the render of the same document if there is one, else queue a
+        # new one (a document without a key is never merged nor cached)
+        import asyncio
+
+        if key is None:
+            key = object()
+        job = self._renders.get(key)
+        if job is not None:
+            job.waiters += 1
+            self._counts["deduplicated"] += 1
+            urgent = RENDER_PRIORITIES.index(priority) < RENDER_PRIORITIES.index(job.priority)
+            if urgent and job in self._waiting[job.priority]:
+                self._waiting[job.priority].remove(job)
+                self._waiting[priority].append(job)
+                job.priority = priority
+            return job
+        if self._full():
+            self._counts["rejected"] += 1
+            raise QueueFull(f"{self._queued()} renders already queued (max_queue={self.max_queue})")
+        job = self._renders[key] = _ScheduledRender(key, args, priority, asyncio.get_running_loop().create_future())
+        self._waiting[priority].append(job)
+        self._counts["max_queued"] = max(self._counts["max_queued"], self._queued())
+        self._dispatch()
+        return job
+
+    def _leave(self, job):
+        # A request gave up; a queued render nobody waits for any more is dropped
+        job.waiters -= 1
+        if not job.waiters and job in self._waiting[job.priority]:
+            self._waiting[job.priority].remove(job)
+            del self._renders[job.key]
+            job.future.cancel()
+
+    def _next_priority(self):
+        """Class of the render to start in a free slot, None if none may start"""
+        if sum(self._running.values()) >= self.max_in_flight:
+            return None
+        interactive, bulk = (self._waiting[priority] for priority in RENDER_PRIORITIES)
+        bulk_ok = bulk and self._running["bulk"] < self.max_in_flight - self.reserved
+        if interactive and not (bulk_ok and self._since_bulk >= self.bulk_every):
+            return "interactive"
+        return "bulk" if bulk_ok else None
+
+    def _dispatch(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while (priority := self._next_priority()) is not None:
+            job = self._waiting[priority].popleft()
+            if priority == "bulk":
+                self._since_bulk = 0
+            elif self._waiting["bulk"]:
+                self._since_bulk += 1
+            self._waits[priority].append(time.perf_counter() - job.queued_at)
+            self._running[priority] += 1
+            future = self._executor.submit(self._render, job.key, *job.args)
+            # Completion is handled on the loop, whoever is still waiting for it
+            future.add_done_callback(lambda done, job=job: self._call_soon(loop, self._finished, job, done))
+
+    def _render(self, key, doc_type, data, quality, profile):
+        # Worker thread: cache lookup, render, cache store
+        cache = self.cache if isinstance(key, str) else None
+        pdf = cache.get(key) if cache else None
+        if pdf is not None:
+            return pdf, True
+        pdf = render_pdf(doc_type, data=data, quality=quality, profile=profile, context=self.context)
+        if cache:
+            cache.put(key, pdf)
+        return pdf, False
+
+    @staticmethod
+    def _call_soon(loop, callback, *args):
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass  # loop already closed: nothing left to release
+
+    def _finished(self, job, done):
+        self._running[job.priority] -= 1
+        del self._renders[job.key]
+        if job.waiters and not job.future.done():
+            if done.cancelled():  # close() dropped it before it started
+                job.future.cancel()
+            elif done.exception() is not None:
+                job.future.set_exception(done.exception())
+            else:
+                job.future.set_result(done.result())
+        self._dispatch()
+
+    def stats(self):
+        """Counters, current queue depth and renders in flight, and per class
+        the same plus wait / total latency percentiles in ms over its last
+        2048 renders"""
+        stats = dict(self._counts, queued=self._queued(), in_flight=sum(self._running.values()),
+                     max_in_flight=self.max_in_flight, reserved=self.reserved, max_queue=self.max_queue)
+        for priority in RENDER_PRIORITIES:
+            cls = dict(self._class_counts[priority], queued=len(self._waiting[priority]),
+                       in_flight=self._running[priority])
+            for name, values in (("wait", self._waits[priority]), ("latency", self._latencies[priority])):
+                values = sorted(values)
+                for q in (50, 95, 99):
+                    cls[f"{name}_p{q}_ms"] = round(percentile(values, q) * 1000, 2) if values else None
+            stats[priority] = cls
+        return stats
+
+    def close(self, wait=True):
+        """Stop the worker threads; renders not started yet are cancelled"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close(wait=False)
+
+
+def benchmark_async(burst=500, max_in_flight=None, max_queue=64, timeout=30.0, doc_type="facture"):
+    """Fire burst concurrent renders at an AsyncRenderer (cache off, so every
+    accepted one renders), once with max_queue and once unbounded; report what
+    was served, rejected and timed out, wait / latency percentiles, the event
+    loop's worst stall (a 10 ms ticker's lateness) and, on Linux, how far the
+    resident memory rose during the burst. PDFs are dropped as they arrive,
+    as a server would after sending them. Returns the two stats dicts."""
+    import asyncio
+
+    data = {"date": "31/03/2026"}
+    render_pdf(doc_type, data=data)  # warm: assets, font metrics
+
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return None
+
+    async def burst_once(queue):
+        lag, base = 0.0, rss()
+        peak = base
+
+        async def ticker():
+            nonlocal lag, peak
+            while True:
+                tick = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag = max(lag, time.perf_counter() - tick - 0.01)
+                peak = base and max(peak, rss())
+
+        async def request(renderer, i):
+            # Numbered so the renderer does not merge them into one render
+            return len(await renderer.render({"type": doc_type, "data": dict(data, number=f"B-{i:04d}")}))
+
+        async with AsyncRenderer(max_in_flight, queue, timeout, cache=None) as renderer:
+            watch = asyncio.create_task(ticker())
+            start = time.perf_counter()
+            await asyncio.gather(*(request(renderer, i) for i in range(burst)), return_exceptions=True)
+            wall = time.perf_counter() - start
+            watch.cancel()
+            stats = renderer.stats()
+        stats.update(wall_s=round(wall, 2), loop_lag_ms=round(lag * 1000, 1),
+                     rss_growth_mb=round((peak - base) / 2 ** 20, 1) if base else None)
+        return stats
+
+    print(f"{burst} concurrent {doc_type} renders, {max_in_flight or os.cpu_count()} in flight")
+    print(f"{'Queue':>9}{'OK':>6}{'Rejected':>10}{'Timeouts':>10}{'Wall':>9}{'p50':>10}{'p95':>10}"
+          f"{'Wait p95':>11}{'Loop lag':>11}{'RSS +':>9}")
+    reports = []
+    for queue in (max_queue, None):
+        stats = asyncio.run(burst_once(queue))
+        reports.append(stats)
+        cls = stats["interactive"]  # every request is a preview here
+        print(f"{queue if queue is not None else 'none':>9}{stats['ok']:>6}{stats['rejected']:>10}"
+              f"{stats['timeouts']:>10}{stats['wall_s']:>7.1f} s"
+              f"{cls['latency_p50_ms'] or 0:>7.0f} ms{cls['latency_p95_ms'] or 0:>7.0f} ms"
+              f"{cls['wait_p95_ms'] or 0:>8.0f} ms{stats['loop_lag_ms']:>8.1f} ms"
+              f"{stats['rss_growth_mb'] or 0:>6.0f} MB")
+    return reports
+
+
+def benchmark_priority(bulk=200, previews=20, interval=0.1, max_in_flight=None, bulk_type="situation_travaux"):
+    """Month-end scenario: a batch of bulk_type renders is queued at once and,
+    while it runs, an admin opens a facture preview every interval seconds,
+    one of them from five tabs at once. Run with every request in one class
+    (first come, first served) and then with the previews interactive; prints
+    per-class latency, the batch's duration and the renders saved by
+    deduplication. Returns the two stats dicts."""
+    import asyncio
+
+    render_pdf(bulk_type)  # warm: assets, font metrics
+    render_pdf("facture")
+
+    async def scenario(preview_priority):
+        async with AsyncRenderer(max_in_flight, max_queue=None, cache=None) as renderer:
+            start = time.perf_counter()
+            batch = asyncio.gather(*(renderer.render({"type": bulk_type, "data": {"number": f"S-{i:04d}"}},
+                                                     priority="bulk") for i in range(bulk)))
+            opened = []
+            for i in range(previews):
+                await asyncio.sleep(interval)
+                job = {"type": "facture", "data": {"number": f"F-{i:04d}"}}
+                tabs = 5 if i == previews // 2 else 1
+                opened += [asyncio.ensure_future(renderer.render(job, priority=preview_priority))
+                           for _ in range(tabs)]
+            await asyncio.gather(*opened)
+            await batch
+            stats = renderer.stats()
+        stats["batch_s"] = round(time.perf_counter() - start, 2)
+        return stats
+
+    print(f"{bulk} x {bulk_type} (bulk) + {previews} facture previews every {interval * 1000:.0f} ms, "
+          f"{max_in_flight or os.cpu_count()} in flight")
+    print(f"{'Previews as':<14}{'Class':<13}{'Renders':>8}{'p50':>10}{'p95':>10}{'Wait p95':>11}"
+          f"{'Batch':>9}{'Merged':>8}")
+    reports = []
+    for preview_priority in ("bulk", "interactive"):
+        stats = asyncio.run(scenario(preview_priority))
+        reports.append(stats)
+        for priority in RENDER_PRIORITIES:
+            cls = stats[priority]
+            if not cls["requests"]:
+                continue
+            print(f"{preview_priority:<14}{priority:<13}{cls['ok']:>8}{cls['latency_p50_ms']:>7.0f} ms"
+                  f"{cls['latency_p95_ms']:>7.0f} ms{cls['wait_p95_ms']:>8.0f} ms"
+                  f"{stats['batch_s']:>7.1f} s{stats['deduplicated']:>8}")
+    return reports
+
+
+def main(argv=None):
+    """generate-docs command line; ReportLab is only imported by commands that render.
+
+    "generate-docs" is only the program name shown by argparse: there is no
+    package or console script, run this file directly.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="generate-docs", description="LE TATCHE BOIS document generator")
+    parser.add_argument("--asset-dpi", type=int, default=None,
+                        help="use assets resampled to this print resolution (e.g. 150 or 300)")
+    parser.add_argument("--flat-background", type=int, default=None, metavar="DPI",
+                        help="draw one pre-composited opaque background at this resolution")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="byte-reproducible output (dates from the document date, content-derived ID)")
+    parser.add_argument("--overlay", action="store_true",
+                        help="draw only the variable content and merge it onto the cached letterhead")
+    parser.add_argument("--stages", default=None, metavar="FILE",
+                        help="time each draw stage in this process: .prom Prometheus text, "
+                             ".folded flamegraph stacks, '-' table on stderr, else JSON lines")
+    parser.add_argument("--cprofile", default=None, metavar="FILE",
+                        help="write cProfile stats (snakeviz, flameprof or gprof2dot for a flamegraph)")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("generate", help="generate all document templates (default)")
+    doc = argparse.ArgumentParser(add_help=False)
+    doc.add_argument("--data", default=None,
+                     help="JSON file ('-' for stdin): the document data, a {type, data} job or a CRMDocument")
+    doc.add_argument("--out", default=None, help="output PDF, '-' for stdout (default: the template in OUTPUT_DIR)")
+    doc.add_argument("--quality", default="final", choices=QUALITIES)
+    doc.add_argument("--profile", default=None, choices=list(OUTPUT_PROFILES), help="output profile")
+    for name, label in DOCUMENT_LABELS.items():
+        sub.add_parser(name, parents=[doc], help=f"render one {label.lower()}")
+    sub.add_parser("list", help="list the document types")
+    val = sub.add_parser("validate", help="check a document data file without rendering")
+    val.add_argument("type", nargs="?", default=None, choices=list(DOCUMENT_BUILDERS),
+                     help="document type (default: the one named in the file)")
+    val.add_argument("--data", required=True, help="JSON file, '-' for stdin")
+    imp = sub.add_parser("check-import-time", help="check the CLI's start-up imports with python -X importtime")
+    imp.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    opt = sub.add_parser("optimise-assets", help="build print-size asset variants")
+    opt.add_argument("--dpi", type=int, default=150)
+    opt.add_argument("--jpeg-quality", type=int, default=85)
+    opt.add_argument("--report", action="store_true",
+                     help="compare PDF size and render time before/after for each document")
+    bench = sub.add_parser("bench-table", help="benchmark the items table paginator")
+    bench.add_argument("--lines", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    bench.add_argument("--long", action="store_true", help="use long, wrapping designations")
+    rp = sub.add_parser("render-profile", help="render one document with an output profile and report it")
+    rp.add_argument("type", choices=list(DOCUMENT_BUILDERS))
+    rp.add_argument("--profile", default="email", choices=list(OUTPUT_PROFILES))
+    rp.add_argument("--max-bytes", type=int, default=None, help="byte budget (default: the profile's)")
+    rp.add_argument("--data", default=None, help="JSON file with the document data or a CRMDocument")
+    rp.add_argument("--out", default=None)
+    bs = sub.add_parser("bench", help="benchmark every document type over line count, "
+                                      "designation length and asset profile; save a JSON baseline")
+    bs.add_argument("--types", nargs="+", default=None, choices=list(DOCUMENT_BUILDERS))
+    bs.add_argument("--lines", type=int, nargs="+", default=list(BENCH_LINES))
+    bs.add_argument("--designations", nargs="+", default=list(BENCH_DESIGNATIONS), choices=list(BENCH_DESIGNATIONS))
+    bs.add_argument("--profiles", nargs="+", default=list(BENCH_PROFILES), choices=list(BENCH_PROFILES))
+    bs.add_argument("--runs", type=int, default=20, help="warm renders per case (at least 3)")
+    bs.add_argument("--max-seconds", type=float, default=5.0, help="time budget for the warm renders of a case")
+    bs.add_argument("--out", default=None, help="write the results to this JSON file")
+    bs.add_argument("--compare", default=None, metavar="BASELINE", help="compare against a saved baseline")
+    bs.add_argument("--threshold", type=float, default=0.10, help="regression threshold (0.10 = 10%%)")
+    bc = sub.add_parser("bench-compare", help="compare two benchmark JSON files; exit 1 on regressions")
+    bc.add_argument("baseline")
+    bc.add_argument("current")
+    bc.add_argument("--threshold", type=float, default=0.10)
+    bo = sub.add_parser("bench-overlay", help="compare overlay mode with the full render on every document")
+    bo.add_argument("--runs", type=int, default=10)
+    bo.add_argument("--lines", type=int, nargs="+", default=[15, 100, 1000], help="facture lengths to add")
+    bo.add_argument("--no-check", action="store_true", help="skip the raster comparison (PyMuPDF)")
+    bt = sub.add_parser("bench-threads", help="render on thread pools with separate contexts (correctness + throughput)")
+    bt.add_argument("--runs", type=int, default=24)
+    bt.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    bt.add_argument("--no-check", action="store_true", help="skip the concurrent byte-for-byte check")
+    ba = sub.add_parser("bench-async", help="burst of concurrent renders through the asyncio API")
+    ba.add_argument("--burst", type=int, default=500)
+    ba.add_argument("--in-flight", type=int, default=None, help="renders running at once (default: CPU count)")
+    ba.add_argument("--queue", type=int, default=64, help="renders allowed to wait before rejecting")
+    ba.add_argument("--timeout", type=float, default=30.0, help="per-render timeout in seconds")
+    ba.add_argument("--type", default="facture", choices=list(DOCUMENT_BUILDERS))
+    bp = sub.add_parser("bench-priority", help="admin previews during a month-end batch, with and without priorities")
+    bp.add_argument("--bulk", type=int, default=200, help="bulk renders queued at once")
+    bp.add_argument("--previews", type=int, default=20, help="interactive previews opened during the batch")
+    bp.add_argument("--interval", type=float, default=0.1, help="seconds between previews")
+    bp.add_argument("--in-flight", type=int, default=None, help="renders running at once (default: CPU count)")
+    bq = sub.add_parser("bench-quality", help="compare final and draft rendering on every document")
+    bq.add_argument("--runs", type=int, default=10)
+    sm = sub.add_parser("check-streaming", help="check the items table works in flat memory (tracemalloc)")
+    sm.add_argument("--lines", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    chk = sub.add_parser("check-flat-background",
+                         help="raster-diff the flattened background against the layered one")
+    chk.add_argument("--dpi", type=int, default=150)
+    chk.add_argument("--tolerance", type=int, default=8)
+    bat = sub.add_parser("batch", help="render a list of document jobs over a process pool")
+    bat.add_argument("jobs", nargs="?", default=None,
+                     help="JSON array or JSON Lines of {type, data, id, filename}; '-' for stdin")
+    bat.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    bat.add_argument("--out-dir", default=OUTPUT_DIR)
+    bat.add_argument("--synthetic", type=int, default=0, metavar="N",
+                     help="instead of a job file, render N sample factures (for scaling tests)")
+    bat.add_argument("--thumbnail", type=int, default=None, metavar="WIDTH",
+                     help="also write a page-1 PNG thumbnail next to each PDF")
+    th = sub.add_parser("thumbnails", help="backfill page-1 thumbnails for a job list over a process pool")
+    th.add_argument("jobs", nargs="?", default=None, help="same job file format as batch")
+    th.add_argument("--width", type=int, default=240)
+    th.add_argument("--format", default="png", choices=THUMBNAIL_FORMATS)
+    th.add_argument("--workers", type=int, default=None)
+    th.add_argument("--out-dir", default=OUTPUT_DIR)
+    th.add_argument("--synthetic", type=int, default=0, metavar="N")
+    srv = sub.add_parser("serve", help="run the render daemon (HTTP on localhost or a Unix socket)")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8765)
+    srv.add_argument("--socket", default=None, help="listen on this Unix socket instead of TCP")
+    srv.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    srv.add_argument("--timeout", type=float, default=30.0, help="per-request render timeout (s)")
+    srv.add_argument("--watch-interval", type=float, default=2.0,
+                     help="seconds between asset change checks (0 disables; SIGHUP always reloads)")
+    srv.add_argument("--cache-mb", type=int, default=128, help="in-memory render cache budget (MB)")
+    srv.add_argument("--cache-dir", default=RENDER_CACHE_DIR, help="on-disk render cache ('' disables)")
+    srv.add_argument("--cache-disk-mb", type=int, default=1024, help="on-disk render cache budget (MB)")
+    srv.add_argument("--no-cache", action="store_true", help="always render")
+    exp = sub.add_parser("export", help="render a job list into one PDF with shared images and bookmarks")
+    exp.add_argument("jobs", help="JSON array or JSON Lines of jobs / CRMDocuments; '-' for stdin")
+    exp.add_argument("--out", default=os.path.join(OUTPUT_DIR, "export.pdf"))
+    exp.add_argument("--compare", action="store_true",
+                     help="also render the documents separately and report the combined size")
+    st = sub.add_parser("stamp", help="append « Acquittée », the cachet or a watermark to an issued PDF "
+                                      "as an incremental update")
+    st.add_argument("pdf")
+    st.add_argument("--out", default=None, help="write the stamped PDF here (default: append to PDF in place)")
+    st.add_argument("--paid", default=None, metavar="DATE", help="add « Acquittée le DATE » to the last page")
+    st.add_argument("--cachet", action="store_true", help="add the company cachet to the last page")
+    st.add_argument("--cachet-at", type=float, nargs=2, default=None, metavar=("X_MM", "Y_MM"),
+                    help="cachet centre (default: the vendor signature box)")
+    st.add_argument("--watermark", default=None, choices=list(STAMP_WATERMARKS), help="mark every page")
+    det = sub.add_parser("check-deterministic",
+                         help="render repeatedly (and in a fresh process) and compare SHA-256 hashes")
+    det.add_argument("--runs", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    use_deterministic_output(args.deterministic)
+    use_letterhead_overlay(args.overlay)
+    if args.stages:
+        import atexit
+        stages = StageRecorder()
+        use_stage_hook(stages)
+        atexit.register(stages.write, args.stages)
+    if args.cprofile:
+        import atexit
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(lambda: (profiler.disable(), profiler.dump_stats(args.cprofile)))
+        profiler.enable()
+    if args.command == "list":
+        for name, label in DOCUMENT_LABELS.items():
+            print(f"{name:<20}{label:<24}{'items' if name in ITEM_DOCUMENTS else ''}")
+        raise SystemExit(0)
+    if args.command == "validate":
+        try:
+            doc_type, data = load_document_data(args.data, args.type)
+        except (OSError, ValueError, KeyError) as exc:
+            parser.exit(1, f"{args.data}: {exc}\n")
+        errors = validate_document_data(doc_type, data)
+        for error in errors:
+            print(f"{args.data}: {error}")
+        if not errors:
+            print(f"{args.data}: valid {doc_type} ({len((data or {}).get('items', []))} items)")
+        raise SystemExit(1 if errors else 0)
+    if args.command == "check-import-time":
+        raise SystemExit(0 if check_import_time(args.budget_ms) else 1)
+    if args.command in DOCUMENT_BUILDERS:
+        data = None
+        if args.data:
+            try:
+                _, data = load_document_data(args.data, args.command)
+            except (OSError, ValueError, KeyError) as exc:
+                parser.exit(1, f"{args.data}: {exc}\n")
+            errors = validate_document_data(args.command, data)
+            if errors:
+                parser.exit(1, "".join(f"{args.data}: {error}\n" for error in errors))
+        apply_asset_options(args.asset_dpi, args.flat_background)
+        if args.out is None:
+            path = DOCUMENT_BUILDERS[args.command](data=data, quality=args.quality, profile=args.profile)
+            print(path, file=sys.stderr)
+        elif args.out == "-":
+            sys.stdout.buffer.write(render_pdf(args.command, data=data, quality=args.quality, profile=args.profile))
+        else:
+            with open(args.out, "wb") as f:
+                render_pdf(args.command, output=f, data=data, quality=args.quality, profile=args.profile)
+        raise SystemExit(0)
+    # Commands exit through SystemExit, so the reports are written at exit
+    if args.command == "optimise-assets":
+        if args.report:
+            report_asset_optimisation(args.dpi, args.jpeg_quality)
+        else:
+            for src, variant in optimise_assets(args.dpi, args.jpeg_quality).items():
+                print(f"{os.path.basename(src):<22} -> {variant} ({os.path.getsize(variant) / 1024:.0f} KB)")
+        raise SystemExit(0)
+    if args.command == "bench-table":
+        benchmark_items_table(args.lines, LONG_DESIGNATION if args.long else None)
+        raise SystemExit(0)
+    if args.command == "bench":
+        cases = benchmark_cases(args.types, args.lines, args.designations, args.profiles)
+        report = run_benchmarks(cases, args.runs, args.max_seconds, args.asset_dpi, args.flat_background)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        regressions = []
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                regressions = compare_benchmarks(json.load(f), report, args.threshold)
+        raise SystemExit(1 if regressions else 0)
+    if args.command == "bench-compare":
+        with open(args.baseline, encoding="utf-8") as f, open(args.current, encoding="utf-8") as g:
+            raise SystemExit(1 if compare_benchmarks(json.load(f), json.load(g), args.threshold) else 0)
+    if args.command == "check-streaming":
+        raise SystemExit(0 if check_streaming_memory(args.lines) else 1)
+    if args.command == "export":
+        apply_asset_options(args.asset_dpi, args.flat_background)
+        jobs = load_batch_jobs(args.jobs)
+        start = time.perf_counter()
+        pdf = export_bulk(jobs, output=io.BytesIO())
+        elapsed = time.perf_counter() - start
+        with open(args.out, "wb") as f:
+            f.write(pdf)
+        pages = pdf_page_count(pdf)
+        print(f"{len(jobs)} documents, {pages} pages -> {args.out} "
+              f"({len(pdf) / 1024:.0f} KB, {elapsed:.2f} s)")
+        if args.compare:
+            separate = sum(len(render_pdf(doc_type, data=data)) for doc_type, data in map(payload_to_job, jobs))
+            print(f"separate files: {separate / 1024:.0f} KB ({separate / len(pdf):.1f}x)")
+        raise SystemExit(0)
+    if args.command == "stamp":
+        center = (args.cachet_at[0] * mm, args.cachet_at[1] * mm) if args.cachet_at else None
+        try:
+            size = stamp_file(args.pdf, args.out, paid_date=args.paid, cachet=args.cachet,
+                              watermark=args.watermark, cachet_center=center)
+        except (OSError, ValueError) as exc:
+            parser.exit(1, f"{args.pdf}: {exc}\n")
+        path = args.out or args.pdf
+        with open(path, "rb") as f:
+            pdf = f.read()
+        revisions = pdf_revisions(pdf)
+        original = hashlib.sha256(pdf[:revisions[0]]).hexdigest()
+        print(json.dumps({"path": path, "update_bytes": size, "revisions": len(revisions),
+                          "original_sha256": original}))
+        raise SystemExit(0)
+    if args.command == "check-deterministic":
+        raise SystemExit(0 if check_deterministic(args.runs) else 1)
+    if args.command == "render-profile":
+        data = None
+        if args.data:
+            _, data = load_document_data(args.data, args.type)
+        report = render_profile(args.type, data, args.profile, args.max_bytes)
+        out = args.out or os.path.join(OUTPUT_DIR, f"{args.type}_{args.profile}.pdf")
+        with open(out, "wb") as f:
+            f.write(report.pop("pdf"))
+        print(json.dumps(dict(report, path=out)))
+        raise SystemExit(0 if report["fits"] else 1)
+    if args.command == "bench-overlay":
+        apply_asset_options(args.asset_dpi, args.flat_background)
+        raise SystemExit(0 if benchmark_overlay(args.runs, args.lines, not args.no_check) else 1)
+    if args.command == "bench-threads":
+        apply_asset_options(args.asset_dpi, args.flat_background)
+        raise SystemExit(0 if benchmark_threads(args.runs, args.workers, check=not args.no_check) else 1)
+    if args.command == "bench-async":
+        apply_asset_options(args.asset_dpi, args.flat_background)
+        benchmark_async(args.burst, args.in_flight, args.queue, args.timeout, args.type)
+        raise SystemExit(0)
+    if args.command == "bench-priority":
+        apply_asset_options(args.asset_dpi, args.flat_background)
+        benchmark_priority(args.bulk, args.previews, args.interval, args.in_flight)
+        raise SystemExit(0)
+    if args.command == "bench-quality":
+        benchmark_quality(args.runs)
+        raise SystemExit(0)
+    if args.command == "check-flat-background":
+        raise SystemExit(0 if check_flat_background(args.dpi, args.tolerance) else 1)
+    if args.command in ("batch", "thumbnails"):
+        if args.synthetic:
+            jobs = [{"type": "facture", "data": {"number": f"F-2026/{i + 1:04d}", "items": synthetic_items(15)}}
+                    for i in range(args.synthetic)]
+        elif args.jobs:
+            jobs = load_batch_jobs(args.jobs)
+        else:
+            parser.error(f"{args.command} needs a job file or --synthetic N")
+        if args.command == "thumbnails":
+            for job in jobs:
+                job.update(thumbnail={"width": args.width, "format": args.format}, thumbnail_only=True)
+        elif args.thumbnail:
+            for job in jobs:
+                job["thumbnail"] = args.thumbnail
+        start = time.perf_counter()
+        failed = 0
+        for result in render_batch(jobs, args.workers, args.out_dir, args.asset_dpi, args.flat_background):
+            failed += not result["ok"]
+            result.pop("traceback", None)
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+        elapsed = time.perf_counter() - start
+        unit = "thumbnails" if args.command == "thumbnails" else "documents"
+        print(f"{len(jobs) - failed}/{len(jobs)} {unit} in {elapsed:.2f} s "
+              f"({len(jobs) / elapsed:.1f} {unit}/s)")
+        raise SystemExit(1 if failed else 0)
+    if args.command == "serve":
+        cache = None if args.no_cache else RenderCache(args.cache_mb * 1024 * 1024, args.cache_dir or None,
+                                                       args.cache_disk_mb * 1024 * 1024)
+        daemon = RenderDaemon(args.workers, args.timeout, args.asset_dpi, args.flat_background,
+                              args.watch_interval, cache)
+        where = args.socket or f"http://{args.host}:{args.port}"
+        print(f"Render daemon listening on {where} ({daemon.workers} workers)", flush=True)
+        try:
+            daemon.serve(args.host, args.port, args.socket)
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit(0)
+
+    if args.asset_dpi:
+        optimise_assets(args.asset_dpi)
+    if args.flat_background:
+        use_flat_background(args.flat_background)
+
     print("🔨 Generating LE TATCHE BOIS documents...")
     
     f1 = create_letterhead()
@@ -1256,3 +4887,7 @@ if __name__ == "__main__":
     print(f"✅ PV Fin de travaux: {f7}")
     
     print("\n🎉 All 7 documents generated successfully!")
+
+
+if __name__ == "__main__":
+    main()